@@ -82,6 +82,7 @@ def argument_parser():
     d_fraclm     = 0.1     # allowed fraction limit
     d_fraclo     = 0.05    # fraction of statistics [0,1] below low limit
     d_frachi     = 0.95    # fraction of statistics [0,1] below high limit
+    d_nbins      = 64      # number of 1-ADU histogram bins per pixel around pedestal
     d_deploy  = False
     d_tstamp  = None # 20180910111049 or run number <10000
     d_version = 'V2021-03-12'
@@ -93,7 +94,7 @@ def argument_parser():
     h_det     = 'detector name, default = %s' % d_det
     h_runs    = 'run number or list of runs e.g. 12,14-18, default = %s' % str(d_runs)
     h_nrecs   = 'number of records to calibrate pedestals, default = %s' % str(d_nrecs)
-    h_nrecs1  = 'number of records to process at 1st stage, default = %s' % str(d_nrecs1)
+    h_nrecs1  = 'number of records to process at 1st stage, not used by streaming dark statistics, default = %s' % str(d_nrecs1)
     h_dirxtc  = 'non-default xtc directory, default = %s' % d_dirxtc
     h_dirrepo = 'repository for calibration results, default = %s' % d_dirrepo
     h_usesmd  = 'add "smd" in dataset string, default = %s' % d_usesmd
@@ -116,6 +117,7 @@ def argument_parser():
     h_fraclm     = 'allowed fraction limit, default = %f' % d_fraclm
     h_fraclo     = 'fraction of statistics [0,1] below low  limit of the gate, default = %f' % d_fraclo
     h_frachi     = 'fraction of statistics [0,1] below high limit of the gate, default = %f' % d_frachi
+    h_nbins      = 'number of 1-ADU histogram bins per pixel around pedestal, default = %d' % d_nbins
     h_deploy  = 'deploy constants to the calib dir, default = %s' % d_deploy
     h_tstamp  = 'non-default time stamp in format YYYYmmddHHMMSS or run number(<10000) for constants selection in repo. '\
                 'By default run time is used, default = %s' % str(d_tstamp)
@@ -152,6 +154,7 @@ def argument_parser():
     parser.add_argument('--fraclm',        default=d_fraclm,     type=float, help=h_fraclm)
     parser.add_argument('--fraclo',        default=d_fraclo,     type=float, help=h_fraclo)
     parser.add_argument('--frachi',        default=d_frachi,     type=float, help=h_frachi)
+    parser.add_argument('--nbins',         default=d_nbins,      type=int,   help=h_nbins)
     parser.add_argument('-D', '--deploy',  action='store_true',              help=h_deploy)
     parser.add_argument('-t', '--tstamp',  default=d_tstamp,     type=int,   help=h_tstamp)
     parser.add_argument('-v', '--version', default=d_version,    type=str,   help=h_version)
@@ -84,13 +84,14 @@ def argument_parser():
     d_fraclm     = 0.1     # allowed fraction limit
     d_fraclo     = 0.05    # fraction of statistics [0,1] below low limit
     d_frachi     = 0.95    # fraction of statistics [0,1] below high limit
+    d_nbins      = 64      # number of 1-ADU histogram bins per pixel around pedestal
 
     h_fname   = 'input xtc file name, default = %s' % d_fname
     h_exp     = 'experiment name, default = %s' % d_exp
     h_det     = 'detector name, default = %s' % d_det
     h_runs    = 'run number or list of runs e.g. 12,14-18, default = %s' % str(d_runs)
     h_nrecs   = 'number of records to calibrate pedestals, default = %s' % str(d_nrecs)
-    h_nrecs1  = 'number of records to process at 1st stage, default = %s' % str(d_nrecs1)
+    h_nrecs1  = 'number of records to process at 1st stage, not used by streaming dark statistics, default = %s' % str(d_nrecs1)
     h_idx     = 'segment index (0-15 for epix10ka2m, 0-3 for quad) or all by default for processing, default = %s' % str(d_idx)
     h_dirxtc  = 'non-default xtc directory, default = %s' % d_dirxtc
     h_dirrepo = 'repository for calibration results, default = %s' % d_dirrepo
@@ -114,6 +115,7 @@ def argument_parser():
     h_fraclm     = 'allowed fraction limit, default = %f' % d_fraclm
     h_fraclo     = 'fraction of statistics [0,1] below low  limit of the gate, default = %f' % d_fraclo
     h_frachi     = 'fraction of statistics [0,1] below high limit of the gate, default = %f' % d_frachi
+    h_nbins      = 'number of 1-ADU histogram bins per pixel around pedestal, default = %d' % d_nbins
 
     parser = ArgumentParser(description='Proceses dark run xtc data for epix10ka')
     parser.add_argument('-f', '--fname',   default=d_fname,      type=str,   help=h_fname)
@@ -145,6 +147,7 @@ def argument_parser():
     parser.add_argument('--fraclm',        default=d_fraclm,     type=float, help=h_fraclm)
     parser.add_argument('--fraclo',        default=d_fraclo,     type=float, help=h_fraclo)
     parser.add_argument('--frachi',        default=d_frachi,     type=float, help=h_frachi)
+    parser.add_argument('--nbins',         default=d_nbins,      type=int,   help=h_nbins)
 
     return parser
 
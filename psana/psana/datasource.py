@@ -66,6 +66,11 @@ def DataSource(*args, **kwargs):
         if mode == 'mpi':
             if world_size == 1:
                 return SerialDataSource(*args, **kwargs)
+            elif kwargs.get('smd_index', False):
+                # With smd index files, each rank reads its own part of the
+                # run directly (no Smd0 and EventBuilder cores needed).
+                kwargs.update({'index_rank': rank, 'index_size': world_size})
+                return SerialDataSource(*args, **kwargs)
             else:
                
                 # >> these lines are here to AVOID initializing node.comms
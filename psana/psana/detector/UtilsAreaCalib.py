@@ -19,10 +19,9 @@ Created on 2021-02-10 by Mikhail Dubrovin
 import logging
 logger = logging.getLogger(__name__)
 import sys
-import numpy as np
 from psana.pyalgos.generic.Utils import create_directory, log_rec_on_start, str_tstamp, time_sec_from_stamp
 from psana.detector.Utils import info_dict, info_namespace, info_command_line
-from psana.detector.UtilsEpix10kaCalib import proc_dark_block
+from psana.detector.UtilsEpix10kaCalib import DarkStats, proc_dark_stats, reduce_dark_stats
 from psana.detector.utils_psana import seconds, datasource_kwargs, info_run #, timestamp_run
 from psana.pyalgos.generic.NDArrUtils import info_ndarr, save_2darray_in_textfile#, save_ndarray_in_textfile
 from psana import DataSource
@@ -174,8 +173,9 @@ def pedestals_calibration(**kwa):
   stepmax = kwa.get('stepmax', 5)
   evskip  = kwa.get('evskip', 0)
   events  = kwa.get('events', 1000)
+  nbins   = kwa.get('nbins', 64)
 
-  block = None
+  stats = None
   nrecs2 = nrecs-2
   iblrec = -1
   break_loop = False
@@ -229,16 +229,15 @@ def pedestals_calibration(**kwa):
             break_loop = True
             break
 
-        rows, cols = raw.shape
-        if block is None:
+        if stats is None:
            segs = odet.raw._segment_numbers(evt)
            logger.info(info_ndarr(segs, 'det.raw._segment_numbers(evt) '))
-           block=np.zeros((nrecs, rows, cols),dtype=raw.dtype)
-           logger.info(info_ndarr(block,'Created array for accumulation of raw data block[nrecs, nrows, ncols]\n '))
+           stats = DarkStats(raw.shape, nbins=nbins, int_lo=kwa.get('int_lo', 1), int_hi=kwa.get('int_hi', 16000))
+           logger.info('Created accumulator of dark statistics for raw shape %s in %d-bin window' % (str(raw.shape), nbins))
            #print(end=10*' ')
 
         iblrec += 1
-        block[iblrec,:] = raw
+        stats.add(raw)
         ss = info_ndarr(raw, 'Event %04d record %04d   raw[0,100:110] '%(ievt, iblrec), first=100, last=110)
         print(ss, end='\r')
         if selected_record(ievt) or selected_record(iblrec):
@@ -258,10 +257,13 @@ def pedestals_calibration(**kwa):
     if break_loop: break   # break run  loop
 
   logger.debug('run/step/event loop is completed')
-  blk = block[:iblrec+1,:]
-  logger.debug(info_ndarr(blk,'Begin processing of the data block '))
 
-  arr_av1, arr_rms, arr_sta = proc_dark_block(blk, **kwa)
+  comms = getattr(ds, 'comms', None)
+  if comms is not None: # merge statistics of MPI ranks on the lowest rank having data
+      stats = reduce_dark_stats(stats, comms.psana_comm)
+  if stats is None: return
+
+  arr_av1, arr_rms, arr_sta = proc_dark_stats(stats, **kwa)
 
   dic_consts = {
     'pedestals'    : arr_av1,\
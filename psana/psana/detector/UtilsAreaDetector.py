@@ -27,6 +27,8 @@ Usage::
   fill_holes(img, hrows, hcols)
   statistics_of_holes(rows, cols, **kwa)
   img = img_default(arr)
+  imap = ImageMapping(rows, cols)
+  img = imap.image(data, mapmode=2, fillholes=True, vbase=0, out=None)
 
   #TBD init_interpolation_parameters(rows, cols, x, y, **kwa)
   #TBD img = img_interpolated(data, interpol_pars, **kwa)
@@ -86,25 +88,14 @@ def statistics_of_pixel_arrays(rows, cols):
 
     img_shape = nrows, ncols = image_shape(rows, cols)
 
-    zipped_rows_cols = zip(rows.ravel(), cols.ravel())
-
     t0_sec = time()
-    img_sta = np.zeros(img_shape, dtype=np.uint16)
-    for r,c in zipped_rows_cols: img_sta[r,c]+=1 # 1.8 sec
-    # DOES NOT WORK FOR MULTI-ENTRIES... img_sta[rows.ravel(),cols.ravel()] += np.ones(rows.size, dtype=np.uint16) # 11ms
-    logger.debug('XXX statistics_of_pixel_arrays consumed time (sec) = %.6f' % (time()-t0_sec)) # 1.8 sec
+    img_inds = img_indices_ravel(rows, cols, ncols)
+    img_sta = np.bincount(img_inds, minlength=nrows*ncols).astype(np.uint16).reshape(img_shape)
+    logger.debug('XXX statistics_of_pixel_arrays consumed time (sec) = %.6f' % (time()-t0_sec))
     logger.debug('XXX np.bincount(img_sta): %s' % str(np.bincount(img_sta.ravel(), minlength=10)))
 
-    t0_sec = time()
-    cond = img_sta>1
-    #inds_img_multiple = np.extract(cond.ravel(), np.arange(img_sta.size))
-    #print(info_ndarr(inds_img_multiple, 'inds_img_multiple:'))
-
-    nrows, ncols = img_sta.shape
-    multinds = {i:int(r*ncols+c) for i,(r,c) in enumerate(zipped_rows_cols) if cond[r,c]}
-    #logger.debug('XXX dict multinds production time (sec) = %.6f' % (time()-t0_sec)) # 170us
-    #exit('TEST EXIT') #############
-
+    inds_multiple = np.nonzero(img_sta.ravel()[img_inds]>1)[0]
+    multinds = dict(zip(inds_multiple.tolist(), img_inds[inds_multiple].tolist()))
 
     s = '\n multiple mapping of pixels to image:'
     for k,v in multinds.items(): s += '\n  pix:%06d img:%06d' % (k,v)
@@ -160,7 +151,9 @@ def img_from_pixel_arrays(rows, cols, weight=1.0, dtype=np.float32, vbase=0):
 
 def img_multipixel_max(img, weight, dict_pix_to_img_idx):
     imgrav = img.ravel() # ravel() does not copy like ravel()
-    for ia,i in dict_pix_to_img_idx.items(): imgrav[i] = max(imgrav[i], weight.ravel()[ia])
+    ia = np.fromiter(dict_pix_to_img_idx.keys(), dtype=np.int64, count=len(dict_pix_to_img_idx))
+    i  = np.fromiter(dict_pix_to_img_idx.values(), dtype=np.int64, count=len(dict_pix_to_img_idx))
+    np.maximum.at(imgrav, i, weight.ravel()[ia])
 
     if logger.getEffectiveLevel()<=logging.DEBUG: #logger.level
         s = '\n  == img_multipixel_max cross-check'
@@ -177,7 +170,9 @@ def img_multipixel_mean(img, weight, dict_pix_to_img_idx, dict_imgidx_numentries
     imgrav = img.ravel()
     imgidx = list(dict_imgidx_numentries.keys())
     imgrav[imgidx] = 0                                               # initialization
-    for ia,i in dict_pix_to_img_idx.items(): imgrav[i] += weight.ravel()[ia] # accumulation
+    ia = np.fromiter(dict_pix_to_img_idx.keys(), dtype=np.int64, count=len(dict_pix_to_img_idx))
+    i  = np.fromiter(dict_pix_to_img_idx.values(), dtype=np.int64, count=len(dict_pix_to_img_idx))
+    np.add.at(imgrav, i, weight.ravel()[ia])                         # accumulation
     imgrav[imgidx] /= list(dict_imgidx_numentries.values())          # normalization
 
     if logger.getEffectiveLevel()<=logging.DEBUG: #logger.level
@@ -189,7 +184,72 @@ def img_multipixel_mean(img, weight, dict_pix_to_img_idx, dict_imgidx_numentries
             s += '\n  inds in img:%06d mean: %.1f for %d entries' % (i, imgrav[i], dict_imgidx_numentries[i])
         logger.debug(s)
     #return img
-    
+
+
+def img_indices_ravel(rows, cols, ncols):
+    """returns int64 array of ravel image indices for pixel rows and cols
+    """
+    return rows.ravel().astype(np.int64)*ncols + cols.ravel()
+
+
+class ImageMapping:
+    """Mapping of pixel (data) arrays to image made once per geometry.
+
+       Keeps ravel index arrays of image bins for pixels, pixels of multiple-entry bins
+       grouped by bin (for mapmode 2/3) and image holes with their 4 neighbors (for fillholes),
+       so that per event image is built by a few gather/scatter operations and reduceat.
+    """
+    def __init__(self, rows, cols):
+        assert isinstance(rows, np.ndarray)
+        assert isinstance(cols, np.ndarray)
+        assert rows.size == cols.size
+
+        t0_sec = time()
+        self.img_shape = nrows, ncols = image_shape(rows, cols)
+        self.img_inds = img_indices_ravel(rows, cols, ncols)
+        counts = np.bincount(self.img_inds, minlength=nrows*ncols)
+        self.img_entries = counts.astype(np.uint16).reshape(self.img_shape)
+
+        multi = counts[self.img_inds]>1
+        self.single_pix = np.nonzero(~multi)[0]
+        self.single_img = self.img_inds[self.single_pix]
+        multi_pix = np.nonzero(multi)[0]
+        self.multi_pix = multi_pix[np.argsort(self.img_inds[multi_pix], kind='stable')]
+        self.multi_img, self.multi_starts, self.multi_counts =\
+            np.unique(self.img_inds[self.multi_pix], return_index=True, return_counts=True)
+
+        self.img_holes = image_of_holes(counts.reshape(self.img_shape)>0)
+        hrows, hcols = hole_rows_cols(self.img_holes)
+        inner = (hrows>0) & (hrows<nrows-1) & (hcols>0) & (hcols<ncols-1) # bins on image border have < 4 neighbors
+        hrows, hcols = hrows[inner], hcols[inner]
+        self.hole_inds = hrows.astype(np.int64)*ncols + hcols
+        self.hole_nbrs = np.stack((self.hole_inds-ncols, self.hole_inds+ncols, self.hole_inds-1, self.hole_inds+1))
+
+        logger.debug('ImageMapping: image shape %s, %d multiple-entry bins, %d holes, time (sec) = %.6f'%\
+                     (str(self.img_shape), self.multi_img.size, self.hole_inds.size, time()-t0_sec))
+
+    def image(self, data, mapmode=2, fillholes=True, vbase=0, out=None):
+        """Returns image of data for mapmode 1/2/3 - last/max/mean pixel intensity in overlapping bins.
+           If out (float32 image-shaped array) is passed, image is made in it.
+        """
+        img = np.empty(self.img_shape, dtype=np.float32) if out is None else out
+        imgrav = img.reshape(-1)
+        w = data.ravel()
+        imgrav.fill(vbase)
+
+        if mapmode==1 or self.multi_img.size==0:
+            imgrav[self.img_inds] = w
+        else:
+            imgrav[self.single_img] = w[self.single_pix]
+            v = w[self.multi_pix]
+            imgrav[self.multi_img] = np.maximum.reduceat(v, self.multi_starts) if mapmode==2 else\
+                                     np.add.reduceat(v, self.multi_starts) / self.multi_counts
+
+        if fillholes and self.hole_inds.size:
+            nbrs = imgrav[self.hole_nbrs]
+            imgrav[self.hole_inds] = np.minimum(np.minimum(nbrs[0], nbrs[1]), np.minimum(nbrs[2], nbrs[3]))
+        return img
+
 
 def size_for_shape(shape): return np.empty(shape).size
 
@@ -9,11 +9,21 @@ Usage::
     #OR
     import psana.detector.UtilsCommonMode as ucm
 
-    ucm.common_mode_rows(arr, mask=None, cormax=None, npix_min=10)
-    ucm.common_mode_cols(arr, mask=None, cormax=None, npix_min=10)
-    ucm.common_mode_2d(arr, mask=None, cormax=None, npix_min=10)
-    ucm.common_mode_rows_hsplit_nbanks(data, mask, nbanks=4, cormax=None)
-    ucm.common_mode_2d_hsplit_nbanks(data, mask, nbanks=4, cormax=None)
+    ucm.common_mode_rows(arr, mask=None, cormax=None, npix_min=10, backend=None)
+    ucm.common_mode_cols(arr, mask=None, cormax=None, npix_min=10, backend=None)
+    ucm.common_mode_2d(arr, mask=None, cormax=None, npix_min=10, backend=None)
+    ucm.common_mode_rows_hsplit_nbanks(data, mask, nbanks=4, cormax=None, backend=None)
+    ucm.common_mode_2d_hsplit_nbanks(data, mask, nbanks=4, cormax=None, backend=None)
+
+    arr and mask are 2-d or 3-d (<segments>, rows, cols) arrays, 3-d arrays are corrected per segment.
+
+Backends::
+
+    'ext'   - compiled kernels of psana.detector.commonmode_ext (median by partial selection,
+              parallel over segments/rows/cols/banks), default if built, bit-identical to 'numpy'
+    'numpy' - np.median/np.ma.median per 2-d array
+    backend=None uses PS_CM_BACKEND environment variable (default 'ext').
+    'ext' kernels run in PS_CM_THREADS threads (default 1).
 
 This software was developed for the LCLS project.
 If you use all or part of it, please give an appropriate acknowledgment.
@@ -25,19 +35,53 @@ Created on 2018-01-31 by Mikhail Dubrovin
 import logging
 logger = logging.getLogger(__name__)
 
+import os
 import numpy as np
 from math import fabs
 from psana.pyalgos.generic.NDArrUtils import info_ndarr, print_ndarr
 
+try:
+    import psana.detector.commonmode_ext as cmext
+except ImportError:
+    cmext = None
+
+CM_BACKEND = os.environ.get('PS_CM_BACKEND', 'ext')
+CM_THREADS = max(int(os.environ.get('PS_CM_THREADS', 1)), 1)
+
+
+def _ext_args(arr, mask, backend):
+    """Returns (arr, mask) 3-d views for compiled kernels or None if numpy backend should be used."""
+    if (CM_BACKEND if backend is None else backend) != 'ext' or cmext is None: return None
+    if arr.dtype not in (np.float32, np.float64) or arr.ndim not in (2,3): return None
+    arr3d = arr if arr.ndim==3 else arr[np.newaxis,:]
+    if mask is None: return arr3d, None
+    if mask.shape != arr.shape: return None
+    mask3d = mask if mask.ndim==3 else mask[np.newaxis,:]
+    if mask3d.dtype != np.uint8: mask3d = (mask3d>0).view(np.uint8) # 0/1 masks
+    return arr3d, mask3d
+
 
-def common_mode_rows(arr, mask=None, cormax=None, npix_min=10):
+def _per_segment(func, arr, mask, *args):
+    """Applies numpy backend func to each segment of 3-d arr."""
+    for i in range(arr.shape[0]):
+        func(arr[i], None if mask is None else mask[i], *args, backend='numpy')
+
+
+def common_mode_rows(arr, mask=None, cormax=None, npix_min=10, backend=None):
     """Defines and applys common mode correction to 2-d arr for rows.
        I/O parameters:
        - arr (float) - i/o 2-d array of intensities
        - mask (int or None) - the same shape 2-d array of bad/good = 0/1 pixels
        - cormax (float or None) - maximal allowed correction in ADU
        - npix_min (int) - minimal number of good pixels in row to evaluate and apply correction
+       - backend (str or None) - 'ext'/'numpy'/None - see module docstring
     """
+    ext = _ext_args(arr, mask, backend)
+    if ext is not None:
+        cmext.rows(*ext, cormax=cormax, npix_min=npix_min, num_threads=CM_THREADS)
+        return
+    if arr.ndim==3: return _per_segment(common_mode_rows, arr, mask, cormax, npix_min)
+
     rows, cols = arr.shape
     if mask is None:
         cmode = np.median(arr,axis=1) # column of median values
@@ -61,14 +105,21 @@ def common_mode_rows(arr, mask=None, cormax=None, npix_min=10):
 
 
 
-def common_mode_cols(arr, mask=None, cormax=None, npix_min=10):
+def common_mode_cols(arr, mask=None, cormax=None, npix_min=10, backend=None):
     """Defines and applys common mode correction to 2-d arr for cols.
        I/O parameters:
        - arr (float) - i/o 2-d array of intensities
        - mask (int or None) - the same shape 2-d array of bad/good = 0/1 pixels
        - cormax (float or None) - maximal allowed correction in ADU
        - npix_min (int) - minimal number of good pixels in column to evaluate and apply correction
+       - backend (str or None) - 'ext'/'numpy'/None - see module docstring
     """
+    ext = _ext_args(arr, mask, backend)
+    if ext is not None:
+        cmext.cols(*ext, cormax=cormax, npix_min=npix_min, num_threads=CM_THREADS)
+        return
+    if arr.ndim==3: return _per_segment(common_mode_cols, arr, mask, cormax, npix_min)
+
     rows, cols = arr.shape
     if mask is None:
         cmode = np.median(arr,axis=0)
@@ -91,9 +142,15 @@ def common_mode_cols(arr, mask=None, cormax=None, npix_min=10):
 
 
 
-def common_mode_2d(arr, mask=None, cormax=None, npix_min=10):
+def common_mode_2d(arr, mask=None, cormax=None, npix_min=10, backend=None):
     """Defines and applys common mode correction to entire 2-d arr using the same shape mask. 
     """
+    ext = _ext_args(arr, mask, backend)
+    if ext is not None:
+        cmext.banks2d(*ext, cormax=cormax, npix_min=npix_min, num_threads=CM_THREADS)
+        return
+    if arr.ndim==3: return _per_segment(common_mode_2d, arr, mask, cormax, npix_min)
+
     if mask is None:
         cmode = np.median(arr)
         if cormax is None or fabs(cmode) < cormax:
@@ -109,39 +166,52 @@ def common_mode_2d(arr, mask=None, cormax=None, npix_min=10):
 
 
 
-def common_mode_rows_hsplit_nbanks(data, mask=None, nbanks=4, cormax=None, npix_min=10):
+def common_mode_rows_hsplit_nbanks(data, mask=None, nbanks=4, cormax=None, npix_min=10, backend=None):
     """Works with 2-d data and mask numpy arrays,
        hsplits them for banks (df. nbanks=4),
        for each bank applies median common mode correction for pixels in rows,
        hstack banks in array of original data shape and copy results in i/o data 
     """
+    ext = _ext_args(data, mask, backend)
+    if ext is not None:
+        cmext.rows(*ext, cormax=cormax, npix_min=npix_min, nbanks=nbanks, num_threads=CM_THREADS)
+        return
+    if data.ndim==3: return _per_segment(common_mode_rows_hsplit_nbanks, data, mask, nbanks, cormax, npix_min)
+
     bdata = np.hsplit(data, nbanks)
 
     if mask is None:
         for b in bdata:
-            common_mode_rows(b, None, cormax, npix_min)
+            common_mode_rows(b, None, cormax, npix_min, backend='numpy')
     else:
         bmask = np.hsplit(mask, nbanks)
         for b,m in zip(bdata,bmask):
-            common_mode_rows(b, m, cormax, npix_min)
+            common_mode_rows(b, m, cormax, npix_min, backend='numpy')
     data[:] = np.hstack(bdata)[:]    
 
 
 
-def common_mode_2d_hsplit_nbanks(data, mask=None, nbanks=4, cormax=None, npix_min=10):
+def common_mode_2d_hsplit_nbanks(data, mask=None, nbanks=4, cormax=None, npix_min=10, backend=None):
     """Works with 2-d data and mask numpy arrays,
        hsplits them for banks (df. nbanks=4),
        for each bank applies median common mode correction for all pixels,
        hstack banks in array of original data shape and copy results in i/o data 
     """
+    ext = _ext_args(data, mask, backend)
+    if ext is not None:
+        if mask is None: cmext.rows(*ext, cormax=cormax, npix_min=npix_min, nbanks=nbanks, num_threads=CM_THREADS) # as numpy backend
+        else: cmext.banks2d(*ext, cormax=cormax, npix_min=npix_min, nbanks=nbanks, num_threads=CM_THREADS)
+        return
+    if data.ndim==3: return _per_segment(common_mode_2d_hsplit_nbanks, data, mask, nbanks, cormax, npix_min)
+
     bdata = np.hsplit(data, nbanks)
     if mask is None:
         for b in bdata:
-            common_mode_rows(b, None, cormax, npix_min)
+            common_mode_rows(b, None, cormax, npix_min, backend='numpy')
     else:
         bmask = np.hsplit(mask, nbanks) if mask is not None else None
         for b,m in zip(bdata,bmask):
-            common_mode_2d(b, m, cormax, npix_min)
+            common_mode_2d(b, m, cormax, npix_min, backend='numpy')
     data[:] = np.hstack(bdata)[:]    
 
 # EOF
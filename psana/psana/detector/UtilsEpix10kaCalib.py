@@ -8,6 +8,7 @@ CALIBRATION - TEST PULSES
 import os
 import sys
 from time import time
+from concurrent.futures import ThreadPoolExecutor
 import logging
 logger = logging.getLogger(__name__)
 DICT_NAME_TO_LEVEL = logging._nameToLevel
@@ -194,13 +195,6 @@ def proc_dark_block(block, **kwa):
     detname    = kwa.get('det', None)
     int_lo     = kwa.get('int_lo', 1)       # lowest  intensity accepted for dark evaluation
     int_hi     = kwa.get('int_hi', 16000)   # highest intensity accepted for dark evaluation
-    intnlo     = kwa.get('intnlo', 6.0)     # intensity ditribution number-of-sigmas low
-    intnhi     = kwa.get('intnhi', 6.0)     # intensity ditribution number-of-sigmas high
-    rms_lo     = kwa.get('rms_lo', 0.001)   # rms ditribution low
-    rms_hi     = kwa.get('rms_hi', 16000)   # rms ditribution high
-    rmsnlo     = kwa.get('rmsnlo', 6.0)     # rms ditribution number-of-sigmas low
-    rmsnhi     = kwa.get('rmsnhi', 6.0)     # rms ditribution number-of-sigmas high
-    fraclm     = kwa.get('fraclm', 0.1)     # allowed fraction limit
     fraclo     = kwa.get('fraclo', 0.05)    # fraction of statistics below low gate limit
     frachi     = kwa.get('frachi', 0.95)    # fraction of statistics below high gate limit
     frac05     = 0.5
@@ -320,6 +314,37 @@ def proc_dark_block(block, **kwa):
         arr_max = np.maximum(arr_max, raw)
         arr_min = np.minimum(arr_min, raw)
 
+    arr_av1, arr_rms, arr_sta = proc_dark_sums(arr_sum0, arr_sum1, arr_sum2, sta_int_lo, sta_int_hi, nrecs, arr_med, med_abs_dev, **kwa)
+
+    logger.info('data block processing time = %.3f sec' % (time()-t0_sec))
+    logger.debug(info_ndarr(arr_av1, 'arr_av1     [100:105] ', first=100, last=105))
+    logger.debug(info_ndarr(arr_rms, 'pixel_rms   [100:105] ', first=100, last=105))
+    logger.debug(info_ndarr(arr_sta, 'pixel_status[100:105] ', first=100, last=105))
+    logger.debug(info_ndarr(arr_med, 'arr mediane [100:105] ', first=100, last=105))
+
+    return arr_av1, arr_rms, arr_sta
+
+
+def proc_dark_sums(arr_sum0, arr_sum1, arr_sum2, sta_int_lo, sta_int_hi, nrecs, arr_med, med_abs_dev, **kwa):
+    """Returns per-pixel arrays of gated average, rms and status evaluated from
+       arr_sum0/1/2 - number/sum/sum of squares of intensities in the gate,
+       sta_int_lo/hi - numbers of intensities below int_lo/above int_hi in nrecs records,
+       arr_med - median intensities substituted for average deviated by more than med_abs_dev.
+       kwa - the same as in proc_dark_block.
+    """
+    int_lo     = kwa.get('int_lo', 1)       # lowest  intensity accepted for dark evaluation
+    int_hi     = kwa.get('int_hi', 16000)   # highest intensity accepted for dark evaluation
+    intnlo     = kwa.get('intnlo', 6.0)     # intensity ditribution number-of-sigmas low
+    intnhi     = kwa.get('intnhi', 6.0)     # intensity ditribution number-of-sigmas high
+    rms_lo     = kwa.get('rms_lo', 0.001)   # rms ditribution low
+    rms_hi     = kwa.get('rms_hi', 16000)   # rms ditribution high
+    rmsnlo     = kwa.get('rmsnlo', 6.0)     # rms ditribution number-of-sigmas low
+    rmsnhi     = kwa.get('rmsnhi', 6.0)     # rms ditribution number-of-sigmas high
+    fraclm     = kwa.get('fraclm', 0.1)     # allowed fraction limit
+
+    shape = arr_med.shape
+    arr1 = np.ones(shape, dtype=np.uint64)
+
     arr_av1 = divide_protected(arr_sum1, arr_sum0)
     arr_av2 = divide_protected(arr_sum2, arr_sum0)
 
@@ -369,11 +394,259 @@ def proc_dark_block(block, **kwa):
     frac_bad = arr_sta_bad.sum()/float(arr_av1.size)
     logger.debug('fraction of panel pixels with gated average deviated from and replaced by median: %.6f' % frac_bad)
 
-    logger.info('data block processing time = %.3f sec' % (time()-t0_sec))
+    return arr_av1, arr_rms, arr_sta
+
+
+# Streaming dark statistics. Pixel intensities are accumulated in per-pixel
+# histograms of nbins 1-ADU bins around the pixel median found in the first
+# nref frames, with underflow/overflow bins, plus Welford mean/M2 and counters
+# of intensities out of [int_lo, int_hi]. Memory does not depend on the number
+# of frames and partial statistics of MPI ranks are merged in a binary tree.
+# Segments (the 1st axis of 3-d raw) are accumulated concurrently by up to
+# PS_DARK_THREADS (default 1, set it to the number of cores per MPI rank) threads.
+
+DARK_THREADS = max(int(os.environ.get('PS_DARK_THREADS', 1)), 1)
+_dark_pool = None
+
+def dark_pool():
+    """Returns ThreadPoolExecutor shared by DarkStats objects of the process."""
+    global _dark_pool
+    if _dark_pool is None:
+        _dark_pool = ThreadPoolExecutor(max_workers=DARK_THREADS, thread_name_prefix='dark_stats')
+    return _dark_pool
+
+
+class DarkStats:
+    """Single-pass per-pixel statistics of dark frames of shape (<segments>, rows, cols) or (rows, cols).
+
+       Usage::
+
+           stats = DarkStats(raw.shape, nbins=64, int_lo=1, int_hi=16000)
+           for raw in frames: stats.add(raw)
+           stats.merge(stats_of_another_rank)
+           arr_av1, arr_rms, arr_sta = proc_dark_stats(stats, seg=None, **kwa)
+
+       hist[..., b] counts intensities off+b-1 for b in 1..nbins,
+       b=0 and b=nbins+1 are underflow and overflow bins.
+    """
+    def __init__(self, shape, nbins=64, int_lo=1, int_hi=16000, nref=8):
+        self.shape  = tuple(shape)
+        self.nbins  = nbins
+        self.int_lo = int_lo
+        self.int_hi = int_hi
+        self.nref   = max(nref, 1)
+        self.n      = 0     # number of accumulated frames
+        self.off    = None  # per-pixel intensity of the 1st histogram bin
+        self.hist   = None
+        self.mean   = None
+        self.m2     = None
+        self.sta_int_lo = None
+        self.sta_int_hi = None
+        self._refs  = []    # frames buffered before the histogram window is defined
+
+    def _segments(self):
+        return [(i,) for i in range(self.shape[0])] if len(self.shape) > 2 else [()]
+
+    def _map(self, func, *args):
+        segs = self._segments()
+        if len(segs) < 2 or DARK_THREADS < 2:
+            for s in segs: func(s, *args)
+        else:
+            for f in [dark_pool().submit(func, s, *args) for s in segs]: f.result()
+
+    def _allocate(self, refs):
+        med = np.median(np.array(refs), axis=0)
+        self.off = (np.floor(med) - self.nbins//2).astype(np.int32)
+        self.hist = np.zeros(self.shape + (self.nbins+2,), dtype=np.uint16)
+        self.mean = np.zeros(self.shape, dtype=np.float64)
+        self.m2   = np.zeros(self.shape, dtype=np.float64)
+        self.sta_int_lo = np.zeros(self.shape, dtype=np.uint32)
+        self.sta_int_hi = np.zeros(self.shape, dtype=np.uint32)
+
+    def _upcast(self, n):
+        if n > np.iinfo(self.hist.dtype).max:
+            self.hist = self.hist.astype(np.uint32 if n <= np.iinfo(np.uint32).max else np.uint64)
+
+    def _add_segment(self, s, raw):
+        nb2 = self.nbins + 2
+        r = raw[s]
+        h = self.hist[s].reshape(-1)
+        b = r.reshape(-1).astype(np.intp) - self.off[s].reshape(-1)
+        b += 1
+        np.clip(b, 0, nb2-1, out=b)
+        b += np.arange(0, h.size, nb2)
+        h[b] += 1 # indexes are unique - one per pixel
+        x = r.astype(np.float64)
+        mean = self.mean[s]
+        d = x - mean
+        mean += d / self.n
+        self.m2[s] += d * (x - mean)
+        self.sta_int_lo[s] += r < self.int_lo
+        self.sta_int_hi[s] += r > self.int_hi
+
+    def _add(self, raw):
+        self._upcast(self.n + 1)
+        self.n += 1
+        self._map(self._add_segment, raw)
+
+    def flush(self):
+        """Defines the histogram window from buffered frames and accumulates them."""
+        if self.off is not None or not self._refs: return
+        refs, self._refs = self._refs, []
+        self._allocate(refs)
+        for raw in refs: self._add(raw)
+
+    def add(self, raw):
+        """Accumulates frame raw of intensities."""
+        if raw.shape != self.shape:
+            raise ValueError('DarkStats: frame shape %s differs from %s' % (str(raw.shape), str(self.shape)))
+        if self.off is None:
+            self._refs.append(np.array(raw))
+            if len(self._refs) >= self.nref: self.flush()
+            return
+        self._add(raw)
+
+    def _merge_segment(self, s, other):
+        nb2 = self.nbins + 2
+        ho = other.hist[s].reshape(-1, other.nbins + 2)
+        # intensities of other bins, under/overflow taken as intensities next to the other window
+        v = other.off[s].reshape(-1,1) + np.arange(-1, other.nbins+1, dtype=np.int32)
+        b = v - self.off[s].reshape(-1,1) + 1
+        np.clip(b, 0, nb2-1, out=b)
+        b += np.arange(0, ho.shape[0]*nb2, nb2).reshape(-1,1)
+        h = self.hist[s].reshape(-1)
+        h += np.bincount(b.ravel(), weights=ho.ravel(), minlength=h.size).astype(h.dtype)
+        self.sta_int_lo[s] += other.sta_int_lo[s]
+        self.sta_int_hi[s] += other.sta_int_hi[s]
+
+    def merge(self, other):
+        """Adds statistics of other DarkStats object of the same shape."""
+        if other.shape != self.shape:
+            raise ValueError('DarkStats: merged shape %s differs from %s' % (str(other.shape), str(self.shape)))
+        self.flush()
+        other.flush()
+        if other.n == 0: return self
+        if self.n == 0:
+            self.__dict__.update(other.__dict__)
+            return self
+        n = self.n + other.n
+        self._upcast(n)
+        self._map(self._merge_segment, other)
+        d = other.mean - self.mean
+        self.m2 += other.m2 + d * d * (self.n * other.n / n)
+        self.mean += d * (other.n / n)
+        self.n = n
+        return self
+
+
+def reduce_dark_stats(stats, comm, tag=77):
+    """Merges DarkStats objects of MPI ranks of comm (stats may be None).
+       Returns merged statistics on the lowest rank having data, None on other ranks.
+    """
+    from mpi4py import MPI
+    if comm == MPI.COMM_NULL: return None
+    if stats is not None: stats.flush()
+    flags = comm.allgather(stats is not None and stats.n > 0)
+    ranks = [r for r,f in enumerate(flags) if f]
+    rank = comm.Get_rank()
+    if rank not in ranks: return None
+    i, step = ranks.index(rank), 1
+    while step < len(ranks):
+        if i % (2*step):
+            comm.send(stats, dest=ranks[i-step], tag=tag)
+            return None
+        if i + step < len(ranks):
+            stats.merge(comm.recv(source=ranks[i+step], tag=tag))
+        step *= 2
+    logger.info('merged dark statistics of %d ranks, number of frames: %d' % (len(ranks), stats.n))
+    return stats
+
+
+def proc_dark_stats(stats, seg=None, **kwa):
+    """Returns arrays of mean, rms, status evaluated from DarkStats for segment index seg or all pixels.
+       The same algorithm as proc_dark_block:
+       - quantiles fraclo, 0.5, frachi interpolated within 1-ADU histogram bins
+         (the same as quantiles of intensities dithered by random [0,1)-0.5),
+       - spectral peak width estimator median(abs(raw-med)) is approximated by
+         half of the per-pixel inter-quartile range,
+       - pixels with gate limits in underflow or overflow bins get ungated mean and rms.
+    """
+    int_lo     = kwa.get('int_lo', 1)       # lowest  intensity accepted for dark evaluation
+    int_hi     = kwa.get('int_hi', 16000)   # highest intensity accepted for dark evaluation
+    fraclo     = kwa.get('fraclo', 0.05)    # fraction of statistics below low gate limit
+    frachi     = kwa.get('frachi', 0.95)    # fraction of statistics below high gate limit
+    frac05     = 0.5
+
+    t0_sec = time()
+    stats.flush()
+    n, nbins = stats.n, stats.nbins
+    sl = () if seg is None else (seg,)
+    shape = stats.shape[len(sl):]
+    h   = stats.hist[sl].reshape(-1, nbins+2)
+    off = stats.off[sl].reshape(-1)
+
+    cum = np.cumsum(h, axis=1, dtype=np.int64)
+    def quantile(q): # intensity within bin b is uniformly distributed in [off+b-1.5, off+b-0.5)
+        r = q * n
+        b = (cum < r).sum(axis=1).reshape(-1,1) # the 1st bin with cum >= r, h[b] > 0
+        hb = np.take_along_axis(h, b, axis=1)[:,0]
+        cb = np.take_along_axis(cum, b, axis=1)[:,0]
+        b = b[:,0]
+        return off + b - 1.5 + (r - cb + hb) / hb, b
+
+    arr_med, bmed = quantile(frac05)
+    arr_qlo, blo = quantile(fraclo)
+    arr_qhi, bhi = quantile(frachi)
+    arr_q25, _ = quantile(0.25)
+    arr_q75, _ = quantile(0.75)
+
+    med_med = np.median(arr_med)
+    med_qlo = np.median(arr_qlo)
+    med_qhi = np.median(arr_qhi)
+    med_abs_dev = np.median(arr_q75 - arr_q25) / 2
+
+    s = 'Pre-processing time %.3f sec' % (time()-t0_sec)\
+      + '\nResults for median over pixels intensities in %d frames:' % n\
+      + '\n    %.3f fraction of the event spectrum is below %.3f ADU - pedestal estimator' % (frac05, med_med)\
+      + '\n    %.3f fraction of the event spectrum is below %.3f ADU - gate low limit' % (fraclo, med_qlo)\
+      + '\n    %.3f fraction of the event spectrum is below %.3f ADU - gate upper limit' % (frachi, med_qhi)\
+      + '\n    event spectrum spread (q75-q25)/2: %.3f ADU - spectral peak width estimator' % med_abs_dev
+    logger.info(s)
+
+    gate_lo = np.maximum(arr_qlo, int_lo).astype(np.uint16)
+    gate_hi = np.minimum(arr_qhi, int_hi).astype(np.uint16)
+    cond = gate_hi>gate_lo
+    gate_hi[np.logical_not(cond)] +=1
+
+    arr_sum0 = np.zeros(off.shape, dtype=np.uint64)
+    arr_sum1 = np.zeros(off.shape, dtype=np.float64)
+    arr_sum2 = np.zeros(off.shape, dtype=np.float64)
+    for b in range(1, nbins+1):
+        v = off + (b-1)
+        hb = np.where((v>=gate_lo) & (v<=gate_hi), h[:,b], 0)
+        arr_sum0 += hb.astype(np.uint64)
+        vf = v.astype(np.float64)
+        arr_sum1 += hb * vf
+        arr_sum2 += hb * np.square(vf)
+
+    out = (blo == 0) | (bhi == nbins+1)
+    if out.any():
+        logger.info('%d pixels with gate limits out of the %d-bin window get ungated mean and rms' % (out.sum(), nbins))
+        mean = stats.mean[sl].reshape(-1)[out]
+        med_out = (bmed == 0) | (bmed == nbins+1)
+        arr_med[med_out] = stats.mean[sl].reshape(-1)[med_out]
+        arr_sum0[out] = n
+        arr_sum1[out] = n * mean
+        arr_sum2[out] = stats.m2[sl].reshape(-1)[out] + n * np.square(mean)
+
+    sh = lambda a: a.reshape(shape)
+    arr_av1, arr_rms, arr_sta = proc_dark_sums(sh(arr_sum0), sh(arr_sum1), sh(arr_sum2),\
+                                               stats.sta_int_lo[sl], stats.sta_int_hi[sl], n, sh(arr_med), med_abs_dev, **kwa)
+
+    logger.info('dark statistics processing time = %.3f sec' % (time()-t0_sec))
     logger.debug(info_ndarr(arr_av1, 'arr_av1     [100:105] ', first=100, last=105))
     logger.debug(info_ndarr(arr_rms, 'pixel_rms   [100:105] ', first=100, last=105))
     logger.debug(info_ndarr(arr_sta, 'pixel_status[100:105] ', first=100, last=105))
-    logger.debug(info_ndarr(arr_med, 'arr mediane [100:105] ', first=100, last=105))
 
     return arr_av1, arr_rms, arr_sta
 
@@ -416,6 +689,98 @@ def data_source_kwargs(**kwa):
     return kwa
 
 
+def save_dark_panels(stats, mode, tstamp, segment_inds, segment_ids, **kwa):
+    """Processes DarkStats of one step for panels and saves pedestals, rms and status for gain mode in the repository
+    """
+    exp        = kwa.get('exp', None)
+    irun       = irun_first(kwa.get('runs', None))
+    dirrepo    = kwa.get('dirrepo', CALIB_REPO_EPIX10KA)
+    fmt_peds   = kwa.get('fmt_peds', '%.3f')
+    fmt_rms    = kwa.get('fmt_rms',  '%.3f')
+    fmt_status = kwa.get('fmt_status', '%4i')
+    idx_sel    = kwa.get('idx', None)
+    dirmode    = kwa.get('dirmode', 0o777)
+    filemode   = kwa.get('filemode', 0o666)
+
+    for idx, panel_id in zip(segment_inds,segment_ids):
+
+        if idx_sel is not None and idx_sel != idx: continue # skip panels with inices other than idx_sel if specified
+
+        logger.info('\n%s\nprocess panel:%02d id:%s' % (96*'=', idx, panel_id))
+
+        #if mode is None:
+        #    msg = 'Gain mode for dark processing is not defined "%s" try to set option -m <gain-mode>' % mode
+        #    logger.warning(msg)
+        #    sys.exit(msg)
+
+        dir_panel, dir_offset, dir_peds, dir_plots, dir_work, dir_gain, dir_rms, dir_status = dir_names(dirrepo, panel_id)
+
+        #print('XXXX panel_id, tstamp, exp, irun', panel_id, tstamp, exp, irun)
+
+        fname_prefix, panel_alias = file_name_prefix(dirrepo, panel_id, tstamp, exp, irun)
+        logger.debug('\n  fname_prefix:%s\n  panel_alias :%s' % (fname_prefix, panel_alias))
+
+        prefix_offset, prefix_peds, prefix_plots, prefix_gain, prefix_rms, prefix_status =\
+            path_prefixes(fname_prefix, dir_offset, dir_peds, dir_plots, dir_gain, dir_rms, dir_status)
+
+        #logger.debug('Directories under %s\n  SHOULD ALREADY EXIST after charge-injection offset_calibration' % dir_panel)
+        #assert os.path.exists(dir_offset), 'Directory "%s" DOES NOT EXIST' % dir_offset
+        #assert os.path.exists(dir_peds),   'Directory "%s" DOES NOT EXIST' % dir_peds        
+
+        create_directory(dir_panel,  mode=dirmode)
+        create_directory(dir_peds,   mode=dirmode)
+        create_directory(dir_offset, mode=dirmode)
+        create_directory(dir_gain,   mode=dirmode)
+        create_directory(dir_rms,    mode=dirmode)
+        create_directory(dir_status, mode=dirmode)
+
+
+        dark, rms, status = proc_dark_stats(stats, seg=idx, **kwa) # process pedestals per-panel (352, 384)
+
+
+        #continue # TEST
+        #==========
+
+        fname = '%s_pedestals_%s.dat' % (prefix_peds, mode)
+        save_2darray_in_textfile(dark, fname, filemode, fmt_peds)
+
+        fname = '%s_rms_%s.dat' % (prefix_rms, mode)
+        save_2darray_in_textfile(rms, fname, filemode, fmt_rms)
+
+        fname = '%s_status_%s.dat' % (prefix_status, mode)
+        save_2darray_in_textfile(status, fname, filemode, fmt_status)
+
+        #if this is an auto gain ranging mode, also calculate the corresponding _L pedestal:
+
+        if mode=='AHL-H': # evaluate AHL_L from AHL_H
+            ped_hl_h = dark #[3,:,:]
+
+            offset_hl_h = load_panel_constants(dir_offset, 'offset_AHL-H', tstamp)
+            offset_hl_l = load_panel_constants(dir_offset, 'offset_AHL-L', tstamp)
+            gain_hl_h   = load_panel_constants(dir_gain,   'gainci_AHL-H', tstamp)
+            gain_hl_l   = load_panel_constants(dir_gain,   'gainci_AHL-L', tstamp)
+
+            #if offset is not None:
+            if all([v is not None for v in (offset_hl_h, offset_hl_l, gain_hl_h, gain_hl_l)]):
+                ped_hl_l = offset_hl_l - (offset_hl_h - ped_hl_h) * divide_protected(gain_hl_l, gain_hl_h) #V3 Gabriel's
+                fname = '%s_pedestals_AHL-L.dat' % prefix_peds
+                save_2darray_in_textfile(ped_hl_l, fname, filemode, fmt_peds)
+
+        elif mode=='AML-M': # evaluate AML_L from AML_M
+            ped_ml_m = dark #[4,:,:]
+
+            offset_ml_m = load_panel_constants(dir_offset, 'offset_AML-M', tstamp)
+            offset_ml_l = load_panel_constants(dir_offset, 'offset_AML-L', tstamp)
+            gain_ml_m   = load_panel_constants(dir_gain,   'gainci_AML-M', tstamp)
+            gain_ml_l   = load_panel_constants(dir_gain,   'gainci_AML-L', tstamp)
+
+            #if offset is not None:
+            if all([v is not None for v in (offset_ml_m, offset_ml_l, gain_ml_m, gain_ml_l)]):
+                ped_ml_l = offset_ml_l - (offset_ml_m - ped_ml_m) * divide_protected(gain_ml_l, gain_ml_m) #V3 Gabriel's
+                fname = '%s_pedestals_AML-L.dat' % prefix_peds
+                save_2darray_in_textfile(ped_ml_l, fname, filemode, fmt_peds)
+
+
 def pedestals_calibration(*args, **kwa):
     """NEWS significant ACCELERATION is acheived:
        - accumulate data for entire epix10kam_2m/quad array
@@ -433,21 +798,16 @@ def pedestals_calibration(*args, **kwa):
     events     = kwa.get('events', 1000)
     dirxtc     = kwa.get('dirxtc', None)
     dirrepo    = kwa.get('dirrepo', CALIB_REPO_EPIX10KA)
-    fmt_peds   = kwa.get('fmt_peds', '%.3f')
-    fmt_rms    = kwa.get('fmt_rms',  '%.3f')
-    fmt_status = kwa.get('fmt_status', '%4i')
-    idx_sel    = kwa.get('idx', None)
     dirmode    = kwa.get('dirmode', 0o777)
-    filemode   = kwa.get('filemode', 0o666)
     usesmd     = kwa.get('usesmd', False)
     logmode    = kwa.get('logmode', 'DEBUG')
     errskip    = kwa.get('errskip', False)
+    nbins      = kwa.get('nbins', 64)
 
     logger.setLevel(DICT_NAME_TO_LEVEL[logmode])
 
     #irun = runs[0] if isinstance(runs, list) else\
     #       int(runs.split(',',1)[0].split('-',1)[0]) # int first run number from str of run(s)
-    irun = irun_first(runs)
 
     #dsname = 'exp=%s:run=%s'%(exp,runs) if dirxtc is None else 'exp=%s:run=%s:dir=%s'%(exp, runs, dirxtc)
     #if usesmd: dsname += ':smd'
@@ -478,13 +838,17 @@ def pedestals_calibration(*args, **kwa):
 
     #=================
 
-    kwa = data_source_kwargs(**kwa)
-    ds = DataSource(**kwa)
+    ds = DataSource(**data_source_kwargs(**kwa))
     logger.debug('ds.runnum_list = %s' % str(ds.runnum_list))
     logger.debug('ds.detectors = %s' % str(ds.detectors))
     
     mode = None # gain_mode
     nstep_tot = -1
+    comms = getattr(ds, 'comms', None)
+    comm = None # bigdata ranks - MPI only, statistics of a step are merged over them when the step is done
+    if comms is not None:
+        from mpi4py import MPI
+        comm = comms.psana_comm.Split(0 if comms.node_type() == 'bd' else MPI.UNDEFINED, comms.psana_comm.Get_rank())
 
     #orun = next(ds.runs())
     for orun in ds.runs():
@@ -587,11 +951,10 @@ def pedestals_calibration(*args, **kwa):
             sys.exit()
             #return
 
-        sh = gmaps[0].shape
-        shape_block = [nrecs,] + list(sh) # [nrecs, <number-of-segments>, 352, 384]
-        logger.info('Accumulate raw frames in block shape = %s' % str(shape_block))
+        sh = gmaps[0].shape # (<number-of-segments>, 352, 384)
+        logger.info('Accumulate statistics of raw frames shape = %s in %d-bin window' % (str(sh), nbins))
 
-        block=np.zeros(shape_block,dtype=np.uint16)
+        stats = DarkStats(sh, nbins=nbins, int_lo=kwa.get('int_lo', 1), int_hi=kwa.get('int_hi', 16000))
         nrec,nevt = -1,0
 
         ss = None
@@ -624,94 +987,21 @@ def pedestals_calibration(*args, **kwa):
                 nrec += 1
                 ss = info_ndarr(raw & ue.M14, 'Ev:%04d rec:%04d raw & M14 ' % (nevt,nrec))
                 if do_print: logger.info(ss)
-                block[nrec]=(raw & ue.M14)
+                stats.add(raw & ue.M14)
 
         if nevt < events: logger.info('==== Ev:%04d end of events in run step %d' % (nevt,nstep_run))
 
         print_statistics(nevt, nrec)
 
-        #---- process statistics in block-array for panels
-
-        for idx, panel_id in zip(segment_inds,segment_ids):
-
-            if idx_sel is not None and idx_sel != idx: continue # skip panels with inices other than idx_sel if specified
-
-            logger.info('\n%s\nprocess panel:%02d id:%s' % (96*'=', idx, panel_id))
-
-            #if mode is None:
-            #    msg = 'Gain mode for dark processing is not defined "%s" try to set option -m <gain-mode>' % mode
-            #    logger.warning(msg)
-            #    sys.exit(msg)
-
-            dir_panel, dir_offset, dir_peds, dir_plots, dir_work, dir_gain, dir_rms, dir_status = dir_names(dirrepo, panel_id)
-
-            #print('XXXX panel_id, tstamp, exp, irun', panel_id, tstamp, exp, irun)
-
-            fname_prefix, panel_alias = file_name_prefix(dirrepo, panel_id, tstamp, exp, irun)
-            logger.debug('\n  fname_prefix:%s\n  panel_alias :%s' % (fname_prefix, panel_alias))
-
-            prefix_offset, prefix_peds, prefix_plots, prefix_gain, prefix_rms, prefix_status =\
-                path_prefixes(fname_prefix, dir_offset, dir_peds, dir_plots, dir_gain, dir_rms, dir_status)
-
-            #logger.debug('Directories under %s\n  SHOULD ALREADY EXIST after charge-injection offset_calibration' % dir_panel)
-            #assert os.path.exists(dir_offset), 'Directory "%s" DOES NOT EXIST' % dir_offset
-            #assert os.path.exists(dir_peds),   'Directory "%s" DOES NOT EXIST' % dir_peds        
- 
-            create_directory(dir_panel,  mode=dirmode)
-            create_directory(dir_peds,   mode=dirmode)
-            create_directory(dir_offset, mode=dirmode)
-            create_directory(dir_gain,   mode=dirmode)
-            create_directory(dir_rms,    mode=dirmode)
-            create_directory(dir_status, mode=dirmode)
-
-
-            #dark=block[:nrec,:].mean(0)  #Calculate mean
-
-            #block.sahpe = (1024, 16, 352, 384)
-            dark, rms, status = proc_dark_block(block[:nrec,idx,:], **kwa) # process pedestals per-panel (352, 384)
-
-
-            #continue # TEST
-            #==========
-
-            fname = '%s_pedestals_%s.dat' % (prefix_peds, mode)
-            save_2darray_in_textfile(dark, fname, filemode, fmt_peds)
-
-            fname = '%s_rms_%s.dat' % (prefix_rms, mode)
-            save_2darray_in_textfile(rms, fname, filemode, fmt_rms)
-
-            fname = '%s_status_%s.dat' % (prefix_status, mode)
-            save_2darray_in_textfile(status, fname, filemode, fmt_status)
-
-            #if this is an auto gain ranging mode, also calculate the corresponding _L pedestal:
-
-            if mode=='AHL-H': # evaluate AHL_L from AHL_H
-                ped_hl_h = dark #[3,:,:]
-
-                offset_hl_h = load_panel_constants(dir_offset, 'offset_AHL-H', tstamp)
-                offset_hl_l = load_panel_constants(dir_offset, 'offset_AHL-L', tstamp)
-                gain_hl_h   = load_panel_constants(dir_gain,   'gainci_AHL-H', tstamp)
-                gain_hl_l   = load_panel_constants(dir_gain,   'gainci_AHL-L', tstamp)
-
-                #if offset is not None:
-                if all([v is not None for v in (offset_hl_h, offset_hl_l, gain_hl_h, gain_hl_l)]):
-                    ped_hl_l = offset_hl_l - (offset_hl_h - ped_hl_h) * divide_protected(gain_hl_l, gain_hl_h) #V3 Gabriel's
-                    fname = '%s_pedestals_AHL-L.dat' % prefix_peds
-                    save_2darray_in_textfile(ped_hl_l, fname, filemode, fmt_peds)
-
-            elif mode=='AML-M': # evaluate AML_L from AML_M
-                ped_ml_m = dark #[4,:,:]
+        if comm is not None: # all bigdata ranks see every step, merge their statistics on one of them
+            stats = reduce_dark_stats(stats, comm)
+            if stats is None: continue
+        elif nrec < 0: continue
+        save_dark_panels(stats, mode, tstamp, segment_inds, segment_ids, **kwa) # histograms are released
+        del stats
 
-                offset_ml_m = load_panel_constants(dir_offset, 'offset_AML-M', tstamp)
-                offset_ml_l = load_panel_constants(dir_offset, 'offset_AML-L', tstamp)
-                gain_ml_m   = load_panel_constants(dir_gain,   'gainci_AML-M', tstamp)
-                gain_ml_l   = load_panel_constants(dir_gain,   'gainci_AML-L', tstamp)
+    if comm is not None and comm != MPI.COMM_NULL: comm.Free()
 
-                #if offset is not None:
-                if all([v is not None for v in (offset_ml_m, offset_ml_l, gain_ml_m, gain_ml_l)]):
-                    ped_ml_l = offset_ml_l - (offset_ml_m - ped_ml_m) * divide_protected(gain_ml_l, gain_ml_m) #V3 Gabriel's
-                    fname = '%s_pedestals_AML-L.dat' % prefix_peds
-                    save_2darray_in_textfile(ped_ml_l, fname, filemode, fmt_peds)
     #logger.info('==== Completed pedestal calibration for rank %d ==== ' % rank)
 
 
@@ -9,6 +9,7 @@ Usage::
   o = AreaDetector(*args, **kwa) # inherits from DetectorImpl(*args, **kwa)
 
   a = o.raw(evt)
+  a = o.raw_batch(events, out=None) # stacked raw data (N, <nsegs>, rows, cols) of N events
   a = o._segment_numbers(evt)
   a = o._det_calibconst()
   a = o._calibcons_and_meta_for_ctype(ctype='pedestals')
@@ -37,6 +38,7 @@ Usage::
   a = o.calib(evt, cmpars=(7,2,100,10),\
                             mbits=0o7, mask=None, edge_rows=10, edge_cols=10, center_rows=5, center_cols=5)
   a = o.calib(evt, **kwa)
+  a = o.calib_batch(events, out=None, **kwa) # stacked calib(evt, **kwa) of N events
   a = o.image(self, evt, nda=None, **kwa)
 
 2020-11-06 created by Mikhail Dubrovin
@@ -52,8 +54,7 @@ import numpy as np
 from psana.pscalib.geometry.GeometryAccess import GeometryAccess #, img_from_pixel_arrays
 from psana.pyalgos.generic.NDArrUtils import info_ndarr, reshape_to_3d # print_ndarr,shape_as_2d, shape_as_3d, reshape_to_2d
 from psana.detector.UtilsAreaDetector import dict_from_arr3d, arr3d_from_dict,\
-        img_from_pixel_arrays, statistics_of_pixel_arrays, img_multipixel_max, img_multipixel_mean,\
-        img_interpolated, init_interpolation_parameters, statistics_of_holes, fill_holes
+        img_interpolated, init_interpolation_parameters, ImageMapping
 from psana.detector.UtilsMask import CC, DTYPE_MASK, DTYPE_STATUS, mask_edges, merge_masks
 
 from amitypes import Array2d, Array3d
@@ -70,6 +71,7 @@ class AreaDetector(DetectorImpl):
         self._pix_rc_ = None, None
         self._pix_xyz_ = None, None, None
         self._interpol_pars_ = None
+        self._img_map_ = None
         self._pedestals_ = None
         self._gain_ = None
         self._rms_ = None
@@ -102,6 +104,33 @@ class AreaDetector(DetectorImpl):
         return arr3d_from_dict({k:v.raw for k,v in segs.items()})
 
 
+    def raw_batch(self, events, out=None):
+        """
+        Returns raw data of events stacked along new first axis.
+
+        Parameters
+        ----------
+        events: list of events
+            psana event objects, ex. [evt for _,evt in zip(range(N), run.events())].
+
+        out: np.array, optional, default: None
+            array of shape (N,) + raw shape re-used for returned data.
+
+        Returns
+        -------
+        raw data: np.array, shape: (N,) + raw shape or None if raw data is missing in any event
+        """
+        raws = []
+        for i,evt in enumerate(events):
+            raw = self.raw(evt)
+            if raw is None:
+                logger.debug('%s.raw(evt) is None for event %d in batch' % (self.__class__.__name__, i))
+                return None
+            raws.append(raw)
+        if not raws: return None
+        return np.stack(raws, out=out)
+
+
     def _segment_numbers(self,evt):
         """ Returns dense 1-d numpy array of segment indexes.
         from dict self._segments(evt)    
@@ -223,20 +252,12 @@ class AreaDetector(DetectorImpl):
         logger.info(s)
 
         mapmode = kwa.get('mapmode',2)
-        if mapmode <4:
-          self.img_entries, self.dmulti_pix_to_img_idx, self.dmulti_imgidx_numentries=\
-            statistics_of_pixel_arrays(rows, cols)
-
         if mapmode==4:
             rsp = self._pixel_coords(**kwa)
             if rsp is None: return None
             x,y,z = self._pix_xyz_ = [reshape_to_3d(a)[segs,:,:] for a in rsp]
             self._interpol_pars_ = init_interpolation_parameters(rows, cols, x, y)
 
-        if mapmode <4 and kwa.get('fillholes',True):
-            self.img_pix_ascend_ind, self.img_holes, self.hole_rows, self.hole_cols, self.hole_inds1d =\
-               statistics_of_holes(rows, cols, **kwa)
-
         # TBD parameters for image interpolation
         if False:
             t0_sec = time()
@@ -269,6 +290,36 @@ class AreaDetector(DetectorImpl):
         return raw - peds
 
 
+    def calib_batch(self, events, out=None, **kwa):
+        """
+        Returns calibrated data of events stacked along new first axis, the same as calib(evt, **kwa) for each event.
+        Corrections are applied to all events at once.
+
+        Parameters
+        ----------
+        events: list of events
+            psana event objects.
+
+        out: np.array, optional, default: None
+            array of shape (N,) + calib shape re-used for returned data.
+
+        Returns
+        -------
+        calibrated data: np.array, shape: (N,) + calib shape or None
+        """
+        logger.debug('%s.calib_batch' % self.__class__.__name__)
+        raws = self.raw_batch(events)
+        if raws is None:
+            logger.debug('det.raw.raw_batch(events) is None')
+            return None
+
+        peds = self._pedestals()
+        if peds is None:
+            logger.debug('det.raw._pedestals() is None - return det.raw.raw_batch(events)')
+            return raws
+        return np.subtract(raws, peds, out=out)
+
+
     def image(self, evt, nda=None, **kwa) -> Array2d:
         """
         Create 2-d image.
@@ -289,6 +340,9 @@ class AreaDetector(DetectorImpl):
         vbase: float, optional, default: 0
             value substituted for all image map bins without entry from data.  
 
+        out: np.array, optional, default: None
+            float32 image-shaped array re-used for image (mapmode 1/2/3).
+
         Returns
         -------
         image: np.array, ndim=2
@@ -303,6 +357,10 @@ class AreaDetector(DetectorImpl):
         mapmode   = kwa.get('mapmode',2)
         fillholes = kwa.get('fillholes',True)
 
+        if mapmode<4 and self._img_map_ is None:
+            self._img_map_ = ImageMapping(*self._pix_rc_)
+            self.img_entries = self._img_map_.img_entries
+
         if mapmode==0: return self.img_entries
 
         data = self.calib(evt) if nda is None else nda
@@ -312,15 +370,10 @@ class AreaDetector(DetectorImpl):
             
         #logger.debug(info_ndarr(data, 'data ', last=3))
 
-        rows, cols = self._pix_rc_
-        img = img_from_pixel_arrays(rows, cols, weight=data, vbase=vbase) # mapmode==1
-        if   mapmode==2: img_multipixel_max(img, data, self.dmulti_pix_to_img_idx)
-        elif mapmode==3: img_multipixel_mean(img, data, self.dmulti_pix_to_img_idx, self.dmulti_imgidx_numentries)
-
-        if mapmode<4 and fillholes: fill_holes(img, self.hole_rows, self.hole_cols)
+        if mapmode<4:
+            return self._img_map_.image(data, mapmode=mapmode, fillholes=fillholes, vbase=vbase, out=kwa.get('out',None))
 
-        return img if mapmode<4 else\
-               img_interpolated(data, self._interpol_pars_) if mapmode==4 else\
+        return img_interpolated(data, self._interpol_pars_) if mapmode==4 else\
                self.img_entries
 
 
@@ -0,0 +1,184 @@
+""" Compiled median common mode kernels (backend of UtilsCommonMode).
+
+Kernels work in place on 3-d (<segments>, rows, cols) float32/float64
+arrays with an optional uint8 mask of the same shape (0/1 - bad/good).
+Medians are found by partial selection of good pixels copied to a
+per-thread buffer. Units of work (rows in banks, columns or banks of all
+segments) run without the GIL in num_threads threads (default 1).
+
+Results are bit-identical to the numpy path of UtilsCommonMode:
+- median of an even no. of values is (low + high)/2 in the array dtype,
+- any NaN among good pixels gives NaN median,
+- rows/cols corrections are compared with cormax in the array dtype,
+  2-d (bank) corrections as double (as math.fabs does).
+"""
+from libc.stdlib cimport malloc, free
+from libc.math cimport fabs, NAN
+from libc.stdint cimport uint8_t
+cimport cython
+from cython cimport floating
+from cython.parallel import prange, parallel, threadid
+
+import numpy as np
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline floating _select(floating* a, Py_ssize_t n, Py_ssize_t k) noexcept nogil:
+    """ Returns k-th smallest of a[0:n] (Wirth). Leaves a[0:k] <= a[k]. """
+    cdef Py_ssize_t l = 0, m = n - 1, i, j
+    cdef floating x, t
+    while l < m:
+        x = a[k]
+        i = l
+        j = m
+        while True:
+            while a[i] < x: i += 1
+            while x < a[j]: j -= 1
+            if i <= j:
+                t = a[i]; a[i] = a[j]; a[j] = t
+                i += 1
+                j -= 1
+            if i > j: break
+        if j < k: l = i
+        if k < i: m = j
+    return a[k]
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline floating _median(floating* a, Py_ssize_t n, Py_ssize_t nnan) noexcept nogil:
+    """ Returns median of a[0:n] (n > 0, w/o NaNs) the same way as np.median. """
+    cdef Py_ssize_t h = n // 2, i
+    cdef floating high, low
+    if nnan > 0: return NAN
+    high = _select(a, n, h)
+    if n % 2:
+        low = high
+    else:
+        low = a[0]
+        for i in range(1, h):
+            if a[i] > low: low = a[i]
+    return (low + high) / 2
+
+cdef inline floating _limit(floating cm, bint has_cormax, floating cormax) noexcept nogil:
+    """ Returns cm if |cm| < cormax (NaN fails) or no cormax, else 0. """
+    if has_cormax and not (fabs(cm) < cormax): return 0
+    return cm
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def rows(floating[:, :, :] arr, const uint8_t[:, :, :] mask=None, cormax=None, long npix_min=10, int nbanks=1, int num_threads=1):
+    """ Median common mode correction for rows of each of nbanks hsplit banks of each segment. """
+    cdef Py_ssize_t nsegs = arr.shape[0], nrows = arr.shape[1], ncols = arr.shape[2]
+    cdef Py_ssize_t bw = ncols // nbanks, u, s, r, c, c0, n, nnan
+    cdef bint has_mask = mask is not None, has_cormax = cormax is not None
+    cdef floating _cormax = cormax if has_cormax else 0
+    cdef floating cm, v
+    cdef floating* bufs
+    cdef floating* buf
+    cdef int nt = max(num_threads, 1)
+    if bw * nbanks != ncols: raise ValueError('no. of columns %d is not divisible by nbanks %d' % (ncols, nbanks))
+    if has_mask and (mask.shape[0] != nsegs or mask.shape[1] != nrows or mask.shape[2] != ncols): raise ValueError('mask shape differs from data shape')
+    if nsegs * nrows * nbanks == 0 or bw == 0: return
+    bufs = <floating*> malloc(nt * bw * sizeof(floating))
+    if bufs == NULL: raise MemoryError()
+    with nogil, parallel(num_threads=nt):
+        buf = bufs + threadid() * bw
+        for u in prange(nsegs * nrows * nbanks, schedule='static'):
+            s = u // (nrows * nbanks)
+            r = (u // nbanks) % nrows
+            c0 = (u % nbanks) * bw
+            n = 0
+            nnan = 0
+            for c in range(c0, c0 + bw):
+                if has_mask and mask[s, r, c] == 0: continue
+                v = arr[s, r, c]
+                if v != v: nnan = nnan + 1
+                else:
+                    buf[n] = v
+                    n = n + 1
+            if has_mask and n + nnan <= npix_min: continue
+            if n + nnan == 0: continue
+            cm = _limit(_median(buf, n, nnan), has_cormax, _cormax)
+            for c in range(c0, c0 + bw):
+                if has_mask and mask[s, r, c] == 0: continue
+                arr[s, r, c] -= cm
+    free(bufs)
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def cols(floating[:, :, :] arr, const uint8_t[:, :, :] mask=None, cormax=None, long npix_min=10, int num_threads=1):
+    """ Median common mode correction for columns of each segment. """
+    cdef Py_ssize_t nsegs = arr.shape[0], nrows = arr.shape[1], ncols = arr.shape[2]
+    cdef Py_ssize_t u, s, r, c, n, nnan
+    cdef bint has_mask = mask is not None, has_cormax = cormax is not None
+    cdef floating _cormax = cormax if has_cormax else 0
+    cdef floating cm, v
+    cdef floating* bufs
+    cdef floating* buf
+    cdef int nt = max(num_threads, 1)
+    if has_mask and (mask.shape[0] != nsegs or mask.shape[1] != nrows or mask.shape[2] != ncols): raise ValueError('mask shape differs from data shape')
+    if nsegs * nrows * ncols == 0: return
+    bufs = <floating*> malloc(nt * nrows * sizeof(floating))
+    if bufs == NULL: raise MemoryError()
+    with nogil, parallel(num_threads=nt):
+        buf = bufs + threadid() * nrows
+        for u in prange(nsegs * ncols, schedule='static'):
+            s = u // ncols
+            c = u % ncols
+            n = 0
+            nnan = 0
+            for r in range(nrows):
+                if has_mask and mask[s, r, c] == 0: continue
+                v = arr[s, r, c]
+                if v != v: nnan = nnan + 1
+                else:
+                    buf[n] = v
+                    n = n + 1
+            if has_mask and n + nnan <= npix_min: continue
+            if n + nnan == 0: continue
+            cm = _limit(_median(buf, n, nnan), has_cormax, _cormax)
+            for r in range(nrows):
+                if has_mask and mask[s, r, c] == 0: continue
+                arr[s, r, c] -= cm
+    free(bufs)
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def banks2d(floating[:, :, :] arr, const uint8_t[:, :, :] mask=None, cormax=None, long npix_min=10, int nbanks=1, int num_threads=1):
+    """ Median common mode correction for all (good) pixels of each of nbanks hsplit banks of each segment. """
+    cdef Py_ssize_t nsegs = arr.shape[0], nrows = arr.shape[1], ncols = arr.shape[2]
+    cdef Py_ssize_t bw = ncols // nbanks, u, s, r, c, c0, n, nnan
+    cdef bint has_mask = mask is not None, has_cormax = cormax is not None
+    cdef double _cormax = cormax if has_cormax else 0
+    cdef floating cm, v
+    cdef floating* bufs
+    cdef floating* buf
+    cdef int nt = max(num_threads, 1)
+    if bw * nbanks != ncols: raise ValueError('no. of columns %d is not divisible by nbanks %d' % (ncols, nbanks))
+    if has_mask and (mask.shape[0] != nsegs or mask.shape[1] != nrows or mask.shape[2] != ncols): raise ValueError('mask shape differs from data shape')
+    if nsegs * nrows * nbanks == 0 or bw == 0: return
+    bufs = <floating*> malloc(nt * nrows * bw * sizeof(floating))
+    if bufs == NULL: raise MemoryError()
+    with nogil, parallel(num_threads=nt):
+        buf = bufs + threadid() * nrows * bw
+        for u in prange(nsegs * nbanks, schedule='dynamic'):
+            s = u // nbanks
+            c0 = (u % nbanks) * bw
+            n = 0
+            nnan = 0
+            for r in range(nrows):
+                for c in range(c0, c0 + bw):
+                    if has_mask and mask[s, r, c] == 0: continue
+                    v = arr[s, r, c]
+                    if v != v: nnan = nnan + 1
+                    else:
+                        buf[n] = v
+                        n = n + 1
+            if (has_mask and n + nnan < npix_min) or n + nnan == 0: continue
+            cm = _median(buf, n, nnan)
+            if has_cormax and not (fabs(cm) < _cormax): continue
+            for r in range(nrows):
+                for c in range(c0, c0 + bw):
+                    if has_mask and mask[s, r, c] == 0: continue
+                    arr[s, r, c] -= cm
+    free(bufs)
@@ -8,6 +8,7 @@ Usage::
 
   o = epix10ka_base(*args, **kwargs) # inherits from AreaDetector
   a = o.calib(evt)
+  a = o.calib_batch(events, out=None, **kwa) # stacked calib(evt, **kwa) of N events
   m = o._mask_from_status(grinds=(0,1,2,3,4), **kwa)
   m = o._mask_edges(self, edge_rows=1, edge_cols=1, center_rows=0, center_cols=0, dtype=DTYPE_MASK, **kwa)
 
@@ -43,6 +44,17 @@ class epix10ka_base(AreaDetector):
         return calib_epix10ka_any(self, evt, **kwa)
 
 
+    def calib_batch(self, events, out=None, **kwa):
+        """
+        Create calibrated data arrays of events stacked along new first axis.
+        """
+        logger.debug('epix10ka_base.calib_batch')
+        raws = self.raw_batch(events)
+        if raws is None: return None
+        kwa['nda_raw'] = raws
+        return calib_epix10ka_any(self, None, out=out, **kwa)
+
+
     def _gain_range_index(self, evt, **kwa):
         """
         Returns array (shaped as raw) per pixel gain range index or None.
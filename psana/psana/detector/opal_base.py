@@ -9,6 +9,7 @@ Usage::
   o = opal_base(*args, **kwa) # inherits from AreaDetector
   a = o.raw(evt)
   a = o.calib(evt, dtype=np.float32, **kwa)
+  a = o.calib_batch(events, dtype=np.float32, **kwa)
   img = o.image(self, evt, **kwa)
 
 2021-02-09 created by Mikhail Dubrovin
@@ -21,7 +22,7 @@ logger = logging.getLogger(__name__)
 
 from psana.detector.areadetector import AreaDetector, np # DTYPE_MASK, DTYPE_STATUS
 from psana.detector.UtilsAreaDetector import arr3d_from_dict #, dict_from_arr3d,...
-from psana.pyalgos.generic.NDArrUtils import reshape_to_2d, divide_protected, info_ndarr
+from psana.pyalgos.generic.NDArrUtils import reshape_to_2d, info_ndarr
 #----
 
 class opal_base(AreaDetector):
@@ -44,27 +45,49 @@ class opal_base(AreaDetector):
         Returns calibrated data array.
         """
         logger.debug('opal_base.calib')
-
-        dtype = kwa.get('dtype', np.float32)
         raw = self.raw(evt)
         if raw is None:
             logger.debug('det.raw.raw(evt) is None')
             return None
+        return self._calib_raw(raw, dtype=kwa.get('dtype', np.float32))
+
 
-        arr = raw.astype(dtype, copy=True)
+    def calib_batch(self, events, out=None, **kwa):
+        """
+        Returns calibrated data of events stacked along new first axis.
+        Corrections are applied in place in out (of shape (N,) + calib shape) if provided.
+        """
+        logger.debug('opal_base.calib_batch')
+        raws = self.raw_batch(events)
+        if raws is None:
+            logger.debug('det.raw.raw_batch(events) is None')
+            return None
+        return self._calib_raw(raws, out=out, dtype=kwa.get('dtype', np.float32))
+
+
+    def _calib_raw(self, raw, out=None, dtype=np.float32):
+        """
+        Returns (raw - pedestals)/gain (0 for zero gain) in out (new array of dtype if None),
+        raw is data of one event or of events stacked along the first axis.
+        """
+        if out is None: out = np.empty(raw.shape, dtype=dtype)
+        out[...] = raw
 
         peds = self._pedestals()
         if peds is None:
             logger.debug('det.raw._pedestals() is None - return raw')
-            return arr
+            return out
 
-        arr -= peds
+        out -= peds
         gain = self._gain()
         if gain is None:
             logger.debug('det.raw._gain() is None - return raw-peds')
-            return arr
+            return out
 
-        return divide_protected(arr, gain)
+        # the same as divide_protected(out, gain) without temporary arrays of data size
+        np.divide(out, gain, out=out, where=gain!=0)
+        out[..., gain==0] = 0
+        return out
 
 
     def image(self, evt, nda=None, **kwa) -> Array2d:
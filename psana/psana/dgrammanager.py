@@ -1,5 +1,6 @@
 import sys, os
 import time
+import mmap
 import getopt
 import pprint
 
@@ -43,9 +44,11 @@ class DgramManager(object):
 
     def __init__(self, xtc_files, configs=[], fds=[], 
             tag=None, run=None, max_retries=0,
-            found_xtc2_callback=None):
+            found_xtc2_callback=None, use_mmap=False):
         """ Opens xtc_files and stores configs.
         If file descriptors (fds) is given, reuse the given file descriptors.
+        With use_mmap, xtc files are also memory-mapped (copy-on-write) so that
+        dgrams can be created directly on the mapped pages (see mmaps).
         """
         self.xtc_files = []
         self.shmem_cli = None
@@ -105,6 +108,38 @@ class DgramManager(object):
         self.calibconst = {} # initialize to empty dict - will be populated by run class
         self.n_files = len(self.xtc_files)
 
+        # Memory maps are only dropped (not closed) when replaced because 
+        # dgrams created on them may still be in use.
+        self.mmaps = [self.map_file(fd) for fd in self.fds] if use_mmap else []
+
+    def open_chunk(self, i_smd, chunk_id):
+        """ Switches bigdata file of stream i_smd to chunk file -cNN.
+        Does nothing if the file is already open."""
+        xtc_dir = os.path.dirname(self.xtc_files[i_smd])
+        filename = os.path.basename(self.xtc_files[i_smd])
+        found = filename.find('-c')
+        if found == -1: 
+            return # not a chunked file
+        new_filename = filename.replace(filename[found:found+4], '-c'+str(chunk_id).zfill(2))
+        new_xtc_file = os.path.join(xtc_dir, new_filename)
+        if new_xtc_file == self.xtc_files[i_smd]:
+            return # still in the same chunk
+        os.close(self.fds[i_smd])
+        fd = os.open(new_xtc_file, os.O_RDONLY)
+        self.fds[i_smd] = fd
+        self.xtc_files[i_smd] = new_xtc_file
+        if self.mmaps:
+            self.mmaps[i_smd] = self.map_file(fd)
+
+    @staticmethod
+    def map_file(fd):
+        """ Returns copy-on-write memory map of the whole file (None if empty).
+        Pages are private to the process so arrays created on them stay
+        writeable, the file is never modified. """
+        if os.fstat(fd).st_size == 0:
+            return None
+        return mmap.mmap(fd, 0, access=mmap.ACCESS_COPY)
+
     def close(self):
         if not self.given_fds:
             for fd in self.fds:
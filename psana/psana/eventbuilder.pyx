@@ -8,9 +8,13 @@ from cpython.buffer cimport PyObject_GetBuffer, PyBuffer_Release, PyBUF_ANY_CONT
 from dgramlite cimport Xtc, Sequence, Dgram
 
 from libc.stdint cimport uint32_t, uint64_t
+from libc.stdlib cimport malloc, free
+from libc.string cimport memcpy
+cimport cython
 
 from psana.event import Event
-import time
+import numpy as np
+import time, os
 
 cdef class EventBuilder:
     """Builds a batch of events
@@ -26,7 +30,16 @@ cdef class EventBuilder:
     Without destination call back the build fn returns a batch of events (size = batch_size) at index 0. With destination call back, this fn returns list of batches. Each batch has the same destination rank.
     
     Note that reading chunks inside a views or events inside a batch can be done
-    using PacketFooter class."""
+    using PacketFooter class.
+    
+    By default, build runs in single-pass mode: matching dgrams are only recorded
+    as (stream, offset, size) in index arrays and each destination batch is
+    filled with one scatter-copy at the end. Set PS_EB_SINGLE_PASS=0 to use
+    the per-event bytearray copy instead.
+    
+    Selections set with set_selection (timestamps, ts_range and stride) are
+    applied to L1Accepts by comparing timestamps of the dgram headers. No
+    Event is created for rejected events."""
     cdef short nsmds
     cdef array.array offsets 
     cdef array.array sizes
@@ -44,6 +57,18 @@ cdef class EventBuilder:
     cdef unsigned long min_ts
     cdef unsigned long max_ts
     cdef unsigned L1Accept 
+    cdef int single_pass
+    cdef Py_ssize_t max_events              # capacity of the index arrays below
+    cdef uint64_t[:, ::1] evt_offsets       # (event, stream) offset of dgram in its view
+    cdef uint32_t[:, ::1] evt_dgram_sizes   # (event, stream) dgram size (0 if missing)
+    cdef int[::1] evt_dests                 # destination rank of each accepted event
+    cdef unsigned[::1] evt_services         # service of each accepted event
+    cdef int has_selection
+    cdef uint64_t[::1] sel_timestamps       # sorted timestamps to keep (empty: all)
+    cdef uint64_t sel_ts_first              # inclusive range of timestamps to keep
+    cdef uint64_t sel_ts_last               # 
+    cdef uint64_t sel_stride                # keep every sel_stride-th of the L1Accepts above
+    cdef uint64_t n_l1_seen                 # no. of L1Accepts that passed timestamps and ts_range
 
     def __init__(self, views, configs):
         self.nsmds              = len(views)
@@ -61,6 +86,54 @@ cdef class EventBuilder:
         self.DGRAM_SIZE         = sizeof(Dgram)
         self.XTC_SIZE           = sizeof(Xtc)
         self.L1Accept           = 12
+        self.single_pass        = int(os.environ.get('PS_EB_SINGLE_PASS', '1'))
+        self.max_events         = 0
+        self.set_selection()
+        
+    def set_selection(self, timestamps=None, ts_range=None, stride=0, n_l1_seen=0):
+        """ Sets L1Accepts to keep.
+
+        timestamps: list of timestamps
+        ts_range:   (first, last) inclusive range of timestamps
+        stride:     keeps every stride-th L1Accept (after the above selections)
+        n_l1_seen:  no. of L1Accepts of the run before this build (to continue
+                    the count of a previous EventBuilder, with several
+                    EventBuilder nodes it is sent by smd0 with each chunk)
+        
+        Transitions are always kept.
+        """
+        if timestamps is not None:
+            self.sel_timestamps = np.unique(np.asarray(timestamps, dtype=np.uint64))
+        else:
+            self.sel_timestamps = np.zeros(0, dtype=np.uint64)
+        self.sel_ts_first = 0
+        self.sel_ts_last = 0xffffffffffffffff
+        if ts_range is not None:
+            self.sel_ts_first, self.sel_ts_last = ts_range
+        self.sel_stride = stride if stride else 1
+        self.n_l1_seen = n_l1_seen
+        self.has_selection = timestamps is not None or ts_range is not None or self.sel_stride > 1
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef inline bint _selected(self, uint64_t ts) nogil:
+        """ Returns True if an L1Accept with timestamp ts passes the selection."""
+        cdef Py_ssize_t lo = 0
+        cdef Py_ssize_t hi = self.sel_timestamps.shape[0]
+        cdef Py_ssize_t mid
+        if ts < self.sel_ts_first or ts > self.sel_ts_last:
+            return False
+        if hi > 0:
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if self.sel_timestamps[mid] < ts:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            if lo == self.sel_timestamps.shape[0] or self.sel_timestamps[lo] != ts:
+                return False
+        self.n_l1_seen += 1
+        return (self.n_l1_seen - 1) % self.sel_stride == 0
         
     def _has_more(self):
         for i in range(self.nsmds):
@@ -82,6 +155,13 @@ cdef class EventBuilder:
         filter_fn: takes an event and return True/False
         destination: takes an event and returns rank no.
         """
+        if self.single_pass:
+            return self._build_single_pass(batch_size, filter_fn, destination, limit_ts, prometheus_counter, run)
+        return self._build_copy(batch_size, filter_fn, destination, limit_ts, prometheus_counter, run)
+
+    def _build_copy(self, batch_size, filter_fn, destination, limit_ts, prometheus_counter, run):
+        """ Builds batches by copying each event into its own bytearray
+        then appending it to the batch of its destination."""
         cdef unsigned got = 0
         cdef unsigned got_step = 0
         batch_dict = {} # keeps list of batches (w/o destination callback, only one batch is returned at index 0)
@@ -194,6 +274,13 @@ cdef class EventBuilder:
                     event_dgrams[view_idx] = <char[:self.DGRAM_SIZE+payload]>view_ptr
                 PyBuffer_Release(&buf)
             
+            # Skip unselected events before any copying
+            if self.has_selection and service == self.L1Accept:
+                if not self._selected(self.event_timestamps[smd_id]):
+                    if limit_ts > -1 and self.max_ts >= limit_ts:
+                        break
+                    continue
+
             # Generate event as bytes from the dgrams
             evt_size = 0
             evt_bytes = bytearray()
@@ -289,6 +376,224 @@ cdef class EventBuilder:
         
         return batch_dict, step_dict
 
+    def _reserve(self, Py_ssize_t n_events):
+        """ Grows the per-event index arrays to hold at least n_events."""
+        if n_events <= self.max_events:
+            return
+        self.evt_offsets        = np.zeros((n_events, self.nsmds), dtype=np.uint64)
+        self.evt_dgram_sizes    = np.zeros((n_events, self.nsmds), dtype=np.uint32)
+        self.evt_dests          = np.zeros(n_events, dtype=np.int32)
+        self.evt_services       = np.zeros(n_events, dtype=np.uint32)
+        self.max_events         = n_events
+
+    cdef object _event_bytes(self, unsigned evt_idx, char** view_ptrs):
+        """ Returns one recorded event as bytearray (dgrams + event footer).
+        Only needed when filter or destination callback wants an Event."""
+        cdef unsigned evt_size = 0
+        cdef short i
+        for i in range(self.nsmds):
+            evt_size += self.evt_dgram_sizes[evt_idx, i]
+        evt_bytes = bytearray(evt_size + sizeof(unsigned) * (self.nsmds + 1))
+        cdef unsigned char[::1] out = evt_bytes
+        cdef unsigned* footer = <unsigned *>(&out[evt_size])
+        cdef size_t offset = 0
+        for i in range(self.nsmds):
+            if self.evt_dgram_sizes[evt_idx, i] > 0:
+                memcpy(&out[offset], view_ptrs[i] + self.evt_offsets[evt_idx, i], self.evt_dgram_sizes[evt_idx, i])
+                offset += self.evt_dgram_sizes[evt_idx, i]
+            footer[i] = self.evt_dgram_sizes[evt_idx, i]
+        footer[self.nsmds] = self.nsmds
+        return evt_bytes
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef object _scatter(self, int dest_rank, unsigned n_events, int only_steps, char** view_ptrs):
+        """ Copies all recorded events for dest_rank into one bytearray.
+        
+        The output has the same layout as described in build(). Returns
+        (batch, evt_sizes) with an empty batch when no events were selected."""
+        cdef unsigned evt_idx, n_selected=0
+        cdef short i
+        cdef size_t total_size = 0
+        cdef unsigned evt_size = 0
+        cdef unsigned evt_footer_size = sizeof(unsigned) * (self.nsmds + 1)
+        evt_sizes = []
+        
+        # First pass sums up event sizes so that the batch is allocated once.
+        for evt_idx in range(n_events):
+            if self.evt_dests[evt_idx] != dest_rank: continue
+            if only_steps and self.evt_services[evt_idx] == self.L1Accept: continue
+            evt_size = evt_footer_size
+            for i in range(self.nsmds):
+                evt_size += self.evt_dgram_sizes[evt_idx, i]
+            evt_sizes.append(evt_size)
+            total_size += evt_size
+            n_selected += 1
+        
+        if n_selected == 0:
+            return bytearray(), evt_sizes
+        
+        total_size += sizeof(unsigned) * (n_selected + 1)
+        batch = bytearray(total_size)
+        cdef unsigned char[::1] out = batch
+        cdef char* out_ptr = <char *>&out[0]
+        cdef unsigned* batch_footer = <unsigned *>(out_ptr + total_size - sizeof(unsigned) * (n_selected + 1))
+        cdef unsigned* evt_footer
+        cdef size_t offset = 0
+        cdef unsigned cn_selected = 0
+        cdef int c_dest_rank = dest_rank
+        cdef unsigned L1Accept = self.L1Accept
+        cdef short nsmds = self.nsmds
+        cdef uint64_t[:, ::1] evt_offsets = self.evt_offsets
+        cdef uint32_t[:, ::1] evt_dgram_sizes = self.evt_dgram_sizes
+        cdef int[::1] evt_dests = self.evt_dests
+        cdef unsigned[::1] evt_services = self.evt_services
+
+        with nogil:
+            for evt_idx in range(n_events):
+                if evt_dests[evt_idx] != c_dest_rank: continue
+                if only_steps and evt_services[evt_idx] == L1Accept: continue
+                evt_size = 0
+                for i in range(nsmds):
+                    if evt_dgram_sizes[evt_idx, i] > 0:
+                        memcpy(out_ptr + offset, view_ptrs[i] + evt_offsets[evt_idx, i], evt_dgram_sizes[evt_idx, i])
+                        offset += evt_dgram_sizes[evt_idx, i]
+                        evt_size += evt_dgram_sizes[evt_idx, i]
+                evt_footer = <unsigned *>(out_ptr + offset)
+                for i in range(nsmds):
+                    evt_footer[i] = evt_dgram_sizes[evt_idx, i]
+                evt_footer[nsmds] = nsmds
+                offset += evt_footer_size
+                batch_footer[cn_selected] = evt_size + evt_footer_size
+                cn_selected += 1
+            batch_footer[cn_selected] = cn_selected
+        
+        return batch, evt_sizes
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def _build_single_pass(self, batch_size, filter_fn, destination, limit_ts, prometheus_counter, run):
+        """ Builds batches in one pass over the views.
+        
+        Each event is only recorded as offsets and sizes of its dgrams in
+        the index arrays. Batches are filled by _scatter when all events
+        have been identified."""
+        cdef unsigned got = 0
+        cdef unsigned got_step = 0
+        self.min_ts = 0
+        self.max_ts = 0
+        self._reserve(batch_size)
+        
+        cdef short nsmds = self.nsmds
+        cdef Py_buffer* bufs = <Py_buffer *>malloc(sizeof(Py_buffer) * nsmds)
+        cdef char** view_ptrs = <char **>malloc(sizeof(char *) * nsmds)
+        cdef uint64_t* cur_timestamps = <uint64_t *>malloc(sizeof(uint64_t) * nsmds)
+        cdef unsigned* cur_sizes = <unsigned *>malloc(sizeof(unsigned) * nsmds)
+        cdef unsigned[:] offsets = self.offsets
+        cdef unsigned[:] sizes = self.sizes
+        cdef uint64_t[:, ::1] evt_offsets = self.evt_offsets
+        cdef uint32_t[:, ::1] evt_dgram_sizes = self.evt_dgram_sizes
+        cdef int[::1] evt_dests = self.evt_dests
+        cdef unsigned[::1] evt_services = self.evt_services
+        
+        cdef short i
+        cdef int smd_id
+        cdef int has_more
+        cdef Dgram* d
+        cdef uint64_t min_ts = 0
+        cdef unsigned service = 0
+        cdef int accept = 1
+        cdef int dest_rank = 0
+        cdef unsigned reach_limit_ts = 0
+        dests = {} # insertion-ordered destinations seen so far 
+        
+        for i in range(nsmds):
+            PyObject_GetBuffer(self.views[i], &bufs[i], PyBUF_SIMPLE | PyBUF_ANY_CONTIGUOUS)
+            view_ptrs[i] = <char *>bufs[i].buf
+        
+        try:
+            while got < batch_size and not reach_limit_ts:
+                # Locate smd_id with the smallest timestamp
+                smd_id = -1
+                for i in range(nsmds):
+                    if offsets[i] < sizes[i]:
+                        d = <Dgram *>(view_ptrs[i] + offsets[i])
+                        cur_timestamps[i] = <uint64_t>d.seq.high << 32 | d.seq.low
+                        cur_sizes[i] = self.DGRAM_SIZE + d.xtc.extent - self.XTC_SIZE
+                        if smd_id == -1 or cur_timestamps[i] < min_ts:
+                            min_ts = cur_timestamps[i]
+                            smd_id = i
+                if smd_id == -1: break # no more data in any of the views
+                
+                d = <Dgram *>(view_ptrs[smd_id] + offsets[smd_id])
+                service = (d.env>>24)&0xf
+                
+                # Record all dgrams with matching timestamp as this event 
+                for i in range(nsmds):
+                    evt_dgram_sizes[got, i] = 0
+                    if offsets[i] < sizes[i] and cur_timestamps[i] == min_ts:
+                        evt_offsets[got, i] = offsets[i]
+                        evt_dgram_sizes[got, i] = cur_sizes[i]
+                        offsets[i] += cur_sizes[i]
+                evt_services[got] = service
+                
+                if self.min_ts == 0:
+                    self.min_ts = min_ts # records first timestamp
+                self.max_ts = min_ts
+                
+                # If destination() is not specifed, use batch 0.
+                dest_rank = 0
+                accept = 1
+                if self.has_selection and service == self.L1Accept:
+                    accept = self._selected(min_ts)
+                if accept and (filter_fn or destination) and service == self.L1Accept:
+                    py_evt = Event._from_bytes(self.configs, self._event_bytes(got, view_ptrs), run=run)
+                    py_evt._complete()
+
+                    if filter_fn:
+                        st_filter = time.time()
+                        accept = filter_fn(py_evt)
+                        en_filter = time.time()
+                        if prometheus_counter is not None:
+                            prometheus_counter.labels('seconds', 'None').inc(en_filter - st_filter)
+                            prometheus_counter.labels('batches', 'None').inc()
+                    
+                    if destination:
+                        dest_rank = destination(py_evt)
+                
+                if dest_rank not in dests:
+                    dests[dest_rank] = True
+                
+                # Rejected events are overwritten by the next event
+                if accept == 1:
+                    evt_dests[got] = dest_rank
+                    got += 1
+                    if service != self.L1Accept:
+                        got_step += 1
+
+                if limit_ts > -1:
+                    if self.max_ts >= limit_ts:
+                        reach_limit_ts = 1
+            
+            # end while got < batch_size...
+            
+            batch_dict = {}
+            step_dict = {}
+            for dest_rank in dests:
+                batch_dict[dest_rank] = self._scatter(dest_rank, got, 0, view_ptrs)
+                step_dict[dest_rank] = self._scatter(dest_rank, got, 1, view_ptrs)
+        finally:
+            for i in range(nsmds):
+                PyBuffer_Release(&bufs[i])
+            free(bufs)
+            free(view_ptrs)
+            free(cur_timestamps)
+            free(cur_sizes)
+        
+        self.nevents = got
+        self.nsteps = got_step
+        return batch_dict, step_dict
+
     @property
     def nevents(self):
         return self.nevents
@@ -297,6 +602,10 @@ cdef class EventBuilder:
     def nsteps(self):
         return self.nsteps
 
+    @property
+    def n_l1_seen(self):
+        return self.n_l1_seen
+
     @property
     def min_ts(self):
         return self.min_ts
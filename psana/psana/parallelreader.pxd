@@ -1,7 +1,7 @@
 ## cython: linetrace=True
 ## distutils: define_macros=CYTHON_TRACE_NOGIL=1
 
-from libc.stdlib cimport malloc, free
+from libc.stdlib cimport malloc, calloc, free
 from libc.string cimport memcpy
 from posix.unistd cimport read, sleep
 from libc.errno cimport errno
@@ -38,7 +38,24 @@ cdef class ParallelReader:
     cdef uint64_t   got                  # summing the size of new reads used by prometheus
     cdef uint64_t   chunk_overflown
     cdef int        num_threads
+    cdef int        prefetch_depth       # no. of chunksize blocks read ahead per file (0: no prefetch)
+    cdef char**     prefetch_blocks      # nfiles x prefetch_depth blocks filled by the prefetch thread
+    cdef uint64_t*  prefetch_nbytes      # no. of bytes read into each block
+    cdef int*       prefetch_head        # next block to be consumed (per file)
+    cdef uint64_t*  prefetch_head_offset # no. of bytes already consumed in the head block
+    cdef int*       prefetch_tail        # next block to be filled (per file)
+    cdef int*       prefetch_n_ready     # no. of filled blocks (per file)
+    cdef int*       prefetch_eof         # set when the last read returned no data
+    cdef object     prefetch_cond
+    cdef object     prefetch_thread
+    cdef object     prefetch_error       # exception raised in the prefetch thread
+    cdef double     prefetch_read_time   # time spent by the prefetch thread in read()
+    cdef double     prefetch_wait_time   # time just_read waited for the prefetch thread
+    cdef object     __weakref__
 
     cdef void _init_buffers(self)
     cdef void _reset_buffers(self, Buffer* bufs)
-    cdef void just_read(self)
+    cdef void _init_prefetch(self)
+    cdef void _parse_buffer(self, Py_ssize_t i, int64_t got) nogil
+    cdef int64_t _take_prefetched(self, Py_ssize_t i, char* dst, uint64_t size) except -1
+    cdef void just_read(self) except *
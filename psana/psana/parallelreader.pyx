@@ -3,12 +3,51 @@
 
 from parallelreader cimport Buffer
 from cython.parallel import prange
-import os
+import os, time, threading, weakref
 from dgramlite cimport Xtc, Sequence, Dgram
 cimport cython
 from psana.psexp import TransitionId
 
+
+def _prefetch_worker(reader_ref, cond, fds):
+    """ Keeps filling the prefetch blocks of a ParallelReader.
+
+    Only a weak reference to the reader is kept while idle so that the
+    thread exits (and closes its duplicated file descriptors) when the
+    reader goes away. An exception ends the thread and is handed to the 
+    reader, which re-raises it from just_read.
+    """
+    cdef ParallelReader reader
+    try:
+        while True:
+            reader = reader_ref()
+            if reader is None: break
+            if not reader._prefetch_next(fds):
+                with cond:
+                    if not reader._has_prefetch_work():
+                        cond.wait(0.5)
+            reader = None
+    except BaseException as e:
+        reader = reader_ref()
+        if reader is not None:
+            with cond:
+                reader.prefetch_error = e
+                cond.notify_all()
+    finally:
+        for fd in fds:
+            os.close(fd)
+
+
 cdef class ParallelReader:
+    """ Reads chunks of all smd files in parallel.
+
+    With PS_SMD_PREFETCH=N (N > 0), a background thread reads up to N
+    chunks ahead for each file into a second set of buffers while the
+    current chunks are viewed, repacked and sent. Like the direct reads,
+    the thread reads the files in parallel (PS_SMD0_NUM_THREADS). 
+    just_read then only copies prefetched data, waiting if the prefetch 
+    thread is behind, and raises the error if the thread failed.
+    """
     
     def __cinit__(self, int[:] file_descriptors, size_t chunksize):
         self.file_descriptors   = file_descriptors
@@ -24,6 +63,8 @@ cdef class ParallelReader:
         self.chunk_overflown    = 0     # set to dgram size if it's too big
         self._init_buffers()
         self.num_threads        = int(os.environ.get('PS_SMD0_NUM_THREADS', '16'))
+        self.prefetch_depth     = int(os.environ.get('PS_SMD_PREFETCH', '0'))
+        self._init_prefetch()
 
 
     def __dealloc__(self):
@@ -37,6 +78,17 @@ cdef class ParallelReader:
                 free(self.step_bufs[i].chunk)
             free(self.step_bufs)
 
+        if self.prefetch_blocks:
+            for i in range(self.nfiles * self.prefetch_depth):
+                free(self.prefetch_blocks[i])
+            free(self.prefetch_blocks)
+        free(self.prefetch_nbytes)
+        free(self.prefetch_head)
+        free(self.prefetch_head_offset)
+        free(self.prefetch_tail)
+        free(self.prefetch_n_ready)
+        free(self.prefetch_eof)
+
     cdef void _init_buffers(self):
         cdef Py_ssize_t i
         self._reset_buffers(self.bufs)
@@ -58,101 +110,276 @@ cdef class ParallelReader:
             buf.timestamp       = 0       
             buf.found_endrun    = 0
             buf.endrun_ts       = 0
+
+    cdef void _init_prefetch(self):
+        cdef Py_ssize_t i
+        self.prefetch_read_time = 0
+        self.prefetch_wait_time = 0
+        self.prefetch_cond      = None
+        self.prefetch_thread    = None
+        self.prefetch_error     = None
+        if self.prefetch_depth <= 0:
+            self.prefetch_depth = 0
+            return
+        self.prefetch_blocks        = <char **>malloc(sizeof(char *) * self.nfiles * self.prefetch_depth)
+        for i in range(self.nfiles * self.prefetch_depth):
+            self.prefetch_blocks[i] = <char *>malloc(self.chunksize)
+        self.prefetch_nbytes        = <uint64_t *>calloc(self.nfiles * self.prefetch_depth, sizeof(uint64_t))
+        self.prefetch_head          = <int *>calloc(self.nfiles, sizeof(int))
+        self.prefetch_head_offset   = <uint64_t *>calloc(self.nfiles, sizeof(uint64_t))
+        self.prefetch_tail          = <int *>calloc(self.nfiles, sizeof(int))
+        self.prefetch_n_ready       = <int *>calloc(self.nfiles, sizeof(int))
+        self.prefetch_eof           = <int *>calloc(self.nfiles, sizeof(int))
+        self.prefetch_cond          = threading.Condition()
+
+    def _start_prefetch(self):
+        """ Starts the prefetch thread on duplicated file descriptors.
+        The thread reads from its own descriptors (sharing file offsets with
+        the originals) so that closing the original ones cannot make it read
+        from an unrelated file that reuses the same descriptor number."""
+        fds = array.array('i', [os.dup(self.file_descriptors[i]) for i in range(self.nfiles)])
+        self.prefetch_thread = threading.Thread(name='SmdPrefetchThread',
+                target=_prefetch_worker, 
+                args=(weakref.ref(self), self.prefetch_cond, fds),
+                daemon=True)
+        self.prefetch_thread.start()
+
+    def _has_prefetch_work(self):
+        """ Returns True if any file has a free block and is not at eof.
+        Must be called with prefetch_cond acquired."""
+        cdef Py_ssize_t i
+        for i in range(self.nfiles):
+            if self.prefetch_eof[i] == 0 and self.prefetch_n_ready[i] < self.prefetch_depth:
+                return True
+        return False
+
+    @cython.boundscheck(False)
+    def _prefetch_next(self, int[:] fds):
+        """ Reads the next chunk of every file that has a free block, the 
+        files in parallel. Returns False if there is nothing to read.
+        Raises OSError if a read fails."""
+        cdef Py_ssize_t i
+        cdef int n_todo = 0
+        cdef int depth = self.prefetch_depth
+        cdef char** blocks = self.prefetch_blocks
+        cdef size_t chunksize = self.chunksize
+        cdef int* tails = <int *>malloc(sizeof(int) * self.nfiles)
+        cdef int64_t* gots = <int64_t *>malloc(sizeof(int64_t) * self.nfiles)
+        cdef int* errnos = <int *>malloc(sizeof(int) * self.nfiles)
+        try:
+            with self.prefetch_cond:
+                for i in range(self.nfiles):
+                    tails[i] = -1
+                    if self.prefetch_eof[i] == 1 or self.prefetch_n_ready[i] == depth: 
+                        continue
+                    tails[i] = self.prefetch_tail[i]
+                    n_todo += 1
+            if n_todo == 0:
+                return False
+
+            # Only this thread fills blocks so the tail blocks stay ours while reading
+            st = time.monotonic()
+            for i in prange(self.nfiles, nogil=True, num_threads=self.num_threads):
+                gots[i] = 0
+                errnos[i] = 0
+                if tails[i] == -1: continue
+                gots[i] = read(fds[i], blocks[i * depth + tails[i]], chunksize)
+                if gots[i] < 0:
+                    errnos[i] = errno
+            en = time.monotonic()
+
+            with self.prefetch_cond:
+                self.prefetch_read_time += en - st
+                for i in range(self.nfiles):
+                    if tails[i] == -1: continue
+                    if gots[i] < 0:
+                        raise OSError(errnos[i], f'smd prefetch: cannot read file #{i} ({os.strerror(errnos[i])})')
+                    elif gots[i] == 0:
+                        self.prefetch_eof[i] = 1
+                    else:
+                        self.prefetch_nbytes[i * depth + tails[i]] = gots[i]
+                        self.prefetch_tail[i] = (tails[i] + 1) % depth
+                        self.prefetch_n_ready[i] += 1
+                self.prefetch_cond.notify_all()
+        finally:
+            free(tails)
+            free(gots)
+            free(errnos)
+        return True
+
+    cdef int64_t _take_prefetched(self, Py_ssize_t i, char* dst, uint64_t size) except -1:
+        """ Copies size bytes of prefetched data for file i to dst.
+        Like read(), this only returns fewer bytes when the prefetch thread
+        has reached the end of the file. Blocks while waiting for data and 
+        raises the exception of the prefetch thread if it failed."""
+        cdef int64_t got = 0
+        cdef uint64_t avail, n_copy
+        cdef int k
+        cdef char* src
+        if self.prefetch_thread is None:
+            self._start_prefetch()
+
+        with self.prefetch_cond:
+            while <uint64_t>got < size:
+                if self.prefetch_n_ready[i] == 0:
+                    if self.prefetch_eof[i] == 1:
+                        # Let the prefetch thread try again next time (file 
+                        # may still grow in live mode).
+                        self.prefetch_eof[i] = 0
+                        break
+                    if self.prefetch_error is not None:
+                        raise self.prefetch_error
+                    if not self.prefetch_thread.is_alive():
+                        raise RuntimeError(f'smd prefetch thread exited before file #{i} was read')
+                    st = time.monotonic()
+                    self.prefetch_cond.wait(1.0)
+                    self.prefetch_wait_time += time.monotonic() - st
+                    continue
+
+                k = self.prefetch_head[i]
+                src = self.prefetch_blocks[i * self.prefetch_depth + k] + self.prefetch_head_offset[i]
+                avail = self.prefetch_nbytes[i * self.prefetch_depth + k] - self.prefetch_head_offset[i]
+                n_copy = min(avail, size - got)
+                with nogil:
+                    memcpy(dst + got, src, n_copy)
+                got += n_copy
+                self.prefetch_head_offset[i] += n_copy
+                if n_copy == avail: # done with this block - give it back
+                    self.prefetch_head_offset[i] = 0
+                    self.prefetch_head[i] = (k + 1) % self.prefetch_depth
+                    self.prefetch_n_ready[i] -= 1
+                    self.prefetch_cond.notify_all()
+        return got
+
+    @property
+    def prefetch_read_time(self):
+        return self.prefetch_read_time
+
+    @property
+    def prefetch_wait_time(self):
+        return self.prefetch_wait_time
     
     @cython.boundscheck(False)
-    cdef void just_read(self):
+    cdef void just_read(self) except *:
         """
         Reads only if the buffer has no more unseen events
 
         If there's some data left at the bottom of the buffer due to cutoff,
         copy this remaining data to the begining of the buffer then read to 
-        nef.num_threads         = os.e
         fill the rest of the chunk. Sets the following variables when done:
         - got = remaining (from copying) + new got (from reading)
         - ready_offset = offset of the last event that fits in the buffer
         - n_ready_events = no. of total events that fit in the buffer
 
+        With prefetching, new data are copied from the prefetch blocks instead 
+        of being read from disk.
         """
         cdef Py_ssize_t i       = 0
-        cdef int64_t got       = 0
-        cdef int64_t gots[1000]
-        cdef uint64_t offset    = 0
-        cdef Dgram* d
+        cdef int64_t* gots      = <int64_t *>malloc(sizeof(int64_t) * self.nfiles)
         cdef Buffer* buf
-        cdef Buffer* step_buf
-        cdef uint64_t payload   = 0
         self.got                = 0
         
-        for i in prange(self.nfiles, nogil=True, num_threads=self.num_threads):
-            gots[i] = 0
-            buf = &(self.bufs[i])
-            step_buf = &(self.step_bufs[i])
-
-            # skip reading this buffer if there is/are still some event(s).
-            if buf.n_ready_events - buf.n_seen_events > 0: continue 
+        if self.prefetch_depth > 0:
+            try:
+                for i in range(self.nfiles):
+                    gots[i] = 0
+                    buf = &(self.bufs[i])
+                    if buf.n_ready_events - buf.n_seen_events > 0: continue 
+                    if buf.got - buf.ready_offset > 0 and buf.ready_offset > 0:
+                        memcpy(buf.chunk, buf.chunk + buf.ready_offset, buf.got - buf.ready_offset)
+                    gots[i] = self._take_prefetched(i, buf.chunk + (buf.got - buf.ready_offset), \
+                            self.chunksize - (buf.got - buf.ready_offset))
+                    self.got += gots[i]
+            except:
+                free(gots)
+                raise
             
-            # copy remaining data if any 
-            if buf.got - buf.ready_offset > 0 and buf.ready_offset > 0:
-                memcpy(buf.chunk, buf.chunk + buf.ready_offset, buf.got - buf.ready_offset)
-            
-            # read more data to fill up the buffer
-            gots[i] = read( self.file_descriptors[i], buf.chunk + (buf.got - buf.ready_offset), \
-                    self.chunksize - (buf.got - buf.ready_offset) )
+            for i in prange(self.nfiles, nogil=True, num_threads=self.num_threads):
+                buf = &(self.bufs[i])
+                if buf.n_ready_events - buf.n_seen_events > 0: continue 
+                self._parse_buffer(i, gots[i])
+        
+        else:
+            for i in prange(self.nfiles, nogil=True, num_threads=self.num_threads):
+                gots[i] = 0
+                buf = &(self.bufs[i])
 
-            # summing the size of all the new reads
-            self.got += gots[i]
-            
-            buf.got = (buf.got - buf.ready_offset) + gots[i]
-            
-            # reset the offsets and no. of events
-            buf.ready_offset        = 0
-            buf.n_ready_events      = 0
-            buf.seen_offset         = 0
-            buf.n_seen_events       = 0
-            step_buf.ready_offset   = 0
-            step_buf.n_ready_events = 0
-            step_buf.seen_offset    = 0
-            step_buf.n_seen_events  = 0
-            
-            while buf.ready_offset < buf.got:
-                if buf.got - buf.ready_offset >= sizeof(Dgram):
-                    d = <Dgram *>(buf.chunk + buf.ready_offset)
-                    payload = d.xtc.extent - sizeof(Xtc)
-
-                    # check if this dgram is too big to fit in the chunk
-                    if sizeof(Dgram) + payload > self.chunksize:
-                        self.chunk_overflown = sizeof(Dgram) + payload
-
-                    if (buf.got - buf.ready_offset) >= sizeof(Dgram) + payload:
-                        buf.ts_arr[buf.n_ready_events] = <uint64_t>d.seq.high << 32 | d.seq.low
-                        buf.st_offset_arr[buf.n_ready_events] = buf.ready_offset
-                        buf.en_offset_arr[buf.n_ready_events] = buf.ready_offset + sizeof(Dgram) + payload
-
-                        buf.sv_arr[buf.n_ready_events] = (d.env>>24)&0xf
-                        
-                        # check if this a non L1
-                        if buf.sv_arr[buf.n_ready_events] != self.L1Accept:
-                            memcpy(step_buf.chunk + step_buf.ready_offset, d, sizeof(Dgram) + payload)
-                            step_buf.ts_arr[step_buf.n_ready_events] = buf.ts_arr[buf.n_ready_events]
-                            step_buf.st_offset_arr[step_buf.n_ready_events] = step_buf.ready_offset
-                            step_buf.en_offset_arr[step_buf.n_ready_events] = step_buf.ready_offset + sizeof(Dgram) + payload
-                            step_buf.sv_arr[step_buf.n_ready_events] = buf.sv_arr[buf.n_ready_events]
-                            step_buf.n_ready_events += 1
-                            step_buf.ready_offset += sizeof(Dgram) + payload
-                            step_buf.timestamp = buf.ts_arr[buf.n_ready_events]
-
-                            if buf.sv_arr[buf.n_ready_events] == self.EndRun:
-                                buf.endrun_ts = buf.ts_arr[buf.n_ready_events]
-                        
-                        buf.timestamp = buf.ts_arr[buf.n_ready_events] 
-                        buf.ready_offset += sizeof(Dgram) + payload
-                        buf.n_ready_events += 1
-
-                    else: # if (buf.got - buf.ready_offset) >= sizeof(Dgram) + payload
-                        break
-                else: #if buf.got - buf.ready_offset >= sizeof(Dgram)
-                    break
+                # skip reading this buffer if there is/are still some event(s).
+                if buf.n_ready_events - buf.n_seen_events > 0: continue 
+                
+                # copy remaining data if any 
+                if buf.got - buf.ready_offset > 0 and buf.ready_offset > 0:
+                    memcpy(buf.chunk, buf.chunk + buf.ready_offset, buf.got - buf.ready_offset)
+                
+                # read more data to fill up the buffer
+                gots[i] = read( self.file_descriptors[i], buf.chunk + (buf.got - buf.ready_offset), \
+                        self.chunksize - (buf.got - buf.ready_offset) )
+
+                # summing the size of all the new reads
+                self.got += gots[i]
+                
+                self._parse_buffer(i, gots[i])
+        
+        free(gots)
+
+    @cython.boundscheck(False)
+    cdef void _parse_buffer(self, Py_ssize_t i, int64_t got) nogil:
+        """ Locates dgrams in buffer i after got bytes were added and 
+        copies non L1Accept dgrams to its step buffer."""
+        cdef Buffer* buf        = &(self.bufs[i])
+        cdef Buffer* step_buf   = &(self.step_bufs[i])
+        cdef Dgram* d
+        cdef uint64_t payload   = 0
             
-            # end while buf.ready_offset < buf.got:
+        buf.got = (buf.got - buf.ready_offset) + got
+        
+        # reset the offsets and no. of events
+        buf.ready_offset        = 0
+        buf.n_ready_events      = 0
+        buf.seen_offset         = 0
+        buf.n_seen_events       = 0
+        step_buf.ready_offset   = 0
+        step_buf.n_ready_events = 0
+        step_buf.seen_offset    = 0
+        step_buf.n_seen_events  = 0
+        
+        while buf.ready_offset < buf.got:
+            if buf.got - buf.ready_offset >= sizeof(Dgram):
+                d = <Dgram *>(buf.chunk + buf.ready_offset)
+                payload = d.xtc.extent - sizeof(Xtc)
 
+                # check if this dgram is too big to fit in the chunk
+                if sizeof(Dgram) + payload > self.chunksize:
+                    self.chunk_overflown = sizeof(Dgram) + payload
 
+                if (buf.got - buf.ready_offset) >= sizeof(Dgram) + payload:
+                    buf.ts_arr[buf.n_ready_events] = <uint64_t>d.seq.high << 32 | d.seq.low
+                    buf.st_offset_arr[buf.n_ready_events] = buf.ready_offset
+                    buf.en_offset_arr[buf.n_ready_events] = buf.ready_offset + sizeof(Dgram) + payload
+
+                    buf.sv_arr[buf.n_ready_events] = (d.env>>24)&0xf
+                    
+                    # check if this a non L1
+                    if buf.sv_arr[buf.n_ready_events] != self.L1Accept:
+                        memcpy(step_buf.chunk + step_buf.ready_offset, d, sizeof(Dgram) + payload)
+                        step_buf.ts_arr[step_buf.n_ready_events] = buf.ts_arr[buf.n_ready_events]
+                        step_buf.st_offset_arr[step_buf.n_ready_events] = step_buf.ready_offset
+                        step_buf.en_offset_arr[step_buf.n_ready_events] = step_buf.ready_offset + sizeof(Dgram) + payload
+                        step_buf.sv_arr[step_buf.n_ready_events] = buf.sv_arr[buf.n_ready_events]
+                        step_buf.n_ready_events += 1
+                        step_buf.ready_offset += sizeof(Dgram) + payload
+                        step_buf.timestamp = buf.ts_arr[buf.n_ready_events]
+
+                        if buf.sv_arr[buf.n_ready_events] == self.EndRun:
+                            buf.endrun_ts = buf.ts_arr[buf.n_ready_events]
+                    
+                    buf.timestamp = buf.ts_arr[buf.n_ready_events] 
+                    buf.ready_offset += sizeof(Dgram) + payload
+                    buf.n_ready_events += 1
+
+                else: # if (buf.got - buf.ready_offset) >= sizeof(Dgram) + payload
+                    break
+            else: #if buf.got - buf.ready_offset >= sizeof(Dgram)
+                break
+        
+        # end while buf.ready_offset < buf.got:
@@ -0,0 +1,113 @@
+"""
+:py:class:`DirCache` - size-bounded LRU cache of files in a local directory
+===========================================================================
+
+Base of the on-disk caches of calibration data (:py:class:`MDBWebCache`) and of
+pixel coordinate arrays (:py:class:`GeometryCache`). An entry consists of files
+<cache_dir>/<name><suffix> for each of the suffixes of the cache. The file with
+the last suffix is written last, so an entry is only valid once it is in place,
+and its modification time marks the last use of the entry. When the total size
+exceeds max_bytes, least recently used entries are removed.
+
+Usage ::
+
+    from psana.pscalib.calib.DirCache import DirCache, cache_from_env
+
+    class MyCache(DirCache):
+        suffixes = ('.bin', '.json')
+
+    cache = cache_from_env(MyCache, 'MY_CACHE', 'MY_CACHE_MB') # None if MY_CACHE is not set
+    cache.write_atomic(cache.path(name, '.bin'), data, 'wb')
+    cache.touch(name)
+
+Cache directory can be shared by processes -- files are written atomically.
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+
+import os
+import tempfile
+import threading
+
+
+class DirCache:
+    """Size-bounded LRU cache of entries (files with suffixes) in directory cache_dir."""
+
+    suffixes = ('.bin',)
+
+    def __init__(self, cache_dir, max_bytes=1024*1024*1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+
+    def path(self, name, suffix=''):
+        return os.path.join(self.cache_dir, name + suffix)
+
+    def touch(self, name):
+        """Marks the last use of the entry."""
+        os.utime(self.path(name, self.suffixes[-1]))
+
+    def write_atomic(self, path, content, mode='wb'):
+        """Writes content (or calls content(f) if callable) to a temporary file renamed to path."""
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, mode) as f:
+                if callable(content): content(f)
+                else: f.write(content)
+            os.replace(tmp_path, path)
+        except BaseException:
+            try: os.remove(tmp_path)
+            except OSError: pass
+            raise
+
+    def entries(self):
+        """Returns list of (last use time, size, name) of cached entries."""
+        marker = self.suffixes[-1]
+        entries = []
+        for fname in os.listdir(self.cache_dir):
+            if not fname.endswith(marker): continue
+            name = fname[:-len(marker)]
+            try:
+                size = sum(os.path.getsize(self.path(name, sfx)) for sfx in self.suffixes)
+                entries.append((os.path.getmtime(self.path(name, marker)), size, name))
+            except OSError:
+                continue
+        return entries
+
+    def evict(self):
+        """Removes least recently used entries until the total size is below max_bytes."""
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        if total <= self.max_bytes: return
+        for _, size, name in sorted(entries):
+            for sfx in self.suffixes[::-1]: # marker first - the entry is invalid from now on
+                try: os.remove(self.path(name, sfx))
+                except OSError: pass
+            total -= size
+            logger.debug('%s: evicted %s (%d bytes)' % (type(self).__name__, name, size))
+            if total <= self.max_bytes: break
+
+
+_caches = {} # cache class: instance
+_caches_lock = threading.Lock()
+
+def cache_from_env(cls, env_dir, env_mb, default_mb=1024):
+    """Returns instance of cls in directory os.environ[env_dir] limited to os.environ[env_mb] MB.
+       Returns None if env_dir is not set or empty (caching is opt-in) or the directory cannot be used.
+    """
+    cache_dir = os.environ.get(env_dir, '')
+    if not cache_dir: return None
+    with _caches_lock:
+        cache = _caches.get(cls, None)
+        if cache is None or cache.cache_dir != cache_dir:
+            try:
+                cache = _caches[cls] = cls(cache_dir, int(os.environ.get(env_mb, default_mb))*1024*1024)
+            except OSError as e:
+                logger.warning('%s: caching is disabled - cannot use %s (%s)' % (cls.__name__, cache_dir, e))
+                return None
+        return cache
+
+# EOF
@@ -0,0 +1,90 @@
+"""
+:py:class:`MDBWebCache` - local on-disk cache of calibration data fetched from the web service
+=================================================================================================
+
+Data (GridFS payloads) of calibration documents are stored in files named by
+the hash of (dbname, doc id, data id). Each entry keeps the time stamp of its
+document and is only used if the document still has the same time stamp.
+When the total size exceeds the limit, least recently used entries are removed
+(see :py:class:`DirCache`).
+
+Usage ::
+
+    from psana.pscalib.calib.MDBWebCache import calib_cache
+
+    cache = calib_cache() # None if caching is not enabled
+    s = cache.get(dbname, doc) # None if not cached
+    cache.put(dbname, doc, s)
+
+Environment ::
+
+    LCLS_CALIB_CACHE     - cache directory, caching is off if not set or empty, e.g.
+                           LCLS_CALIB_CACHE=${XDG_CACHE_HOME:-~/.cache}/psana/calib or a scratch directory
+    LCLS_CALIB_CACHE_MB  - maximal total size of cached data in MB (default 1024)
+
+Cache directory can be shared by processes -- entries are written atomically.
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+
+import json
+import hashlib
+from psana.pscalib.calib.DirCache import DirCache, cache_from_env
+
+
+class MDBWebCache(DirCache):
+    """Size-bounded LRU cache of calibration data in directory cache_dir."""
+
+    suffixes = ('.bin', '.json') # data first - an entry is only valid once its .json is in place
+
+    def _name(self, dbname, doc):
+        key = '%s/%s/%s' % (dbname, doc.get('_id', None), doc.get('id_data', None))
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    @staticmethod
+    def _doc_stamp(doc):
+        return str(doc.get('time_stamp', doc.get('time_sec', None)))
+
+    def get(self, dbname, doc):
+        """Returns cached data (bytes) of the document or None."""
+        name = self._name(dbname, doc)
+        try:
+            with open(self.path(name, '.json')) as f:
+                meta = json.load(f)
+            if meta['time_stamp'] != self._doc_stamp(doc):
+                logger.debug('MDBWebCache: outdated entry for doc %s' % str(doc.get('_id', None)))
+                self.misses += 1
+                return None
+            with open(self.path(name, '.bin'), 'rb') as f:
+                s = f.read()
+            if len(s) != meta['size']:
+                self.misses += 1
+                return None
+            self.touch(name)
+        except (OSError, ValueError, KeyError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return s
+
+    def put(self, dbname, doc, s):
+        """Saves data (bytes) of the document. Returns False if it cannot be written."""
+        name = self._name(dbname, doc)
+        meta = {'dbname': dbname, 'doc_id': str(doc.get('_id', None)), 'id_data': str(doc.get('id_data', None)),
+                'time_stamp': self._doc_stamp(doc), 'size': len(s)}
+        try:
+            self.write_atomic(self.path(name, '.bin'), s, 'wb')
+            self.write_atomic(self.path(name, '.json'), json.dumps(meta), 'w')
+        except OSError as e:
+            logger.debug('MDBWebCache: cannot write %s (%s)' % (self.path(name), e))
+            return False
+        self.evict()
+        return True
+
+
+def calib_cache():
+    """Returns the cache set by LCLS_CALIB_CACHE and LCLS_CALIB_CACHE_MB or None if not enabled."""
+    return cache_from_env(MDBWebCache, 'LCLS_CALIB_CACHE', 'LCLS_CALIB_CACHE_MB')
+
+# EOF
@@ -20,6 +20,7 @@ Usage ::
     data,doc = wu.calib_constants(det, exp=None, ctype='pedestals', run=None, time_sec=None, vers=None, url=cc.URL)
     d = wu.calib_constants_all_types(det, exp=None, run=None, time_sec=None, vers=None, url=cc.URL)
     d = {ctype:(data,doc),}
+    resp = wu.calib_constants_for_dets(func, dets) # {det:func(det),} with func called concurrently
 
     id = wu.add_data_from_file(dbname, fname, sfx=None, url=cc.URL_KRB, krbheaders=cc.KRBHEADERS)
     id = wu.add_data(dbname, data, url=cc.URL_KRB, krbheaders=cc.KRBHEADERS)
@@ -48,12 +49,18 @@ Usage ::
 import logging
 logger = logging.getLogger(__name__)
 
+import os
 import sys
 import numpy as np
 import io
 
 import psana.pscalib.calib.CalibConstants as cc
 from requests import get, post, delete #put
+from requests import Session
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
+import threading
 
 from time import time
 from numpy import fromstring
@@ -62,6 +69,7 @@ import psana.pscalib.calib.MDBUtils as mu
 #from bson.objectid import ObjectId
 
 import psana.pyalgos.generic.Utils as gu
+from psana.pscalib.calib.MDBWebCache import calib_cache
 
 
 from subprocess import call
@@ -86,9 +94,40 @@ def query_id_pro(query):
     return query
 
 
+# GET requests share a pool of connections and are retried with backoff on
+# connection errors and server errors. Calibration data of different ctypes
+# and detectors are fetched concurrently by up to LCLS_CALIB_WORKERS threads.
+CALIB_WORKERS = int(os.environ.get('LCLS_CALIB_WORKERS', 8))
+CALIB_RETRIES = int(os.environ.get('LCLS_CALIB_RETRIES', 3))
+_session = None
+_session_lock = threading.Lock()
+_data_pool = None
+
+def session():
+    """Returns requests.Session shared by threads of the process."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            retry = Retry(total=CALIB_RETRIES, backoff_factor=0.5, status_forcelist=(500, 502, 503, 504), raise_on_status=False)
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max(CALIB_WORKERS, 1), max_retries=retry)
+            _session = Session()
+            _session.mount('http://', adapter)
+            _session.mount('https://', adapter)
+    return _session
+
+
+def data_pool():
+    """Returns thread pool for get_data_for_doc calls."""
+    global _data_pool
+    with _session_lock:
+        if _data_pool is None:
+            _data_pool = ThreadPoolExecutor(max_workers=max(CALIB_WORKERS, 1), thread_name_prefix='calib_data')
+    return _data_pool
+
+
 def request(url, query=None):
     #t0_sec = time()
-    r = get(url, query)
+    r = session().get(url, params=query) # ConnectionError and Timeout are raised after retries
     #dt = time()-t0_sec # ~30msec
     #logger.debug('CONSUMED TIME by request %.3f sec\n  for url=%s  query=%s' % (dt, url, str(query)))
     if r.ok: return r
@@ -203,6 +242,7 @@ def get_data_for_docid(dbname, colname, docid, url=cc.URL):
 # curl -s "https://pswww.slac.stanford.edu/calib_ws/cdb_cxic0415/cspad_0001/gridfs/5b6893e81ead141643fe4344"
 def get_data_for_doc(dbname, doc, url=cc.URL):
     """Returns data from GridFS using doc.
+       Data are taken from the local cache (see MDBWebCache) if available.
     """
     logger.debug('get_data_for_doc: %s', str(doc))
     idd = doc.get('id_data', None)
@@ -210,9 +250,13 @@ def get_data_for_doc(dbname, doc, url=cc.URL):
         logger.debug("get_data_for_doc: key 'id_data' is missing in selected document...")
         return None
 
-    r2 = request('%s/%s/gridfs/%s'%(url,dbname,idd))
-    if r2 is None: return None
-    s = r2.content
+    cache = calib_cache()
+    s = None if cache is None else cache.get(dbname, doc)
+    if s is None:
+        r2 = request('%s/%s/gridfs/%s'%(url,dbname,idd))
+        if r2 is None: return None
+        s = r2.content
+        if cache is not None: cache.put(dbname, doc, s)
 
     return mu.object_from_data_string(s, doc)
 
@@ -269,13 +313,35 @@ def calib_constants_of_missing_types(resp, det, time_sec=None, vers=None, url=cc
 
     logger.debug('calib_constants_missing_types - found additional ctypes: %s' % str(_ctypes))
 
-    for ct in _ctypes:
+    resp.update(data_for_latest_docs(dbname, docs, _ctypes, query, url))
+    return resp
+
+
+def data_for_latest_docs(dbname, docs, ctypes, query, url=cc.URL):
+    """ returns {ctype:(data,doc),} for the latest doc of each ctype,
+        data of all ctypes are fetched concurrently.
+    """
+    latest = {}
+    for ct in ctypes:
         docs_for_type = [d for d in docs if d.get('ctype',None)==ct]
         doc = select_latest_doc(docs_for_type, query)
         if doc is None : continue
-        resp[ct] = (get_data_for_doc(dbname, doc, url), doc)
+        latest[ct] = doc
 
-    return resp
+    futures = {ct:data_pool().submit(get_data_for_doc, dbname, doc, url) for ct,doc in latest.items()}
+    return {ct:(f.result(), latest[ct]) for ct,f in futures.items()}
+
+
+def calib_constants_for_dets(func, dets):
+    """ returns {det:func(det),} with func (e.g. calling calib_constants_all_types) 
+        called concurrently for dets.
+    """
+    dets = list(dets)
+    if len(dets) < 2:
+        return {det:func(det) for det in dets}
+    with ThreadPoolExecutor(max_workers=min(len(dets), max(CALIB_WORKERS, 1)), thread_name_prefix='calib_det') as pool:
+        futures = {det:pool.submit(func, det) for det in dets}
+        return {det:f.result() for det,f in futures.items()}
 
 
 def calib_constants_all_types(det, exp=None, run=None, time_sec=None, vers=None, url=cc.URL):
@@ -296,12 +362,7 @@ def calib_constants_all_types(det, exp=None, run=None, time_sec=None, vers=None,
     ctypes.discard(None)
     logger.debug('calib_constants_all_types - found ctypes: %s' % str(ctypes))
 
-    resp = {}
-    for ct in ctypes:
-        docs_for_type = [d for d in docs if d.get('ctype',None)==ct]
-        doc = select_latest_doc(docs_for_type, query)
-        if doc is None : continue
-        resp[ct] = (get_data_for_doc(dbname, doc, url), doc)
+    resp = data_for_latest_docs(dbname, docs, ctypes, query, url)
 
     resp = calib_constants_of_missing_types(resp, det, time_sec, vers, url)
 
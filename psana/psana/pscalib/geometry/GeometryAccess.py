@@ -81,6 +81,10 @@ Usage::
     # save current geometry parameters in file
     geometry.save_pars_in_file(fname_geometry_new)
 
+    # pixel coordinate and index arrays are cached on disk by hash of geometry and call parameters,
+    # if enabled with LCLS_GEO_CACHE (see GeometryCache), arrays are returned as copy-on-write memmaps
+    s = geometry.geo_pars_hash()
+
     # DEPRECATED change verbosity bit-control word; to print everythisg use pbits = 0xffff
     geometry.set_print_bits(pbits=0o377)
 
@@ -106,10 +110,12 @@ Author: Mikhail Dubrovin
 #------------------------------
 
 import os
+import hashlib
 import numpy as np
 from math import floor, fabs
 
 from psana.pscalib.geometry.GeometryObject import GeometryObject
+from psana.pscalib.geometry.GeometryCache import geometry_cache
 
 import logging
 logger = logging.getLogger(__name__)
@@ -172,6 +178,8 @@ class GeometryAccess:
         self.p_um_old   = None
         self.cframe_old = None
         self.fract_old  = None
+        self.pars_xyz_old = None
+        self.pars_rc_old  = None
 
     #------------------------------
 
@@ -388,6 +396,30 @@ class GeometryAccess:
     
     #------------------------------
 
+    def geo_pars_hash(self):
+        """Returns hash (hex digest) of parameters of all geometry objects.
+        """
+        pars = [(g.pname, g.pindex, g.oname, g.oindex, g.x0, g.y0, g.z0, g.rot_z, g.rot_y, g.rot_x,\
+                 g.tilt_z, g.tilt_y, g.tilt_x) for g in self.list_of_geos if g is not None]
+        return hashlib.sha1(repr((pars, self.use_wide_pix_center)).encode()).hexdigest()
+
+    #------------------------------
+
+    def _cached_arrays(self, kind, pars, func):
+        """Returns tuple of arrays evaluated by func for call parameters pars from/to GeometryCache.
+        """
+        cache = geometry_cache()
+        if cache is None: return func()
+        key = cache.key(kind, self.geo_pars_hash(), pars)
+        a = cache.get(key)
+        if a is None:
+            arrs = func()
+            if any(v is None for v in arrs): return arrs
+            a = cache.put(key, np.stack(arrs))
+        return tuple(a)
+
+    #------------------------------
+
     def coords_psana_to_lab_frame(self, x, y, z):
         """ Switches arrays of pixel coordinates between psana <-(symmetric transformation)-> lab frame 
             returns x,y,z pixel arrays in the lab coordinate frame.
@@ -409,21 +441,22 @@ class GeometryAccess:
         """
         if not self.valid: return None
 
-        if  oindex  == self.oindex_old\
-        and oname   == self.oname_old\
-        and do_tilt == self.tilt_old\
-        and cframe  == self.cframe_old:
+        pars = (oname, oindex, do_tilt, cframe)
+        if pars == self.pars_xyz_old:
             return self.X_old, self.Y_old, self.Z_old
 
-        geo = self.get_top_geo() if oname is None else self.get_geo(oname, oindex)
-        if logger.getEffectiveLevel() == logging.DEBUG:
-            logger.debug('get_pixel_coords(...) for geo:')
-            geo.print_geo_children();
-        
-        x,y,z = geo.get_pixel_coords(do_tilt) 
-        self.X_old, self.Y_old, self.Z_old = self.coords_psana_to_lab_frame(x,y,z) if cframe>0 else (x,y,z)
+        def pixel_coords():
+            geo = self.get_top_geo() if oname is None else self.get_geo(oname, oindex)
+            if logger.getEffectiveLevel() == logging.DEBUG:
+                logger.debug('get_pixel_coords(...) for geo:')
+                geo.print_geo_children();
+            x,y,z = geo.get_pixel_coords(do_tilt) 
+            return self.coords_psana_to_lab_frame(x,y,z) if cframe>0 else (x,y,z)
+
+        self.X_old, self.Y_old, self.Z_old = self._cached_arrays('xyz', pars, pixel_coords)
         self.tilt_old = do_tilt
         self.cframe_old = cframe
+        self.pars_xyz_old = pars
         return self.X_old, self.Y_old, self.Z_old
 
     #------------------------------
@@ -493,6 +526,7 @@ class GeometryAccess:
         """
         if not self.valid: return None
         geo = self.get_top_geo() if oname is None else self.get_geo(oname, oindex)
+        self.reset_cash()
         return geo.set_geo_pars(x0, y0, z0, rot_z, rot_y, rot_x, tilt_z, tilt_y, tilt_x)
 
     #------------------------------
@@ -502,6 +536,7 @@ class GeometryAccess:
         """
         if not self.valid: return None
         geo = self.get_top_geo() if oname is None else self.get_geo(oname, oindex)
+        self.reset_cash()
         return geo.move_geo(dx, dy, dz)
 
     #------------------------------
@@ -511,6 +546,7 @@ class GeometryAccess:
         """
         if not self.valid: return None
         geo = self.get_top_geo() if oname is None else self.get_geo(oname, oindex)
+        self.reset_cash()
         return geo.tilt_geo(dt_x, dt_y, dt_z)
 
     #------------------------------
@@ -617,17 +653,16 @@ class GeometryAccess:
         """
         if not self.valid: return None, None
 
-        if  oindex  == self.oindex_old\
-        and oname   == self.oname_old\
-        and do_tilt == self.tilt_old\
-        and cframe  == self.cframe_old\
-        and pix_scale_size_um is None\
-        and xy0_off_pix is None\
-        and self.rows_old is not None:
+        pars = (oname, oindex, pix_scale_size_um, None if xy0_off_pix is None else tuple(xy0_off_pix), do_tilt, cframe)
+        if pars == self.pars_rc_old:
             return self.rows_old, self.cols_old
 
-        X, Y, Z = self.get_pixel_coords(oname, oindex, do_tilt, cframe)
-        self.rows_old, self.cols_old = self.xy_to_rc_arrays(X, Y, pix_scale_size_um, xy0_off_pix, cframe)
+        def pixel_coord_indexes():
+            X, Y, Z = self.get_pixel_coords(oname, oindex, do_tilt, cframe)
+            return self.xy_to_rc_arrays(X, Y, pix_scale_size_um, xy0_off_pix, cframe)
+
+        self.rows_old, self.cols_old = self._cached_arrays('rc', pars, pixel_coord_indexes)
+        self.pars_rc_old = pars
         return self.rows_old, self.cols_old
 
     #------------------------------
@@ -638,6 +673,7 @@ class GeometryAccess:
         if not self.valid: return None, None
         X, Y = self.get_pixel_xy_at_z(zplane, oname, oindex, do_tilt, cframe)
         self.rows_old, self.cols_old = self.xy_to_rc_arrays(X, Y, pix_scale_size_um, xy0_off_pix, cframe)
+        self.pars_rc_old = None
         return self.rows_old, self.cols_old
 
     #------------------------------
@@ -0,0 +1,78 @@
+"""
+:py:class:`GeometryCache` - local on-disk cache of pixel coordinate arrays evaluated from geometry
+==================================================================================================
+
+Arrays (e.g. stacked X,Y,Z pixel coordinates or rows,cols pixel indexes) are
+stored in .npy files named by the hash of geometry parameters and parameters
+of the call that produced them, see :py:meth:`GeometryCache.key`.
+Cached arrays are returned as copy-on-write memmaps, so processes on the same
+node share their pages until an array is modified (changes are private to the
+process and never written to the cache). When the total size exceeds the limit,
+least recently used entries are removed (see :py:class:`DirCache`).
+
+Usage ::
+
+    from psana.pscalib.geometry.GeometryCache import geometry_cache
+
+    cache = geometry_cache() # None if caching is not enabled
+    key = cache.key('xyz', geo_pars, (oname, oindex, do_tilt, cframe))
+    a = cache.get(key) # None if not cached
+    a = cache.put(key, a)
+
+Environment ::
+
+    LCLS_GEO_CACHE     - cache directory, caching is off if not set or empty, e.g.
+                         LCLS_GEO_CACHE=${XDG_CACHE_HOME:-~/.cache}/psana/geometry or a scratch directory
+    LCLS_GEO_CACHE_MB  - maximal total size of cached arrays in MB (default 1024)
+
+Cache directory can be shared by processes -- entries are written atomically.
+"""
+
+import logging
+logger = logging.getLogger(__name__)
+
+import hashlib
+import numpy as np
+from psana.pscalib.calib.DirCache import DirCache, cache_from_env
+
+CACHE_VERSION = 1 # increment if evaluation of pixel coordinates changes
+
+
+class GeometryCache(DirCache):
+    """Size-bounded LRU cache of numpy arrays in directory cache_dir."""
+
+    suffixes = ('.npy',)
+
+    @staticmethod
+    def key(*pars):
+        """Returns key (hex digest) for parameters with deterministic repr."""
+        return hashlib.sha1(repr((CACHE_VERSION,) + pars).encode()).hexdigest()
+
+    def get(self, key):
+        """Returns cached array as copy-on-write memmap or None."""
+        try:
+            a = np.load(self.path(key, '.npy'), mmap_mode='c')
+            self.touch(key)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return a
+
+    def put(self, key, a):
+        """Saves array, returns it as copy-on-write memmap or unchanged if it cannot be written."""
+        path = self.path(key, '.npy')
+        try:
+            self.write_atomic(path, lambda f: np.save(f, a), 'wb')
+            self.evict()
+            return np.load(path, mmap_mode='c')
+        except (OSError, ValueError) as e:
+            logger.debug('GeometryCache: cannot write %s (%s)' % (path, e))
+            return a
+
+
+def geometry_cache():
+    """Returns the cache set by LCLS_GEO_CACHE and LCLS_GEO_CACHE_MB or None if not enabled."""
+    return cache_from_env(GeometryCache, 'LCLS_GEO_CACHE', 'LCLS_GEO_CACHE_MB')
+
+# EOF
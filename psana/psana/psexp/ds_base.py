@@ -31,6 +31,11 @@ class DsParms:
     max_retries: int
     live: bool
     found_xtc2_callback: int
+    bd_access: str = 'read'
+    timestamps: object = None   # L1Accept selections applied by EventBuilder (see
+    ts_range: object = None     # EventBuilder.set_selection)
+    stride: int = 0             #
+    n_l1_seen: int = 0          # no. of L1Accepts of the run counted for stride so far
 
     def set_det_class_table(self, det_classes, xtc_info, det_info_table):
         self.det_classes, self.xtc_info, self.det_info_table = det_classes, xtc_info, det_info_table
@@ -55,6 +60,15 @@ class DataSourceBase(abc.ABC):
         self.destination = 0         # callback that returns rank no. (used by EventBuilder)
         self.monitor     = False     # turns prometheus monitoring client of/off
         self.small_xtc   = []        # swap smd file(s) with bigdata files for these detetors
+        self.bd_access   = 'read'    # bigdata access on bd nodes: 'read' (copy) or 'mmap' (no copy)
+        self.smd_index   = False     # use smd index files (built if missing) instead of reading smd files
+        self.start_ts    = 0         # with smd_index, start at the first event at/after this timestamp
+        self.evt_range   = None      # with smd_index, (start, stop) no. of events (from start_ts) 
+        self.index_rank  = 0         # with smd_index, process part index_rank of index_size parts
+        self.index_size  = 1         # of the selected events (used to split a run across mpi ranks)
+        self.timestamps  = None      # only keep L1Accepts with these timestamps
+        self.ts_range    = None      # only keep L1Accepts in this (first, last) inclusive timestamp range
+        self.stride      = 0         # only keep every stride-th (selected) L1Accept
 
         if kwargs is not None:
             self.smalldata_kwargs = {}
@@ -72,12 +86,36 @@ class DataSourceBase(abc.ABC):
                     'smalldata_kwargs', 
                     'monitor',
                     'small_xtc',
+                    'bd_access',
+                    'smd_index',
+                    'start_ts',
+                    'evt_range',
+                    'index_rank',
+                    'index_size',
+                    'timestamps',
+                    'ts_range',
+                    'stride',
                     )
             
             for k in keywords:
                 if k in kwargs:
                     setattr(self, k, kwargs[k])
 
+            if self.bd_access not in ('read', 'mmap'):
+                raise InvalidDataSourceArgument(f"bd_access must be 'read' or 'mmap' (got '{self.bd_access}')")
+
+            if (self.start_ts or self.evt_range) and not self.smd_index:
+                raise InvalidDataSourceArgument("start_ts and evt_range require smd_index=True")
+
+            if self.smd_index and self.live:
+                raise InvalidDataSourceArgument("smd_index=True is not supported in live mode")
+
+            if self.ts_range is not None and (len(self.ts_range) != 2 or self.ts_range[0] > self.ts_range[1]):
+                raise InvalidDataSourceArgument(f"ts_range must be (first, last) with first <= last (got {self.ts_range})")
+
+            if self.stride < 0:
+                raise InvalidDataSourceArgument(f"stride must be >= 0 (got {self.stride})")
+
             if self.destination != 0:
                 self.batch_size = 1 # reset batch_size to prevent L1 transmitted before BeginRun (FIXME?: Mona)
 
@@ -91,6 +129,10 @@ class DataSourceBase(abc.ABC):
             max_retries = 0
             if self.live: 
                 max_retries = int(os.environ.get('PS_R_MAX_RETRIES', '3'))
+                if self.bd_access == 'mmap':
+                    # Files are still being written - use read retries instead
+                    logger.warning("bd_access='mmap' is not supported in live mode, using 'read'")
+                    self.bd_access = 'read'
 
         assert self.batch_size > 0
         
@@ -102,7 +144,11 @@ class DataSourceBase(abc.ABC):
                 self.prom_man, 
                 max_retries, 
                 self.live,
-                self.found_xtc2_callback) 
+                self.found_xtc2_callback,
+                self.bd_access,
+                self.timestamps,
+                self.ts_range,
+                self.stride) 
 
     def found_xtc2_callback(self, file_type):
         """ Returns a list of True/False if .xtc2 file is found 
@@ -406,23 +452,27 @@ class DataSourceBase(abc.ABC):
             return
         expt, runnum, _ = runinfo
         
-        self.dsparms.calibconst = {}
-        for det_name, configinfo in self.dsparms.configinfo_dict.items():
-            if expt: 
-                if expt == "cxid9114": # mona: hack for cctbx
-                    det_uniqueid = "cspad_0002"
-                elif expt == "xpptut15":
-                    det_uniqueid = "cspad_detnum1234"
-                else:
-                    det_uniqueid = configinfo.uniqueid
-                calib_const = wu.calib_constants_all_types(det_uniqueid, exp=expt, run=runnum)
-                
-                # mona - hopefully this will be removed once the calibconst
-                # db all use uniqueid as an identifier
-                if not calib_const:
-                    calib_const = wu.calib_constants_all_types(det_name, exp=expt, run=runnum)
-                self.dsparms.calibconst[det_name] = calib_const
+        def _calib_const(det_name):
+            if expt == "cxid9114": # mona: hack for cctbx
+                det_uniqueid = "cspad_0002"
+            elif expt == "xpptut15":
+                det_uniqueid = "cspad_detnum1234"
             else:
+                det_uniqueid = self.dsparms.configinfo_dict[det_name].uniqueid
+            calib_const = wu.calib_constants_all_types(det_uniqueid, exp=expt, run=runnum)
+            
+            # mona - hopefully this will be removed once the calibconst
+            # db all use uniqueid as an identifier
+            if not calib_const:
+                calib_const = wu.calib_constants_all_types(det_name, exp=expt, run=runnum)
+            return calib_const
+
+        if expt:
+            # Detectors are fetched concurrently
+            self.dsparms.calibconst = wu.calib_constants_for_dets(_calib_const, self.dsparms.configinfo_dict.keys())
+        else:
+            self.dsparms.calibconst = {}
+            for det_name in self.dsparms.configinfo_dict:
                 print(f"ds_base: Warning: cannot access calibration constant (exp is None)")
                 self.dsparms.calibconst[det_name] = None
     
@@ -1,6 +1,7 @@
 from psana       import dgram
 from psana.event import Event
 from psana.psexp import PacketFooter, TransitionId, PrometheusManager
+from psana.smdparser import parse_smd_batch
 import numpy as np
 import os
 import time
@@ -12,6 +13,25 @@ s_bd_just_read = PrometheusManager.get_metric('psana_bd_just_read')
 s_bd_gen_smd_batch = PrometheusManager.get_metric('psana_bd_gen_smd_batch')
 s_bd_gen_evt = PrometheusManager.get_metric('psana_bd_gen_evt')
 
+IOV_MAX = os.sysconf('SC_IOV_MAX') if hasattr(os, 'sysconf') else 1024
+
+def coalesce_ranges(offsets, sizes, max_gap):
+    """ Groups file ranges (in the given order) into read requests.
+
+    The next range joins the current request if it starts at or after the end
+    of the previous range and the gap between them is at most max_gap bytes.
+    Returns list of (i_first, i_last+1) index pairs and the gaps before each range."""
+    if offsets.shape[0] == 0:
+        return [], np.zeros(0, dtype=np.int64)
+    gaps = np.zeros(offsets.shape[0], dtype=np.int64)
+    gaps[1:] = offsets[1:] - (offsets[:-1] + sizes[:-1])
+    new_req = (gaps < 0) | (gaps > max_gap)
+    new_req[0] = True
+    starts = np.nonzero(new_req)[0]
+    ends = np.append(starts[1:], offsets.shape[0])
+    gaps[new_req] = 0
+    return list(zip(starts, ends)), gaps
+
 class EventManager(object):
     """ Return an event from the received smalldata memoryview (view)
 
@@ -41,6 +61,13 @@ class EventManager(object):
         self.use_smds = use_smds
         self.smd_view = view
         self.i_evt = 0
+        # Parse smd batch in C (default) or step through it with Dgram objects
+        self.fast_parse = bool(int(os.environ.get('PS_BD_FAST_PARSE', 1)))
+        # Bigdata ranges closer than max_gap bytes are read in one request
+        # (gap bytes are discarded). With readahead, the kernel is told that
+        # the next batch (assumed to follow this one) will be needed soon.
+        self.bd_max_gap = int(os.environ.get('PS_BD_MAX_GAP', 65536))
+        self.bd_readahead = bool(int(os.environ.get('PS_BD_READAHEAD', 1))) and hasattr(os, 'posix_fadvise')
 
         self._get_offset_and_size()
         if self.dm.n_files > 0:
@@ -77,8 +104,46 @@ class EventManager(object):
 
         current_bd_offsets[i_smd] = self.bd_offset_array[i_evt, i_smd] + self.bd_size_array[i_evt, i_smd]
         
+    def _get_chunk_id(self, d):
+        """ Returns new chunk id found in SlowUpdate dgram (0 if not found)."""
+        if not hasattr(d, 'chunkinfo'):
+            return 0
+        _chunk_ids = [getattr(d.chunkinfo[seg_id].chunkinfo, 'chunkid') for seg_id in d.chunkinfo]
+        if _chunk_ids: return _chunk_ids[0] # there must be only one unique epics var
+        return 0
+
     @s_bd_gen_smd_batch.time()
     def _get_offset_and_size(self):
+        if self.fast_parse:
+            self._parse_offset_and_size()
+        else:
+            self._step_offset_and_size()
+
+    def _parse_offset_and_size(self):
+        """ Fills offset and size arrays from footers and dgram headers of
+        smd_view (see parse_smd_batch). Dgram objects are only created for 
+        SlowUpdates (chunkinfo) and for L1Accepts with non-standard smdinfo."""
+        get_bd = self.dm.n_files > 0
+        arrays = parse_smd_batch(self.smd_view, self.n_smd_files, get_bd)
+        self.bd_offset_array    = arrays['bd_offset']
+        self.bd_size_array      = arrays['bd_size']
+        self.smd_offset_array   = arrays['smd_offset']
+        self.smd_size_array     = arrays['smd_size']
+        self.cutoff_flag_array  = arrays['cutoff_flag']
+        self.services           = arrays['services']
+        self.new_chunk_id_array = np.zeros_like(self.bd_offset_array)
+        
+        for i_evt, i_smd in zip(*np.nonzero(arrays['needs_dgram'])):
+            d = dgram.Dgram(config=self.smd_configs[i_smd], view=self.smd_view, 
+                    offset=int(self.smd_offset_array[i_evt, i_smd]))
+            if self.services[i_evt] == TransitionId.L1Accept:
+                self.bd_offset_array[i_evt, i_smd] = d.smdinfo[0].offsetAlg.intOffset
+                self.bd_size_array[i_evt, i_smd] = d.smdinfo[0].offsetAlg.intDgramSize 
+            else:
+                # We only support chunking on bigdata
+                self.new_chunk_id_array[i_evt, i_smd] = self._get_chunk_id(d)
+
+    def _step_offset_and_size(self):
         """
         Use fast step-through to read off offset and size from smd_view.
         Format of smd_view 
@@ -129,9 +194,7 @@ class EventManager(object):
                 elif d.service() == TransitionId.SlowUpdate and hasattr(d, 'chunkinfo'):
                     # We only support chunking on bigdata
                     if self.dm.n_files > 0: 
-                        stream_id = self.dm.get_stream_id(i_smd)
-                        _chunk_ids = [getattr(d.chunkinfo[seg_id].chunkinfo, 'chunkid') for seg_id in d.chunkinfo]
-                        if _chunk_ids: self.new_chunk_id_array[i_evt, i_smd] = _chunk_ids[0] # there must be only one unique epics var
+                        self.new_chunk_id_array[i_evt, i_smd] = self._get_chunk_id(d)
             
             offset += smd_aux_sizes[i_smd]            
             i_smd += 1
@@ -141,18 +204,12 @@ class EventManager(object):
                 i_evt += 1 # done with this smd event
 
     def _open_new_bd_file(self, i_smd, new_chunk_id):
-        os.close(self.dm.fds[i_smd])
-        xtc_dir = os.path.dirname(self.dm.xtc_files[i_smd])
-        filename = os.path.basename(self.dm.xtc_files[i_smd])
-        found = filename.find('-c')
-        new_filename = filename.replace(filename[found:found+4], '-c'+str(new_chunk_id).zfill(2))
-        fd = os.open(os.path.join(xtc_dir, new_filename), os.O_RDONLY)
-        self.dm.fds[i_smd] = fd
-        self.dm.xtc_files[i_smd] = new_filename
+        self.dm.open_chunk(i_smd, new_chunk_id)
     
-    @s_bd_just_read.time()
     def _read(self, fd, size, offset):
-        st = time.monotonic()
+        """ Reads size bytes at offset, retrying while the file is still being
+        written (up to PS_R_MAX_RETRIES). Returns fewer bytes if the file does
+        not grow. Not timed, bytes and time are counted by the caller (_readv)."""
         chunk = bytearray()
         for i_retry in range(self.max_retries+1):
             chunk.extend(os.pread(fd, size, offset))
@@ -169,56 +226,155 @@ class EventManager(object):
 
             print(f'bigdata read retry#{i_retry} - waiting for {size/1e6} MB, max_retries: {self.max_retries} (PS_R_MAX_RETRIES), sleeping 1 second...') 
             time.sleep(1)
+        return chunk
+
+    @s_bd_just_read.time()
+    def _readv(self, fd, offsets, sizes, bd_buf, buf_offset):
+        """ Reads ranges (offsets, sizes) back-to-back into bd_buf starting at
+        buf_offset. Nearby ranges are coalesced into one preadv call that
+        scatters dgrams into bd_buf and gap bytes into a scratch buffer.
+        Returns no. of bytes placed in bd_buf. Raises IOError if the ranges
+        cannot be read in full (e.g. a truncated file)."""
+        requests, gaps = coalesce_ranges(offsets, sizes, self.bd_max_gap)
+        if self.bd_readahead:
+            for i_st, i_en in requests:
+                os.posix_fadvise(fd, int(offsets[i_st]), int(offsets[i_en-1] + sizes[i_en-1] - offsets[i_st]), 
+                        os.POSIX_FADV_WILLNEED)
+        
+        st = time.monotonic()
+        buf_view = memoryview(bd_buf)
+        scratch = bytearray(int(np.max(gaps)) if gaps.shape[0] else 0)
+        got_nbytes = 0
+        gap_nbytes = 0
+        n_reqs = 0
+        for i_st, i_en in requests:
+            i = i_st
+            while i < i_en:
+                # Build iovecs for this request (gaps point to the scratch buffer)
+                iovs = []
+                file_offset = int(offsets[i])
+                while i < i_en and len(iovs) < IOV_MAX - 1:
+                    if i > i_st and gaps[i] > 0 and iovs:
+                        iovs.append(memoryview(scratch)[:gaps[i]])
+                        gap_nbytes += int(gaps[i])
+                    iovs.append(buf_view[buf_offset: buf_offset + sizes[i]])
+                    buf_offset += int(sizes[i])
+                    i += 1
+                
+                req_size = sum(iov.nbytes for iov in iovs)
+                got = os.preadv(fd, iovs, file_offset) if hasattr(os, 'preadv') else self._pread_into(fd, iovs, file_offset)
+                n_reqs += 1
+                if got < req_size:
+                    # Short read (e.g. file still being written) - retry the rest
+                    got += self._scatter(self._read(fd, req_size - got, file_offset + got), iovs, got)
+                got_nbytes += got
+                if got < req_size:
+                    raise IOError(f'bigdata read got {got} of {req_size} bytes at offset {file_offset} (fd {fd})')
         
         en = time.monotonic()
-        sum_read_nbytes = memoryview(chunk).nbytes # for prometheus counter
-        rate = 0
-        if sum_read_nbytes > 0:
-            rate = (sum_read_nbytes/1e6)/(en-st)
-        logger.debug(f"bd reads chunk {sum_read_nbytes/1e6:.5f} MB took {en-st:.2f} s (Rate: {rate:.2f} MB/s)")
-        self._inc_prometheus_counter('MB', sum_read_nbytes/1e6)
+        logger.debug(f"bd readv {got_nbytes/1e6:.5f} MB in {n_reqs} requests ({gap_nbytes/1e6:.5f} MB gaps) took {en-st:.2f} s")
+        self._inc_prometheus_counter('MB', got_nbytes/1e6)
         self._inc_prometheus_counter('seconds', en-st)
-        return chunk
+        self._inc_prometheus_counter('requests', n_reqs)
+        self._inc_prometheus_counter('gap_MB', gap_nbytes/1e6)
+        return int(np.sum(sizes))
+
+    def _pread_into(self, fd, iovs, offset):
+        """ Fallback for platforms without preadv """
+        return self._scatter(os.pread(fd, sum(iov.nbytes for iov in iovs), offset), iovs, 0)
+
+    def _scatter(self, chunk, iovs, skip):
+        """ Copies chunk into iovs, skipping the first skip bytes of iovs."""
+        chunk = memoryview(chunk)
+        pos = 0
+        for iov in iovs:
+            if skip >= iov.nbytes:
+                skip -= iov.nbytes
+                continue
+            n = min(iov.nbytes - skip, chunk.nbytes - pos)
+            iov[skip: skip + n] = chunk[pos: pos + n]
+            pos += n
+            skip = 0
+            if pos == chunk.nbytes: break
+        return pos
 
     def _fill_bd_bufs(self):
         """
         Fill self.bigdatas 
         1) If use_smd is set for this file, no filling.
         2) For others,
-            - Ignore all transitions
-            - Identify how many times do we need to read
-              From cutoff_flag_array[:, i_smd], we get cutoff_indices as
-              [0, 1, 2, 12, 13, 18, 19] a list of index to where each read or copy will happen.
+            - Ignore all transitions except SlowUpdates that switch to
+              a new bigdata chunk file.
+            - Read all L1Accept dgrams between chunk switches back-to-back
+              into one preallocated buffer (see _readv).
+            - With memory-mapped files (dm.mmaps), nothing is read. The map
+              of each chunk file is kept in bd_maps[i_smd] and events point 
+              to theirs with bd_map_ids.
         """
         self.bd_bufs = [None] * self.n_smd_files
         self.bd_buf_offsets = np.zeros(self.n_smd_files, dtype=np.int64)
+        self.bd_maps = [None] * self.n_smd_files
+        self.bd_map_ids = np.zeros((self.n_events, self.n_smd_files), dtype=np.int64)
+        is_L1 = self.services == TransitionId.L1Accept
         for i_smd in range(self.n_smd_files):
             # Skip copy and read if smd was replaced with bigdata
             if self.use_smds[i_smd]: continue
 
-            bd_buf = bytearray()
-            cutoff_indices = np.where(self.cutoff_flag_array[:, i_smd] == 1)[0]
-            for cn_i, i_evt_cutoff in enumerate(cutoff_indices):
-                # Check in case we need to switch to the next bigdata chunk file
-                if self.services[i_evt_cutoff] != TransitionId.L1Accept:
-                    if self.new_chunk_id_array[i_evt_cutoff, i_smd] != 0:
-                        self._open_new_bd_file(i_smd, self.new_chunk_id_array[i_evt_cutoff, i_smd])
-                else:
-                    begin_chunk_offset = self.bd_offset_array[i_evt_cutoff, i_smd]
-                    if cn_i == cutoff_indices.shape[0] - 1:
-                        read_size = np.sum(self.bd_size_array[i_evt_cutoff:, i_smd])
-                    else:
-                        i_next_evt_cutoff = cutoff_indices[cn_i + 1]
-                        read_size = np.sum(self.bd_size_array[i_evt_cutoff:i_next_evt_cutoff, i_smd])
-                    bd_buf.extend(self._read(self.dm.fds[i_smd], read_size, begin_chunk_offset))
+            offsets = self.bd_offset_array[:, i_smd]
+            sizes = self.bd_size_array[:, i_smd]
+            new_chunk_ids = self.new_chunk_id_array[:, i_smd]
+            use_mmap = len(self.dm.mmaps) > 0
+            if use_mmap:
+                self.bd_maps[i_smd] = []
+            else:
+                bd_buf = bytearray(int(np.sum(sizes[is_L1])))
+            buf_offset = 0
+            
+            # Check in case we need to switch to the next bigdata chunk file
+            switch_evts = np.nonzero(~is_L1 & (new_chunk_ids != 0))[0]
+            i_st = 0
+            for i_switch in np.append(switch_evts, self.n_events):
+                selected = np.arange(i_st, i_switch)
+                selected = selected[is_L1[selected] & (sizes[selected] > 0)]
+                if use_mmap:
+                    self.bd_map_ids[i_st:i_switch, i_smd] = len(self.bd_maps[i_smd])
+                    self.bd_maps[i_smd].append(self._get_bd_map(i_smd, offsets[selected], sizes[selected]))
+                elif selected.shape[0] > 0:
+                    buf_offset += self._readv(self.dm.fds[i_smd], offsets[selected], sizes[selected], bd_buf, buf_offset)
+                if i_switch < self.n_events:
+                    self._open_new_bd_file(i_smd, new_chunk_ids[i_switch])
+                i_st = i_switch + 1
+
+            if use_mmap: continue
+
+            # Hint the range after this batch (same span) for the next batch
+            if self.bd_readahead and selected.shape[0] > 0:
+                end = int(offsets[selected[-1]] + sizes[selected[-1]])
+                span = end - int(offsets[selected[0]])
+                os.posix_fadvise(self.dm.fds[i_smd], end, span, os.POSIX_FADV_WILLNEED)
+            
             self.bd_bufs[i_smd] = bd_buf
     
+    def _get_bd_map(self, i_smd, offsets, sizes):
+        """ Returns memory map of the current bigdata file of this stream. 
+        The file is remapped if it has grown past the mapped size."""
+        mm = self.dm.mmaps[i_smd]
+        if offsets.shape[0] == 0:
+            return mm
+        end = int(np.max(offsets + sizes))
+        if mm is None or end > len(mm):
+            mm = self.dm.mmaps[i_smd] = self.dm.map_file(self.dm.fds[i_smd])
+        if mm is None or end > len(mm):
+            raise IOError(f'bigdata range ends at {end} bytes, beyond end of {self.dm.xtc_files[i_smd]}')
+        self._inc_prometheus_counter('MB', np.sum(sizes)/1e6)
+        return mm
+
     def _get_next_evt(self):
         """ Generate bd evt for different cases:
         1) No bigdata or Transition Event
             create dgrams from smd_view
         2) L1Accept event
-            create dgrams from bd_bufs
+            create dgrams from bd_bufs (or directly on memory-mapped files)
         3) L1Accept with some smd files replaced by bigdata files
             create dgram from smd_view if use_smds[i_smd] is set
             otherwise create dgram from bd_bufs
@@ -231,6 +387,11 @@ class EventManager(object):
                 view = self.smd_view
                 offset = self.smd_offset_array[self.i_evt, i_smd]
                 size = self.smd_size_array[self.i_evt, i_smd]
+            elif self.bd_maps[i_smd] is not None:
+                # Memory-mapped file: offset is the location on disk
+                view = self.bd_maps[i_smd][self.bd_map_ids[self.i_evt, i_smd]]
+                offset = self.bd_offset_array[self.i_evt, i_smd]
+                size = self.bd_size_array[self.i_evt, i_smd] 
             else:
                 view = self.bd_bufs[i_smd]
                 # This is the offset of bd buffer! and not what stored in smd dgram,
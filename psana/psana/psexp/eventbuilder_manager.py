@@ -8,12 +8,14 @@ class EventBuilderManager(object):
         self.batch_size     = dsparms.batch_size
         self.filter_fn      = dsparms.filter
         self.destination    = dsparms.destination
+        self.dsparms        = dsparms
         self.run            = run
         self.n_files        = len(self.configs)
 
         pf                  = PacketFooter(view=view)
         views               = pf.split_packets()
         self.eb             = EventBuilder(views, self.configs)
+        self.eb.set_selection(dsparms.timestamps, dsparms.ts_range, dsparms.stride, dsparms.n_l1_seen)
         self.c_filter       = PrometheusManager.get_metric('psana_eb_filter')
 
     def batches(self):
@@ -26,6 +28,7 @@ class EventBuilderManager(object):
                     run                 = self.run) 
             self.min_ts = self.eb.min_ts
             self.max_ts = self.eb.max_ts
+            self.dsparms.n_l1_seen = self.eb.n_l1_seen
             if self.eb.nevents==0 and self.eb.nsteps==0: break
             yield batch_dict, step_dict
 
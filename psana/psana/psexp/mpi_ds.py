@@ -173,7 +173,8 @@ class MPIDataSource(DataSourceBase):
         
         self._setup_configs()
         self.dm = DgramManager(self.xtc_files, configs=self._configs,
-                found_xtc2_callback=super().found_xtc2_callback)
+                found_xtc2_callback=super().found_xtc2_callback,
+                use_mmap=(nodetype == 'bd' and self.dsparms.bd_access == 'mmap'))
         
         if nodetype == 'smd0':
             self.smd0 = Smd0(self.comms, self._configs, self.smdr_man, self.dsparms)
@@ -224,7 +225,7 @@ class MPIDataSource(DataSourceBase):
         else: 
             self.dsparms.calibconst = None
 
-        self.dsparms.calibconst = self.comms.psana_comm.bcast(self.dsparms.calibconst, root=0)
+        self.dsparms.calibconst = self.comms.bcast_calibconst(self.dsparms.calibconst)
 
     def _start_run(self):
         if self._setup_beginruns():   # try to get next run from current files
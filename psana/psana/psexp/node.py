@@ -2,7 +2,9 @@ from sys import byteorder
 import numpy as np
 from psana.psexp import *
 from psana.dgram import Dgram
+from psana.smdparser import index_smd
 import os
+import weakref
 
 from psana.psexp.tools import mode
 if mode == 'mpi':
@@ -52,6 +54,9 @@ class Communicators(object):
     color = 0
     _nodetype = None
     bd_comm = None
+    node_comm = None
+    node_rank = 0
+    node_leader_comm = None
 
 
     def __init__(self):
@@ -64,6 +69,12 @@ class Communicators(object):
         PS_EB_NODES = int(os.environ.get('PS_EB_NODES', 1))
         self.n_smd_nodes = PS_EB_NODES
 
+        # No. of in-flight (non-blocking) sends allowed on Smd0 and EventBuilder 
+        # nodes. With depth > 0, EventBuilder and BigData nodes also request 
+        # the next chunk before they start working on the current one.
+        # Default (0) uses blocking sends and request-after-done.
+        self.pipeline_depth = int(os.environ.get('PS_PIPELINE_DEPTH', 0))
+
         if (self.world_size - PS_SRV_NODES) < 3:
             raise Exception('Too few MPI cores to run parallel psana.'
                             '\nYou need 3 + #PS_SRV_NODES (currently: %d)'
@@ -105,6 +116,17 @@ class Communicators(object):
             self._nodetype = 'smd0'
         elif self.world_rank>=self.psana_group.Get_size():
             self._nodetype = 'srv'
+
+        # With PS_CALIB_SHMEM=1 psana ranks on the same host share one copy of
+        # calibration constants (see bcast_calibconst). Psana rank 0 is rank 0
+        # of its node_comm and of node_leader_comm (one rank per host).
+        self.calib_shmem = int(os.environ.get('PS_CALIB_SHMEM', 0))
+        self._calib_wins = []
+        if self.calib_shmem and self.psana_comm != MPI.COMM_NULL:
+            psana_rank = self.psana_comm.Get_rank()
+            self.node_comm = self.psana_comm.Split_type(MPI.COMM_TYPE_SHARED, key=psana_rank)
+            self.node_rank = self.node_comm.Get_rank()
+            self.node_leader_comm = self.psana_comm.Split(0 if self.node_rank == 0 else MPI.UNDEFINED, psana_rank)
     
 
     def bd_group(self):
@@ -119,6 +141,104 @@ class Communicators(object):
         return self._nodetype
 
 
+    def bcast_calibconst(self, calibconst):
+        """ Broadcasts calibconst of psana rank 0 to all psana ranks.
+
+        By default calibconst is pickled to every rank. With PS_CALIB_SHMEM=1
+        numpy arrays of the constants are sent once per host into an MPI
+        shared-memory window and every rank gets read-only views of it.
+        A window is freed at a later call once arrays of its constants are
+        not referenced on any rank of the host, see _free_calib_wins.
+        """
+        if not self.calib_shmem:
+            return self.psana_comm.bcast(calibconst, root=0)
+
+        self._free_calib_wins()
+
+        # Constants without arrays (placeholders) are small enough to pickle
+        layout = None
+        arrays = []
+        nbytes = 0
+        if self.psana_comm.Get_rank() == 0 and calibconst:
+            layout = {}
+            for det_name, det_calibconst in calibconst.items():
+                if not det_calibconst:
+                    layout[det_name] = det_calibconst
+                    continue
+                layout[det_name] = {}
+                for ctype, (data, doc) in det_calibconst.items():
+                    if isinstance(data, np.ndarray) and not data.dtype.hasobject:
+                        arrays.append((nbytes, data))
+                        data = SharedArray(nbytes, data.shape, data.dtype)
+                        nbytes += -(-data.nbytes // SHM_ALIGN) * SHM_ALIGN
+                    layout[det_name][ctype] = (data, doc)
+        else:
+            layout = calibconst
+        layout, nbytes = self.psana_comm.bcast((layout, nbytes), root=0)
+        if nbytes == 0:
+            return layout
+
+        win = MPI.Win.Allocate_shared(nbytes if self.node_rank == 0 else 0, 1, comm=self.node_comm)
+        buf, _ = win.Shared_query(0)
+        shm = np.frombuffer(buf, dtype=np.uint8, count=nbytes)
+        # views of the constants keep shm alive (their base)
+        self._calib_wins.append((win, weakref.ref(shm)))
+        win.Fence()
+        if self.node_rank == 0:
+            for offset, data in arrays:
+                shm[offset: offset + data.nbytes] = np.ascontiguousarray(data).reshape(-1).view(np.uint8)
+            if self.node_leader_comm.Get_size() > 1:
+                self.node_leader_comm.Bcast([shm, nbytes, MPI.BYTE], root=0)
+        win.Fence()
+
+        for det_calibconst in layout.values():
+            if not det_calibconst: continue
+            for ctype, (data, doc) in det_calibconst.items():
+                if isinstance(data, SharedArray):
+                    det_calibconst[ctype] = (data.view(shm), doc)
+        return layout
+
+
+    def _free_calib_wins(self):
+        """ Frees shared-memory windows whose arrays are not used on any rank of the host.
+
+        Win.Free is collective over node_comm, so ranks agree on the windows to
+        free. Windows still referenced anywhere are kept until a later call or
+        the end of the process.
+        """
+        if not self._calib_wins:
+            return
+        used = np.array([ref() is not None for _, ref in self._calib_wins], dtype=np.int32)
+        self.node_comm.Allreduce(MPI.IN_PLACE, used, op=MPI.MAX)
+        wins = []
+        for (win, ref), in_use in zip(self._calib_wins, used):
+            if in_use:
+                wins.append((win, ref))
+            else:
+                win.Free()
+        self._calib_wins = wins
+
+
+# Offsets of arrays in the calibration constants window are cache-line aligned
+SHM_ALIGN = 64
+
+class SharedArray(object):
+    """ Placeholder for an array at offset of a shared-memory window """
+    def __init__(self, offset, shape, dtype):
+        self.offset = offset
+        self.shape  = shape
+        self.dtype  = np.dtype(dtype)
+
+    @property
+    def nbytes(self):
+        return int(np.prod(self.shape, dtype=np.int64)) * self.dtype.itemsize
+
+    def view(self, shm):
+        arr = shm[self.offset: self.offset + self.nbytes].view(self.dtype).reshape(self.shape)
+        arr.setflags(write=False)
+        return arr
+
+
 
 class StepHistory(object):
     """ Keeps step data and their send history. """
@@ -176,6 +296,45 @@ class StepHistory(object):
                     self.send_history[indexed_id][i] = current_buf_size
         return views
 
+class IsendPool(object):
+    """ Keeps up to max_sends non-blocking sends in flight. 
+    
+    Each slot holds an MPI request and a reference to the sent buffer so 
+    that the buffer stays alive (and unmodified) until the send completes."""
+    def __init__(self, comm, max_sends):
+        self.comm = comm
+        self.max_sends = max_sends
+        self.reqs = [MPI.REQUEST_NULL] * max_sends
+        self.bufs = [None] * max_sends
+        self.wait_time = 0
+
+    def get_slot(self):
+        """ Returns index of a free slot. Waits for the first in-flight
+        send to complete if all slots are taken."""
+        for i, req in enumerate(self.reqs):
+            if req == MPI.REQUEST_NULL:
+                return i
+        st = time.monotonic()
+        i = MPI.Request.Waitany(self.reqs)
+        self.wait_time += time.monotonic() - st
+        self.reqs[i] = MPI.REQUEST_NULL
+        self.bufs[i] = None
+        return i
+
+    def isend(self, buf, dest, slot=None):
+        if slot is None:
+            slot = self.get_slot()
+        self.bufs[slot] = buf
+        self.reqs[slot] = self.comm.Isend(buf, dest=dest)
+
+    def waitall(self):
+        st = time.monotonic()
+        MPI.Request.Waitall(self.reqs)
+        self.wait_time += time.monotonic() - st
+        self.reqs = [MPI.REQUEST_NULL] * self.max_sends
+        self.bufs = [None] * self.max_sends
+
+
 def repack_for_bd(smd_batch, step_views, configs, client=-1):
     """ EventBuilder Node uses this to prepend missing step views 
     to the smd_batch. This output chunk contains list of pre-built events."""
@@ -229,14 +388,44 @@ class Smd0(object):
         self.comms = comms
         self.smdr_man = smdr_man
         self.configs = configs
+        self.dsparms = dsparms
         self.step_hist = StepHistory(self.comms.smd_size, len(self.configs))
         
         # Collecting Smd0 performance using prometheus
         self.c_sent = dsparms.prom_man.get_metric('psana_smd0_sent')
+        self.c_view = dsparms.prom_man.get_metric('psana_smd0_view')
+
+        # Pipelined mode: each in-flight send owns one SmdReader send buffer
+        self.send_pool = None
+        if self.comms.pipeline_depth > 0:
+            self.send_pool = IsendPool(self.comms.smd_comm, self.comms.pipeline_depth)
         
+    def _count_l1(self):
+        """ Returns no. of L1Accepts in the current chunk that pass the
+        timestamps and ts_range selections (counted for stride)."""
+        l1_ts = []
+        for i in range(self.smdr_man.n_files):
+            index = index_smd(self.smdr_man.smdr.show(i))
+            l1_ts.append(index['timestamp'][index['service'] == TransitionId.L1Accept])
+        l1_ts = np.unique(np.concatenate(l1_ts))
+        if self.dsparms.timestamps is not None:
+            l1_ts = l1_ts[np.isin(l1_ts, np.asarray(self.dsparms.timestamps, dtype=np.uint64))]
+        if self.dsparms.ts_range is not None:
+            l1_ts = l1_ts[(l1_ts >= self.dsparms.ts_range[0]) & (l1_ts <= self.dsparms.ts_range[1])]
+        return l1_ts.shape[0]
+
+    def _send_l1_count(self, dest_rank):
+        """ With stride, every message to an EventBuilder node is preceded by
+        the no. of L1Accepts of the run before it so that the stride is
+        counted over the whole run for any no. of EventBuilder nodes."""
+        if self.dsparms.stride > 1:
+            self.comms.smd_comm.Send(np.array([self.n_l1_seen], dtype=np.int64), dest=dest_rank)
+
     def start(self):
         rankreq = np.empty(1, dtype='i')
         waiting_ebs = []
+        i_buf = 0
+        self.n_l1_seen = 0
 
         # Indentify viewing windows. SmdReaderManager has starting index and block size
         # that it needs to share later when data are packaged for sending to EventBuilders.
@@ -257,11 +446,21 @@ class Smd0(object):
             self.step_hist.extend_buffers(step_views, rankreq[0])
             logger.debug(f'RANK{self.comms.world_rank} 2.2 SMD0GOTSTEP {time.monotonic()}')
 
-            repack_smd = self.smdr_man.smdr.repack_parallel(missing_step_views)
+            if self.send_pool:
+                i_buf = self.send_pool.get_slot()
+            repack_smd = self.smdr_man.smdr.repack_parallel(missing_step_views, i_buf=i_buf)
+            self.c_view.labels('seconds', 'repack').inc(self.smdr_man.smdr.last_repack_time)
+
+            self._send_l1_count(rankreq[0])
+            if self.dsparms.stride > 1:
+                self.n_l1_seen += self._count_l1()
             
             logger.debug(f'RANK{self.comms.world_rank} 3. SMD0GOTREPACK {time.monotonic()}')
             
-            self.comms.smd_comm.Send(repack_smd, dest=rankreq[0])
+            if self.send_pool:
+                self.send_pool.isend(repack_smd, rankreq[0], slot=i_buf)
+            else:
+                self.comms.smd_comm.Send(repack_smd, dest=rankreq[0])
             
             logger.debug(f'RANK{self.comms.world_rank} 4. SMD0DONEWITHEB{rankreq[0]} {time.monotonic()}')
         
@@ -279,22 +478,31 @@ class Smd0(object):
         
         # end for (smd_chunk, step_chunk)
 
+        # Send buffers are reused below - all in-flight sends must be done
+        if self.send_pool:
+            self.send_pool.waitall()
+            self.c_sent.labels('seconds', 'isend_wait').inc(self.send_pool.wait_time)
+            logger.debug(f'node: smd0 waited {self.send_pool.wait_time:.5f} seconds for in-flight sends')
+
         # check if there are missing steps to be sent 
         for i in range(self.comms.n_smd_nodes):
             self.comms.smd_comm.Recv(rankreq, source=MPI.ANY_SOURCE)
             missing_step_views = self.step_hist.get_buffer(rankreq[0], smd0=True)
             repack_smd = self.smdr_man.smdr.repack_parallel(missing_step_views, only_steps=1)
             if memoryview(repack_smd).nbytes > 0:
+                self._send_l1_count(rankreq[0])
                 self.comms.smd_comm.Send(repack_smd, dest=rankreq[0])
             else:
                 waiting_ebs.append(rankreq[0])
         
         # kill waiting bd nodes
         for dest_rank in waiting_ebs:
+            self._send_l1_count(dest_rank)
             self.comms.smd_comm.Send(bytearray(), dest=dest_rank)
 
         for i in range(self.comms.n_smd_nodes-len(waiting_ebs)):
             self.comms.smd_comm.Recv(rankreq, source=MPI.ANY_SOURCE)
+            self._send_l1_count(rankreq[0])
             self.comms.smd_comm.Send(bytearray(), dest=rankreq[0])
     
 
@@ -311,6 +519,9 @@ class EventBuilderNode(object):
         self.step_hist  = StepHistory(self.comms.bd_size, len(self.configs))
         # Collecting Smd0 performance using prometheus
         self.c_sent     = dsparms.prom_man.get_metric('psana_eb_sent')
+        self.send_pool  = None
+        if self.comms.pipeline_depth > 0:
+            self.send_pool = IsendPool(self.comms.bd_comm, self.comms.pipeline_depth)
 
 
     def pack(self, *args):
@@ -323,12 +534,19 @@ class EventBuilderNode(object):
         return batch
 
 
+    def _send(self, batch, dest_rank):
+        """ Sends a batch to a bigdata node. Batches are new objects for 
+        every send so in pipelined mode they can be sent without copying."""
+        if self.send_pool:
+            self.send_pool.isend(batch, dest_rank)
+        else:
+            self.comms.bd_comm.Send(batch, dest=dest_rank)
+
     def _send_to_dest(self, dest_rank, smd_batch_dict, step_batch_dict, eb_man):
-        bd_comm = self.comms.bd_comm
         smd_batch, _ = smd_batch_dict[dest_rank]
         missing_step_views = self.step_hist.get_buffer(dest_rank)
         batch = repack_for_bd(smd_batch, missing_step_views, self.configs, client=dest_rank)
-        bd_comm.Send(batch, dest=dest_rank)
+        self._send(batch, dest_rank)
         del smd_batch_dict[dest_rank] # done sending
         
         step_batch, _ = step_batch_dict[dest_rank]
@@ -344,11 +562,19 @@ class EventBuilderNode(object):
         self.c_sent.labels('seconds',rankreq[0]).inc(en_req-st_req)
         logger.debug("node: eb%d got bd %d (request took %.5f seconds)"%(self.comms.smd_rank, rankreq[0], (en_req-st_req)))
 
-    @s_eb_wait_smd0.time()
-    def _request_data(self, smd_comm):
+    def _send_request(self, smd_comm):
         logger.debug(f'RANK{self.comms.world_rank} 5. EB{self.comms.world_rank}SENDREQTOSMD0 {time.monotonic()}')
         smd_comm.Send(np.array([self.comms.smd_rank], dtype='i'), dest=0)
         logger.debug(f'RANK{self.comms.world_rank} 6. EB{self.comms.world_rank}DONESENDREQ {time.monotonic()}')
+
+    @s_eb_wait_smd0.time()
+    def _request_data(self, smd_comm, send_request=True):
+        if send_request:
+            self._send_request(smd_comm)
+        if self.dsparms.stride > 1: # L1Accepts of the run before this chunk (see Smd0)
+            n_l1_seen = np.empty(1, dtype=np.int64)
+            smd_comm.Recv(n_l1_seen, source=0)
+            self.dsparms.n_l1_seen = int(n_l1_seen[0])
         info = MPI.Status()
         smd_comm.Probe(source=0, status=info)
         count = info.Get_elements(MPI.BYTE)
@@ -365,12 +591,21 @@ class EventBuilderNode(object):
         bd_comm    = self.comms.bd_comm
         smd_rank   = self.comms.smd_rank
         waiting_bds   = []
+        pipelined     = self.send_pool is not None
         
+        if pipelined:
+            self._send_request(smd_comm)
+
         while True:
-            smd_chunk = self._request_data(smd_comm)
+            # In pipelined mode, the request for this chunk was already sent 
+            smd_chunk = self._request_data(smd_comm, send_request=not pipelined)
             if not smd_chunk:
                 break
 
+            # Ask for the next chunk so that Smd0 can prepare it while we build
+            if pipelined:
+                self._send_request(smd_comm)
+
             eb_man = EventBuilderManager(smd_chunk, self.configs, self.dsparms, self.dm.get_run())
             logger.debug(f'RANK{self.comms.world_rank} 8. EB{self.comms.world_rank}DONEBUILDINGEVENTS {time.monotonic()}')
         
@@ -395,7 +630,7 @@ class EventBuilderNode(object):
                     missing_step_views = self.step_hist.get_buffer(rankreq[0])
                     batch = repack_for_bd(smd_batch, missing_step_views, self.configs, client=rankreq[0])
                     logger.debug(f'RANK{self.comms.world_rank} 11. EB{self.comms.world_rank}SENDDATATOBD{rankreq[0]+1} {time.monotonic()}')
-                    bd_comm.Send(batch, dest=rankreq[0])
+                    self._send(batch, rankreq[0])
                     logger.debug(f'RANK{self.comms.world_rank} 12. EB{self.comms.world_rank}DONESENDDATATOBD{rankreq[0]+1} {time.monotonic()}')
                     
                     # sending data to prometheus
@@ -440,6 +675,10 @@ class EventBuilderNode(object):
             # end for smd_batch_dict in ...
             logger.debug(f'RANK{self.comms.world_rank} 12.1 EB{self.comms.world_rank}DONEALLBATCHES {time.monotonic()}')
 
+        if self.send_pool:
+            self.send_pool.waitall()
+            self.c_sent.labels('seconds', 'isend_wait').inc(self.send_pool.wait_time)
+
         # Check if any of the waiting bds need missing steps from the last batch
         copied_waiting_bds = waiting_bds[:]
         for dest_rank in copied_waiting_bds:
@@ -495,12 +734,20 @@ class BigDataNode(object):
 
     def start(self):
         
-        def get_smd():
-            bd_comm = self.comms.bd_comm
-            bd_rank = self.comms.bd_rank
+        pipelined = self.comms.pipeline_depth > 0
+        req_sent = False
+
+        def send_request():
             logger.debug(f'RANK{self.comms.world_rank} 13. BD{self.comms.world_rank}SENDREQTOEB {time.monotonic()}')
-            bd_comm.Send(np.array([bd_rank], dtype='i'), dest=0)
+            self.comms.bd_comm.Send(np.array([self.comms.bd_rank], dtype='i'), dest=0)
             logger.debug(f'RANK{self.comms.world_rank} 14. BD{self.comms.world_rank}DONESENDREQTOEB {time.monotonic()}')
+
+        def get_smd():
+            nonlocal req_sent
+            bd_comm = self.comms.bd_comm
+            if not req_sent:
+                send_request()
+            req_sent = False
             info = MPI.Status()
             bd_comm.Probe(source=0, tag=MPI.ANY_TAG, status=info)
             count = info.Get_elements(MPI.BYTE)
@@ -510,6 +757,12 @@ class BigDataNode(object):
             logger.debug(f'RANK{self.comms.world_rank} 15. BD{self.comms.world_rank}RECVDATA {time.monotonic()}')
             en_req = time.monotonic()
             self.bd_wait_eb.labels('seconds', self.comms.world_rank).inc(en_req - st_req)
+
+            # Pre-request the next batch so that it is on its way while this
+            # one is processed. No request after the (empty) end-of-data reply.
+            if pipelined and chunk:
+                send_request()
+                req_sent = True
             return chunk
         
         events = Events(self.configs, self.dm, self.dsparms, 
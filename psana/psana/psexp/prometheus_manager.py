@@ -9,15 +9,19 @@ PUSH_GATEWAY        = 'psdm03:9091'
 
 registry = CollectorRegistry()
 metrics ={
-        'psana_smd0_read'       : ('Counter', 'Counting no. of events/batches/MB read by Smd0'), 
+        'psana_smd0_read'       : ('Counter', 'Counting no. of events/batches/MB read by Smd0   \
+                                    (endpoint prefetch_read/prefetch_wait are read and  \
+                                    wait times with PS_SMD_PREFETCH)'), 
         'psana_smd0_sent'       : ('Counter', 'Counting no. of events/batches/MB and wait time  \
                                     communicating with EventBuilder cores'), 
+        'psana_smd0_view'       : ('Counter', 'time spent (s) by Smd0 in SmdReader (endpoint is \
+                                    search, view, or repack)'),
         'psana_eb_sent'         : ('Counter', 'Counting no. of events/batches/MB and wait time  \
                                     communicating with BigData cores'),
         'psana_eb_filter'       : ('Counter', 'Counting no. of batches and wait time            \
                                     in filter callback'), 
         'psana_eb_wait_smd0'    : ('Summary', 'time spent (s) waiting for Smd0'),
-        'psana_bd_read'         : ('Counter', 'Counting no. of events processed by BigData'),
+        'psana_bd_read'         : ('Counter', 'Counting no. of events, MB, read requests and gap MB of BigData reads'),
         'psana_bd_just_read'    : ('Summary', 'time spent (s) reading bigdata'),
         'psana_bd_gen_smd_batch': ('Summary', 'time spent (s) creating a batch of smd events'),
         'psana_bd_gen_evt'      : ('Summary', 'time spent (s) creating an evt'),
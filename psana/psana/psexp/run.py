@@ -10,6 +10,7 @@ import psana.pscalib.calib.MDBWebUtils as wu
 from psana.detector.detector_impl import MissingDet
 from psana.event import Event
 from psana.psexp import *
+from psana.psexp.smd_index import IndexedEvents
 
 
 class DetectorNameError(Exception): pass
@@ -64,6 +65,7 @@ class Run(object):
     
     def __init__(self, ds):
         self.dsparms = ds.dsparms
+        self.dsparms.n_l1_seen = 0 # stride counts L1Accepts of each run
         self.c_ana   = self.dsparms.prom_man.get_metric('psana_bd_ana')
         if hasattr(ds, "dm"): ds.dm.set_run(self)
         if hasattr(ds, "smdr_man"): ds.smdr_man.set_run(self)
@@ -276,8 +278,17 @@ class RunSerial(Run):
         self.configs   = ds._configs
         super()._get_runinfo()
         super()._setup_envstore()
-        self._evt_iter = Events(self.configs, ds.dm, ds.dsparms, 
-                filter_callback=ds.dsparms.filter, smdr_man=ds.smdr_man)
+        if ds.smd_index_obj is not None:
+            positions = ds.smd_index_obj.select(after_ts=run_evt.timestamp, 
+                    start_ts=ds.start_ts, evt_range=ds.evt_range, 
+                    max_events=ds.dsparms.max_events,
+                    rank=ds.index_rank, size=ds.index_size,
+                    timestamps=ds.timestamps, ts_range=ds.ts_range, stride=ds.stride)
+            self._evt_iter = IndexedEvents(ds.smd_index_obj, positions, self.configs, 
+                    ds.dm, ds.smd_fds, ds.dsparms, filter_callback=ds.dsparms.filter)
+        else:
+            self._evt_iter = Events(self.configs, ds.dm, ds.dsparms, 
+                    filter_callback=ds.dsparms.filter, smdr_man=ds.smdr_man)
     
     def events(self):
         for evt in self._evt_iter:
@@ -299,6 +310,7 @@ class RunSerial(Run):
 class RunLegion(Run):
     def __init__(self, ds, run_evt):
         self.dsparms = ds.dsparms
+        self.dsparms.n_l1_seen = 0 # stride counts L1Accepts of each run
         self.c_ana   = self.dsparms.prom_man.get_metric('psana_bd_ana')
         RunHelper(self)
         self._evt       = run_evt
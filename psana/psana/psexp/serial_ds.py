@@ -2,6 +2,7 @@ from psana.psexp import RunSerial, DataSourceBase
 from psana.psexp import Events, TransitionId, SmdReaderManager
 from psana.event import Event
 from psana.dgrammanager import DgramManager
+from psana.psexp.smd_index import SmdIndex
 import numpy as np
 import os
 from psana.smalldata import SmallData
@@ -16,6 +17,7 @@ class SerialDataSource(DataSourceBase):
         super()._setup_runnum_list()
         self.runnum_list_index = 0
         self.smd_fds = None
+        self.beginruns = None
         
         self.smalldata_obj = SmallData(**self.smalldata_kwargs)
         self._setup_run()
@@ -44,14 +46,23 @@ class SerialDataSource(DataSourceBase):
         super()._apply_detector_selection()
         self._setup_configs()
         self.dm = DgramManager(self.xtc_files, configs=self._configs, 
-                found_xtc2_callback=super().found_xtc2_callback)
+                found_xtc2_callback=super().found_xtc2_callback,
+                use_mmap=(self.dsparms.bd_access == 'mmap'))
+        self.smd_index_obj = None
+        if self.smd_index:
+            self.smd_index_obj = SmdIndex(self.smd_files)
         return True
     
     def _setup_beginruns(self):
         """ Determines if there is a next run as
         1) New run found in the same smalldata files
         2) New run found in the new smalldata files
+        With smd index, the run ends at EndRun of the index (one run per files).
         """
+        if self.smd_index_obj is not None and self.beginruns is not None:
+            self.beginruns = None
+            return False
+
         dgrams = self.smdr_man.get_next_dgrams() 
         while dgrams is not None:
             if dgrams[0].service() == TransitionId.BeginRun:
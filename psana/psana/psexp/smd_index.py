@@ -0,0 +1,235 @@
+""" Sidecar index files for smd (.smd.xtc2) files.
+
+An index stores one row per dgram of an smd file: timestamp, service,
+offset and size of the dgram in the smd file, offset and size of the
+matching bigdata dgram and the bigdata chunk (-cNN) it is in. With indexes
+of all smd files of a run, events can be located without reading through
+the smd files (see SmdIndex), which allows seeking to a timestamp or an
+event range and splitting a run across ranks without Smd0.
+
+Index files are written next to the smd files (<smd file>.idx.npz) or to
+PS_SMD_INDEX_DIR if set. They are built on first use when missing or out
+of date, or ahead of time with:
+
+    python -m psana.psexp.smd_index <smd files>
+"""
+import os, sys, mmap, tempfile
+import numpy as np
+
+from psana import dgram
+from psana.event import Event
+from psana.psexp import TransitionId
+from psana.smdparser import index_smd
+
+import logging
+logger = logging.getLogger(__name__)
+
+INDEX_DTYPE = np.dtype([('timestamp', '<u8'), ('service', 'u1'), ('chunk_id', '<i4'),
+    ('smd_offset', '<i8'), ('smd_size', '<i8'), ('bd_offset', '<i8'), ('bd_size', '<i8')])
+
+def index_path(smd_file):
+    index_dir = os.environ.get('PS_SMD_INDEX_DIR', os.path.dirname(smd_file))
+    return os.path.join(index_dir, os.path.basename(smd_file) + '.idx.npz')
+
+def build_index(smd_file):
+    """ Returns index of an smd file."""
+    fd = os.open(smd_file, os.O_RDONLY)
+    try:
+        if os.fstat(fd).st_size == 0:
+            return np.zeros(0, dtype=INDEX_DTYPE)
+        mm = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+        arrays = index_smd(mm)
+        index = np.zeros(arrays['timestamp'].shape[0], dtype=INDEX_DTYPE)
+        for key in INDEX_DTYPE.names:
+            if key in arrays:
+                index[key] = arrays[key]
+
+        # Chunk id comes from the chunkinfo of SlowUpdates and stays
+        # in effect until the next one (chunk ids only increase).
+        chunk_ids = np.full(index.shape[0], -1, dtype=np.int64)
+        chunk_ids[:1] = 0
+        slowupdates = np.nonzero(arrays['needs_dgram'])[0]
+        if slowupdates.shape[0] > 0:
+            config = dgram.Dgram(file_descriptor=fd) # Configure is the first dgram
+        for i in slowupdates:
+            d = dgram.Dgram(file_descriptor=fd, config=config,
+                    offset=int(index['smd_offset'][i]), size=int(index['smd_size'][i]))
+            if hasattr(d, 'chunkinfo'):
+                _chunk_ids = [getattr(d.chunkinfo[seg_id].chunkinfo, 'chunkid') for seg_id in d.chunkinfo]
+                if _chunk_ids: chunk_ids[i] = _chunk_ids[0]
+        chunk_ids = np.maximum.accumulate(chunk_ids)
+        index['chunk_id'] = chunk_ids
+        return index
+    finally:
+        os.close(fd)
+
+def save_index(smd_file, index):
+    """ Writes the index file atomically. Returns False if it cannot be written."""
+    path = index_path(smd_file)
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, index=index, smd_size=os.path.getsize(smd_file))
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.debug(f'smd_index: cannot write {path} ({e})')
+        return False
+    return True
+
+def load_index(smd_file, build=True):
+    """ Returns index of the smd file.
+
+    The index file is used if it was built for the current size of the smd
+    file with the current INDEX_DTYPE. Otherwise the index is rebuilt (and 
+    saved) when build is set or None is returned."""
+    path = index_path(smd_file)
+    if os.path.isfile(path):
+        with np.load(path) as data:
+            if data['smd_size'] == os.path.getsize(smd_file) and data['index'].dtype == INDEX_DTYPE:
+                return data['index']
+        logger.debug(f'smd_index: {path} is out of date')
+    if not build:
+        return None
+    index = build_index(smd_file)
+    save_index(smd_file, index)
+    return index
+
+
+class SmdIndex(object):
+    """ Event table of a run built from the indexes of its smd files.
+
+    Events are dgrams with the same timestamp across smd files. For each
+    event, rows[i_evt, i_smd] is the row in the index of smd file i_smd
+    (-1 if the dgram is missing).
+    """
+    def __init__(self, smd_files, build=True):
+        self.smd_files = smd_files
+        self.indexes = [load_index(smd_file, build=build) for smd_file in smd_files]
+        if any(index is None for index in self.indexes):
+            raise FileNotFoundError(f'smd index not found for {smd_files}')
+
+        self.timestamps = np.unique(np.concatenate([index['timestamp'] for index in self.indexes]))
+        self.n_events = self.timestamps.shape[0]
+        self.rows = np.full((self.n_events, len(smd_files)), -1, dtype=np.int64)
+        self.services = np.zeros(self.n_events, dtype=np.uint8)
+        for i_smd, index in enumerate(self.indexes):
+            pos = np.searchsorted(self.timestamps, index['timestamp'])
+            self.rows[pos, i_smd] = np.arange(index.shape[0])
+            self.services[pos] = index['service']
+
+    def select(self, after_ts=0, start_ts=0, evt_range=None, max_events=0, rank=0, size=1,
+            timestamps=None, ts_range=None, stride=0):
+        """ Returns positions of events to iterate over.
+
+        L1Accepts after after_ts (e.g. BeginRun) are selected by start_ts
+        (first timestamp), timestamps, ts_range and stride (same as
+        EventBuilder.set_selection), evt_range ((start, stop) no. of 
+        L1Accepts from start_ts) and max_events then split into size 
+        contiguous parts.
+        Only part rank is returned together with all transitions up to
+        the next L1Accept after it (so that step and epics information
+        are available).
+        """
+        after = self.timestamps > after_ts
+        is_L1 = self.services == TransitionId.L1Accept
+        selected = after & is_L1 & (self.timestamps >= start_ts)
+        if timestamps is not None:
+            selected &= np.isin(self.timestamps, np.asarray(timestamps, dtype=np.uint64))
+        if ts_range is not None:
+            selected &= (self.timestamps >= ts_range[0]) & (self.timestamps <= ts_range[1])
+        l1_pos = np.nonzero(selected)[0]
+        if stride:
+            l1_pos = l1_pos[::stride]
+        if evt_range:
+            l1_pos = l1_pos[slice(*evt_range)]
+        if max_events:
+            l1_pos = l1_pos[:max_events]
+        l1_pos = np.array_split(l1_pos, size)[rank]
+
+        end = self.n_events
+        if l1_pos.shape[0] > 0:
+            next_l1 = np.nonzero(is_L1[l1_pos[-1] + 1:])[0]
+            if next_l1.shape[0] > 0:
+                end = l1_pos[-1] + 1 + next_l1[0]
+        transitions = np.nonzero(after[:end] & ~is_L1[:end])[0]
+        return np.sort(np.concatenate((transitions, l1_pos)))
+
+    def get(self, i_evt, i_smd):
+        """ Returns index row of smd file i_smd for event i_evt (None if missing)."""
+        row = self.rows[i_evt, i_smd]
+        if row < 0: return None
+        return self.indexes[i_smd][row]
+
+
+class IndexedEvents(object):
+    """ Yields events at the given positions of an SmdIndex.
+
+    Transitions (and L1Accepts of smd files in use_smds) are read from the
+    smd files, L1Accepts from the bigdata files. Transitions update the
+    EnvStore the same way EventManager does.
+    """
+    def __init__(self, smd_index, positions, configs, dm, smd_fds, dsparms, filter_callback=None):
+        self.smd_index      = smd_index
+        self.positions      = positions
+        self.configs        = configs
+        self.dm             = dm
+        self.smd_fds        = smd_fds
+        self.dsparms        = dsparms
+        self.filter_callback= filter_callback
+        self.c_read         = dsparms.prom_man.get_metric('psana_bd_read')
+        self.i              = 0
+
+    def __iter__(self):
+        return self
+
+    def _smd_dgram(self, i_smd, row):
+        return dgram.Dgram(file_descriptor=self.smd_fds[i_smd], config=self.configs[i_smd],
+                offset=int(row['smd_offset']), size=int(row['smd_size']),
+                max_retries=self.dsparms.max_retries)
+
+    def __next__(self):
+        while True:
+            if self.i == self.positions.shape[0]:
+                raise StopIteration
+            i_evt = self.positions[self.i]
+            self.i += 1
+            service = self.smd_index.services[i_evt]
+            rows = [self.smd_index.get(i_evt, i_smd) for i_smd in range(len(self.configs))]
+
+            if service != TransitionId.L1Accept or not self.filter_callback:
+                break
+            smd_dgrams = [self._smd_dgram(i_smd, row) if row is not None else None for i_smd, row in enumerate(rows)]
+            if self.filter_callback(Event(dgrams=smd_dgrams, run=self.dm.get_run())):
+                break
+
+        dgrams = [None] * len(self.configs)
+        for i_smd, row in enumerate(rows):
+            if row is None: continue
+            if service != TransitionId.L1Accept or self.dm.n_files == 0 or \
+                    self.dsparms.use_smds[i_smd] or row['bd_offset'] < 0:
+                dgrams[i_smd] = self._smd_dgram(i_smd, row)
+            else:
+                self.dm.open_chunk(i_smd, row['chunk_id'])
+                dgrams[i_smd] = self.dm.jumps(i_smd, int(row['bd_offset']), int(row['bd_size']))
+                self.c_read.labels('MB', 'None').inc(row['bd_size']/1e6)
+
+        evt = Event(dgrams=dgrams, run=self.dm.get_run())
+        if service != TransitionId.L1Accept:
+            self.dsparms.esm.update_by_event(evt)
+        else:
+            self.c_read.labels('evts', 'None').inc()
+        return evt
+
+
+def main():
+    """ Writes index files of the given smd files """
+    if len(sys.argv) < 2:
+        print('usage: python -m psana.psexp.smd_index <smd files>')
+        sys.exit(1)
+    for smd_file in sys.argv[1:]:
+        index = build_index(smd_file)
+        saved = save_index(smd_file, index)
+        print(f'{smd_file}: {index.shape[0]} dgrams {"-> " + index_path(smd_file) if saved else "(not saved)"}')
+
+if __name__ == "__main__":
+    main()
@@ -14,11 +14,12 @@ class BatchIterator(object):
 
     SmdReaderManager returns this object when a chunk is read.
     """
-    def __init__(self, views, configs, run, batch_size=1, filter_fn=0, destination=0):
+    def __init__(self, views, configs, run, batch_size=1, filter_fn=0, destination=0, dsparms=None):
         self.batch_size     = batch_size
         self.filter_fn      = filter_fn
         self.destination    = destination
         self.run            = run 
+        self.dsparms        = dsparms # for L1Accept selections (timestamps, ts_range and stride)
         
         empty_view = True
         for view in views:
@@ -30,6 +31,8 @@ class BatchIterator(object):
             self.eb = None
         else:
             self.eb = EventBuilder(views, configs)
+            if dsparms is not None:
+                self.eb.set_selection(dsparms.timestamps, dsparms.ts_range, dsparms.stride, dsparms.n_l1_seen)
 
 
     def __iter__(self):
@@ -46,6 +49,8 @@ class BatchIterator(object):
                 filter_fn=self.filter_fn, 
                 destination=self.destination,
                 run=self.run)
+        if self.dsparms is not None:
+            self.dsparms.n_l1_seen = self.eb.n_l1_seen
         if self.eb.nevents == 0 and self.eb.nsteps == 0: raise StopIteration
         return batch_dict, step_dict
 
@@ -69,8 +74,14 @@ class SmdReaderManager(object):
         self.got_events = -1
         self._run = None
         
+        # With PS_SMD_PREFETCH > 0, reads happen on a background thread.
+        # Keep the last totals so that only new read/wait times are counted.
+        self._prefetch_read_time = 0
+        self._prefetch_wait_time = 0
+        
         # Collecting Smd0 performance using prometheus
         self.c_read = self.dsparms.prom_man.get_metric('psana_smd0_read')
+        self.c_view = self.dsparms.prom_man.get_metric('psana_smd0_view')
 
     def _get(self):
         st = time.time()
@@ -80,6 +91,16 @@ class SmdReaderManager(object):
         self.c_read.labels('MB', 'None').inc(self.smdr.got/1e6)
         self.c_read.labels('seconds', 'None').inc(en-st)
         
+        if self.smdr.prefetch_depth > 0:
+            d_read = self.smdr.prefetch_read_time - self._prefetch_read_time
+            d_wait = self.smdr.prefetch_wait_time - self._prefetch_wait_time
+            self._prefetch_read_time = self.smdr.prefetch_read_time
+            self._prefetch_wait_time = self.smdr.prefetch_wait_time
+            self.c_read.labels('seconds', 'prefetch_read').inc(d_read)
+            self.c_read.labels('seconds', 'prefetch_wait').inc(d_wait)
+            logger.debug(f'smdreader_manager: prefetch read:{self._prefetch_read_time:.3f}s '
+                    f'wait:{self._prefetch_wait_time:.3f}s overlap efficiency:{self.prefetch_overlap_efficiency:.2f}')
+        
         if self.smdr.chunk_overflown > 0:
             msg = f"SmdReader found dgram ({self.smdr.chunk_overflown} MB) larger than chunksize ({self.chunksize/1e6} MB)"
             raise ValueError(msg)
@@ -136,7 +157,8 @@ class SmdReaderManager(object):
         batch_iter = BatchIterator(mmrv_bufs, self.configs, self._run, 
                 batch_size  = self.dsparms.batch_size, 
                 filter_fn   = self.dsparms.filter, 
-                destination = self.dsparms.destination)
+                destination = self.dsparms.destination,
+                dsparms     = self.dsparms)
         self.got_events = self.smdr.view_size
         self.processed_events += self.got_events
 
@@ -160,6 +182,8 @@ class SmdReaderManager(object):
 
                 #mmrv_bufs, mmrv_step_bufs = self.smdr.view(batch_size=self.smd0_n_events)
                 self.smdr.view(batch_size=self.smd0_n_events)
+                self.c_view.labels('seconds', 'search').inc(self.smdr.last_search_time)
+                self.c_view.labels('seconds', 'view').inc(self.smdr.last_view_time)
                 self.got_events = self.smdr.view_size
                 got_events = self.got_events
                 self.processed_events += self.got_events
@@ -186,7 +210,17 @@ class SmdReaderManager(object):
                 if not self.smdr.is_complete():
                     is_done = True
                     break
-            #print(f'chunks() view:{d_view:.3f} read:{d_read:.3f} tot:{d_view+d_read:.3f}') 
+
+        logger.debug(f'smdreader_manager: chunks() read:{d_read:.3f}s view:{d_view:.3f}s '
+                f'(search:{self.smdr.search_time:.3f}s) repack:{self.smdr.repack_time:.3f}s')
+
+    @property
+    def prefetch_overlap_efficiency(self):
+        """ Fraction of the prefetch read time that was hidden behind 
+        viewing, repacking and sending (1: fully overlapped, 0: no overlap)."""
+        if self._prefetch_read_time == 0:
+            return 0
+        return max(0, 1 - self._prefetch_wait_time / self._prefetch_read_time)
 
     @property
     def min_ts(self):
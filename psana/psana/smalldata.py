@@ -43,27 +43,63 @@ Analysis consists of two different process types:
 Some Notes:
   * number of servers to use is set by PS_SRV_NODES
     environment variable
+  * clients send each batch as columns (one array per
+    dataset + a mask of the events that have it, see
+    ColumnBatch) so that servers append whole columns to
+    their caches. Set PS_SMD_COLUMNAR=0 to send lists of
+    per-event dicts instead
+  * full caches are written to disk by a writer thread
+    (up to PS_SMD_WRITE_QUEUE caches per server can wait to
+    be written, 0: write in the receiving thread) while
+    the server keeps receiving into fresh caches
+  * datasets named ragged_* hold a variable no. of entries
+    per event (e.g. a list of peaks). They are stored flat:
+    all entries concatenated in <name> and the no. of
+    entries of each event (0 if missing) in <name>_lengths,
+    which is aligned with the other datasets. Offsets of
+    the events are the cumulative sum of the lengths:
+
+    lengths = f['ragged_peaks_lengths'][:]
+    offsets = np.concatenate(([0], np.cumsum(lengths)))
+    peaks_of_evt_i = f['ragged_peaks'][offsets[i]:offsets[i+1]]
+
+  * accumulators (MeanVar, Histogram, ImageSum) registered
+    with SmallData.accumulator are updated per event on the
+    clients and merged across clients (mpi reduce, which
+    is tree-structured) by SmallData.reduce_accumulators
+    and at the end of the job -- results are written with
+    save_summary
+  * columnar batches are sent as one typed buffer (see
+    BufferPacker) with MPI Send/Recv -- only the schema
+    (name, dtype and shape) of each dataset is pickled,
+    once. Set PS_SMD_BUFFERS=0 to pickle batches instead
   * if running in psana parallel mode, clients ARE
     BD nodes (they are the same processes)
-  * eventual time-stamp sorting would be doable with
-    code conceptually similar to this (but would need
-    to be optimized for performance):
+  * the joined file is not time-stamp sorted (events are
+    in the order servers received them). With
+    sort_timestamps=True, a permutation that sorts the
+    aligned datasets is saved in `timestamp_order`:
 
-    import numpy as np
     import h5py
     f = h5py.File('smalldata_test.h5')
-    ts = f['timestamp'][:]
-    tsneg = f['tsneg']
-    for i in np.argsort(ts):
-        print(tsneg[i])
+    order = f['timestamp_order'][:]
+    tsneg = f['tsneg'][:][order]
 
 """                          
 
 import os
+import copy
+import time
+import queue
+import threading
 import numpy as np
 import h5py
+from abc import ABC, abstractmethod
 from collections.abc import MutableMapping
 
+import logging
+logger = logging.getLogger(__name__)
+
 # -----------------------------------------------------------------------------
 
 from psana.psexp.tools import mode
@@ -90,12 +126,34 @@ INT_TYPES   = [int, np.int8, np.int16, np.int32, np.int64,
                int, np.uint8, np.uint16, np.uint32, np.uint64, np.uint]
 FLOAT_TYPES = [float, np.float16, np.float32, np.float64, np.float128, float]
 
+# MPI tags of messages from clients to their server (batches in a
+# typed buffer and the schema of their datasets), everything else
+# is pickled with the default tag
+BATCH_TAG  = 1
+SCHEMA_TAG = 2
+
+TIMESTAMP_ORDER = 'timestamp_order'
+
 RAGGED_PREFIX   = 'ragged_'
+RAGGED_LENGTHS_SUFFIX = '_lengths'
 UNALIGED_PREFIX = 'unaligned_'
 
 def is_unaligned(dset_name):
     return dset_name.split('/')[-1].startswith(UNALIGED_PREFIX)
 
+def is_ragged(dset_name):
+    """True for the (flat) values dataset of a ragged dataset"""
+    name = dset_name.split('/')[-1]
+    return name.startswith(RAGGED_PREFIX) and not name.endswith(RAGGED_LENGTHS_SUFFIX)
+
+def is_ragged_lengths(dset_name):
+    name = dset_name.split('/')[-1]
+    return name.startswith(RAGGED_PREFIX) and name.endswith(RAGGED_LENGTHS_SUFFIX)
+
+def is_aligned(dset_name):
+    """True for datasets with one entry per event"""
+    return not is_unaligned(dset_name) and not is_ragged(dset_name)
+
 # -----------------------------------------------------------------------------
 
 
@@ -128,11 +186,410 @@ def _get_missing_value(dtype):
     return missing_value
 
 
+def _get_dset_missing_value(dset_name, dtype):
+    # events without entries of a ragged dataset have length 0 (values
+    # of ragged datasets are never filled)
+    if is_ragged_lengths(dset_name) or is_ragged(dset_name):
+        return 0
+    return _get_missing_value(dtype)
+
+
+def _expand_ragged(event_data_dict):
+    """
+    Returns the event dict with the lengths dataset added for each
+    ragged dataset (whose data is converted to an array of entries).
+    """
+    if not any(is_ragged(dataset_name) for dataset_name in event_data_dict):
+        return event_data_dict
+    expanded = {}
+    for dataset_name, data in event_data_dict.items():
+        if is_ragged(dataset_name):
+            data = np.atleast_1d(np.asarray(data))
+            expanded[dataset_name + RAGGED_LENGTHS_SUFFIX] = np.int64(data.shape[0])
+        expanded[dataset_name] = data
+    return expanded
+
+
+def _write_timestamp_order(fh):
+    """
+    Saves the permutation that sorts the timestamp dataset of the file.
+
+    Timestamps come in sorted runs (each client batch is sorted), which
+    the stable sort (timsort) merges instead of sorting from scratch.
+    """
+    if 'timestamp' not in fh:
+        return
+    order = np.argsort(fh['timestamp'][:], kind='stable')
+    if TIMESTAMP_ORDER in fh:
+        del fh[TIMESTAMP_ORDER]
+    fh.create_dataset(TIMESTAMP_ORDER, data=order)
+    return
+
+
 def _format_srv_filename(dirname, basename, rank):
     srv_basename = '%s_part%d.h5' % (basename.strip('.h5'), rank)
     srv_fn = os.path.join(dirname, srv_basename)
     return srv_fn
 
+def _column_dtype(data):
+    """ Returns dtype of a dataset as Server.new_dset would create it
+    from the first data seen."""
+    if type(data) == int:
+        return np.dtype('i8')
+    elif type(data) == float:
+        return np.dtype('f8')
+    elif hasattr(data, 'dtype'):
+        return data.dtype
+    return None
+
+
+class ColumnBatch:
+    """
+    A batch of events stored as columns.
+
+    For each dataset, `columns[dataset_name]` is a tuple (values, mask)
+    where mask is a boolean array (one per event in the batch) that is
+    True for events that have the dataset and values is an array of the
+    data of those events only (stacked along the first axis).
+
+    Ragged datasets have their entries concatenated in values (mask is
+    None) and the no. of entries per event in the <name>_lengths column.
+    """
+
+    def __init__(self, n_events, columns):
+        self.n_events = n_events
+        self.columns  = columns
+        return
+
+    @classmethod
+    def from_events(cls, batch):
+        """
+        Converts a list of event dicts (as collected by SmallData.event)
+        to a ColumnBatch.
+        """
+        n_events = len(batch)
+        masks = {}
+        values = {}
+        for i, event_data_dict in enumerate(batch):
+            for dataset_name, data in event_data_dict.items():
+                if dataset_name not in masks:
+                    masks[dataset_name] = np.zeros(n_events, dtype=bool)
+                    values[dataset_name] = []
+                masks[dataset_name][i] = True
+                values[dataset_name].append(data)
+
+        columns = {}
+        for dataset_name, mask in masks.items():
+            data = values[dataset_name]
+            if is_ragged(dataset_name):
+                data = [np.atleast_1d(np.asarray(x)) for x in data]
+                lengths = np.array([x.shape[0] for x in data], dtype=np.int64)
+                columns[dataset_name] = (np.concatenate(data), None)
+                columns[dataset_name + RAGGED_LENGTHS_SUFFIX] = (lengths, mask)
+                continue
+            dtype = _column_dtype(data[0])
+            if dtype is None:
+                raise TypeError('Type: Dataset %s type %s not compatible' % (dataset_name, type(data[0])))
+            columns[dataset_name] = (np.asarray(data, dtype=dtype), mask)
+
+        return cls(n_events, columns)
+
+    def to_events(self):
+        """
+        Returns the list of event dicts (e.g. for Server callbacks).
+        """
+        batch = [{} for i in range(self.n_events)]
+        for dataset_name, (values, mask) in self.columns.items():
+            if is_ragged(dataset_name):
+                lengths, mask = self.columns[dataset_name + RAGGED_LENGTHS_SUFFIX]
+                offsets = np.concatenate(([0], np.cumsum(lengths)))
+                for i, st, en in zip(np.flatnonzero(mask), offsets[:-1], offsets[1:]):
+                    batch[i][dataset_name] = values[st:en].copy()
+                continue
+            if is_ragged_lengths(dataset_name):
+                continue
+            for i, data in zip(np.flatnonzero(mask), values):
+                batch[i][dataset_name] = data.copy() if data.ndim > 0 else data.item()
+        return batch
+
+
+def _padded(n_bytes):
+    return (n_bytes + 7) & ~7
+
+
+class BufferPacker:
+    """
+    Packs ColumnBatches into one contiguous uint8 buffer (client side).
+
+    Each (dataset name, dtype, shape) gets an id the first time it is
+    packed -- pack returns these new schema entries, which have to be
+    sent to the server (BufferUnpacker.update) before the buffer.
+
+    Buffer layout (all parts padded to 8 bytes):
+        [n_events, n_columns, (id, n_values, has_mask) x n_columns]  (uint64)
+        per column: [mask (n_events bytes, only if has_mask)]
+                    [values]
+    """
+
+    def __init__(self):
+        self.schema = {} # (name, dtype str, shape) -> dataset id
+        return
+
+    def pack(self, batch):
+        """
+        Returns (new_schema, buffer) or (None, None) if the batch has
+        datasets that cannot be sent as raw bytes (e.g. object dtype).
+        """
+        new_schema = {}
+        columns = []
+        n_bytes = _padded(8 * (2 + 3 * len(batch.columns)))
+        for dataset_name, (values, mask) in batch.columns.items():
+            if values.dtype.hasobject:
+                return None, None
+            key = (dataset_name, values.dtype.str, values.shape[1:])
+            if key not in self.schema:
+                self.schema[key] = len(self.schema)
+                new_schema[self.schema[key]] = key
+            has_mask = mask is not None and values.shape[0] < batch.n_events
+            columns.append((self.schema[key], values, mask, has_mask))
+            if has_mask:
+                n_bytes += _padded(batch.n_events)
+            n_bytes += _padded(values.nbytes)
+
+        buf = np.empty(n_bytes, dtype=np.uint8)
+        header = buf[:8 * (2 + 3 * len(columns))].view(np.uint64)
+        header[:2] = (batch.n_events, len(columns))
+        offset = _padded(header.nbytes)
+        for i, (dset_id, values, mask, has_mask) in enumerate(columns):
+            header[2 + 3*i: 5 + 3*i] = (dset_id, values.shape[0], has_mask)
+            if has_mask:
+                buf[offset: offset + batch.n_events] = mask
+                offset += _padded(batch.n_events)
+            buf[offset: offset + values.nbytes] = np.ascontiguousarray(values).reshape(-1).view(np.uint8)
+            offset += _padded(values.nbytes)
+
+        return new_schema, buf
+
+
+class BufferUnpacker:
+    """
+    Unpacks buffers of one client's BufferPacker into ColumnBatches
+    (server side). Values are views into the buffer (not copied).
+    """
+
+    def __init__(self):
+        self.schema = {} # dataset id -> (name, dtype str, shape)
+        return
+
+    def update(self, new_schema):
+        self.schema.update(new_schema)
+        return
+
+    def unpack(self, buf):
+        n_events, n_columns = (int(x) for x in np.frombuffer(buf, dtype=np.uint64, count=2))
+        header = np.frombuffer(buf, dtype=np.uint64, count=3 * n_columns, offset=16)
+        offset = _padded(8 * (2 + 3 * n_columns))
+        columns = {}
+        for i in range(n_columns):
+            dset_id, n_values, has_mask = (int(x) for x in header[3*i: 3*i + 3])
+            dataset_name, dtype, shape = self.schema[dset_id]
+            if has_mask:
+                mask = np.frombuffer(buf, dtype=bool, count=n_events, offset=offset)
+                offset += _padded(n_events)
+            elif is_ragged(dataset_name):
+                mask = None
+            else:
+                mask = np.ones(n_events, dtype=bool)
+            dtype = np.dtype(dtype)
+            count = n_values * int(np.prod(shape, dtype=np.int64))
+            values = np.frombuffer(buf, dtype=dtype, count=count, offset=offset).reshape((n_values,) + shape)
+            offset += _padded(values.nbytes)
+            columns[dataset_name] = (values, mask)
+        return ColumnBatch(n_events, columns)
+
+
+class Accumulator(ABC):
+    """
+    Base class of mergeable per-event accumulators.
+
+    Subclasses implement update (per event), merge (in place, with an
+    accumulator of the same kind and shape), results (dict of
+    summary datasets) and reset. update sets and reset clears the
+    updated flag (accumulators that do not track it are always
+    reduced by SmallData.done).
+    """
+
+    updated = True
+
+    @abstractmethod
+    def update(self, *args, **kwargs):
+        pass
+
+    @abstractmethod
+    def merge(self, other):
+        pass
+
+    @abstractmethod
+    def results(self):
+        pass
+
+    @abstractmethod
+    def reset(self):
+        pass
+
+    def merged(self, other):
+        """Returns a new accumulator with the data of self and other"""
+        return copy.deepcopy(self).merge(other)
+
+
+class MeanVar(Accumulator):
+    """
+    Running mean and variance (Welford) of a scalar or an array. The
+    shape is taken from the first update (shape is only used for the
+    results if there was none).
+    """
+
+    def __init__(self, shape=()):
+        self.shape = shape
+        self.reset()
+        return
+
+    def reset(self):
+        self.count = 0
+        self.mean  = np.zeros(self.shape)
+        self.m2    = np.zeros(self.shape)
+        self.updated = False
+        return
+
+    def update(self, value):
+        self.updated = True
+        if self.count == 0:
+            self.mean = np.zeros(np.shape(value))
+            self.m2   = np.zeros(np.shape(value))
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        return
+
+    def merge(self, other):
+        if other.count == 0:
+            return self
+        if self.count == 0:
+            self.count, self.mean, self.m2 = other.count, other.mean.copy(), other.m2.copy()
+            return self
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * (other.count / count)
+        self.m2 = self.m2 + other.m2 + delta**2 * (self.count * other.count / count)
+        self.count = count
+        return self
+
+    @property
+    def var(self):
+        if self.count == 0:
+            return np.full(np.shape(self.mean), np.nan)
+        return self.m2 / self.count
+
+    def results(self):
+        mean = self.mean if self.count > 0 else np.full(np.shape(self.mean), np.nan)
+        return {'count': self.count, 'mean': mean, 'var': self.var}
+
+
+class Histogram(Accumulator):
+    """
+    Histogram with n_bins fixed-width bins over value_range. Values
+    outside of the range are counted in underflow and overflow.
+    """
+
+    def __init__(self, n_bins, value_range):
+        self.n_bins = n_bins
+        self.edges  = np.linspace(value_range[0], value_range[1], n_bins + 1)
+        self.reset()
+        return
+
+    def reset(self):
+        self.counts    = np.zeros(self.n_bins, dtype=np.int64)
+        self.underflow = 0
+        self.overflow  = 0
+        self.updated   = False
+        return
+
+    def update(self, values):
+        self.updated = True
+        values = np.asarray(values).ravel()
+        lo, hi = self.edges[0], self.edges[-1]
+        inside = (values >= lo) & (values <= hi)
+        self.underflow += int(np.count_nonzero(values < lo))
+        self.overflow  += int(np.count_nonzero(values > hi))
+        idx = ((values[inside] - lo) * (self.n_bins / (hi - lo))).astype(np.int64)
+        np.minimum(idx, self.n_bins - 1, out=idx) # hi goes to the last bin
+        self.counts += np.bincount(idx, minlength=self.n_bins)
+        return
+
+    def merge(self, other):
+        self.counts = self.counts + other.counts
+        self.underflow += other.underflow
+        self.overflow  += other.overflow
+        return self
+
+    def results(self):
+        return {'counts': self.counts, 'edges': self.edges, 
+                'underflow': self.underflow, 'overflow': self.overflow}
+
+
+class ImageSum(Accumulator):
+    """
+    Per-pixel sum and no. of contributing events of images. Pixels
+    that are NaN or not in mask (if given) are not counted.
+    """
+
+    def __init__(self, shape):
+        self.shape = shape
+        self.reset()
+        return
+
+    def reset(self):
+        self.sum   = np.zeros(self.shape)
+        self.count = np.zeros(self.shape, dtype=np.int64)
+        self.updated = False
+        return
+
+    def update(self, image, mask=None):
+        self.updated = True
+        valid = ~np.isnan(image)
+        if mask is not None:
+            valid &= mask.astype(bool)
+        self.sum += np.where(valid, image, 0)
+        self.count += valid
+        return
+
+    def merge(self, other):
+        self.sum = self.sum + other.sum
+        self.count = self.count + other.count
+        return self
+
+    def results(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.where(self.count > 0, self.sum / self.count, np.nan)
+        return {'sum': self.sum, 'count': self.count, 'mean': mean}
+
+
+def _merge_accumulators(a, b):
+    """
+    Reduce op for dicts of accumulators (inputs are not modified).
+    Clients may have registered different names (e.g. a client that
+    got no events), the result has the union of them.
+    """
+    merged = {}
+    for name in list(a) + [name for name in b if name not in a]:
+        if name in a and name in b:
+            merged[name] = a[name].merged(b[name])
+        else:
+            merged[name] = a[name] if name in a else b[name]
+    return merged
+
+
 # FOR NEXT TIME
 # CONSIDER MAKING A FileServer CLASS
 # CLASS BASECLASS METHOD THEN HANDLES HDF5
@@ -161,6 +618,16 @@ class CacheArray:
         self.n_events += 1
         return
 
+    def append_many(self, data):
+        """
+        Appends as many events of data as fit in the cache with one
+        slice assignment. Returns the no. of events appended.
+        """
+        n = min(data.shape[0], self.cache_size - self.n_events)
+        self.data[self.n_events:self.n_events+n,...] = data[:n]
+        self.n_events += n
+        return n
+
     def reset(self):
         self.n_events = 0
         return
@@ -182,20 +649,74 @@ class Server: # (hdf5 handling)
         # maps dataset_name --> CacheArray()
         self._cache = {}
 
+        # maps dataset_name --> list of written (reset) CacheArrays
+        # that can be reused
+        self._free_caches = {}
+
+        # maps dataset_name --> no. of events written to the dataset
+        # (datasets are resized geometrically so they can be longer)
+        self._n_written = {}
+
         self.num_events_seen = 0
 
+        # write statistics
+        self.bytes_written   = 0
+        self.write_time      = 0.
+        self.max_queue_depth = 0
+
+        self._write_queue   = None
+        self._writer        = None
+        self._writer_error  = None
+
         if (self.filename is not None):
             self.file_handle = h5py.File(self.filename, 'w')
 
+            write_queue_size = int(os.environ.get('PS_SMD_WRITE_QUEUE', '2'))
+            if write_queue_size > 0:
+                self._write_queue = queue.Queue(maxsize=write_queue_size)
+                self._writer = threading.Thread(target=self._write_loop, daemon=True)
+                self._writer.start()
+
         return
 
+    @property
+    def queue_depth(self):
+        """No. of full caches waiting to be written"""
+        if self._write_queue is None:
+            return 0
+        return self._write_queue.qsize()
+
+    @property
+    def write_bandwidth(self):
+        """Average write bandwidth (MB/s) of the hdf5 writes so far"""
+        if self.write_time == 0:
+            return 0.
+        return self.bytes_written / self.write_time / 1e6
+
     def recv_loop(self):
 
         num_clients_done = 0
         num_clients = self.smdcomm.Get_size() - 1
+        unpackers = {} # client rank -> BufferUnpacker
+        recv_buf = np.empty(0, dtype=np.uint8)
+        status = MPI.Status()
         while num_clients_done < num_clients:
-            msg = self.smdcomm.recv(source=MPI.ANY_SOURCE)
-            if type(msg) is list:
+            self.smdcomm.Probe(source=MPI.ANY_SOURCE, tag=MPI.ANY_TAG, status=status)
+            source, tag = status.Get_source(), status.Get_tag()
+
+            if tag == BATCH_TAG:
+                # the buffer is reused - handle copies the data it keeps
+                n_bytes = status.Get_count(MPI.BYTE)
+                if recv_buf.shape[0] < n_bytes:
+                    recv_buf = np.empty(n_bytes, dtype=np.uint8)
+                self.smdcomm.Recv([recv_buf, n_bytes, MPI.BYTE], source=source, tag=BATCH_TAG)
+                self.handle(unpackers[source].unpack(recv_buf[:n_bytes]))
+                continue
+
+            msg = self.smdcomm.recv(source=source, tag=tag)
+            if tag == SCHEMA_TAG:
+                unpackers.setdefault(source, BufferUnpacker()).update(msg)
+            elif type(msg) is list or type(msg) is ColumnBatch:
                 self.handle(msg)
             elif msg == 'done':
                 num_clients_done += 1
@@ -205,6 +726,10 @@ class Server: # (hdf5 handling)
 
     def handle(self, batch):
 
+        if type(batch) is ColumnBatch:
+            self.handle_columns(batch)
+            return
+
         for event_data_dict in batch:
 
             for cb in self.callbacks:
@@ -217,16 +742,19 @@ class Server: # (hdf5 handling)
                 #              dont see them
                 to_backfill = list(self._dsets.keys())
 
-                for dataset_name, data in event_data_dict.items():
+                for dataset_name, data in _expand_ragged(event_data_dict).items():
 
                     if dataset_name not in self._dsets.keys():
                         self.new_dset(dataset_name, data)
                     else:
                         to_backfill.remove(dataset_name)
-                    self.append_to_cache(dataset_name, data)
+                    if is_ragged(dataset_name):
+                        self.append_column_to_cache(dataset_name, data)
+                    else:
+                        self.append_to_cache(dataset_name, data)
 
                 for dataset_name in to_backfill:
-                    if not is_unaligned(dataset_name):
+                    if is_aligned(dataset_name):
                         self.backfill(dataset_name, 1)
 
             self.num_events_seen += 1
@@ -234,9 +762,54 @@ class Server: # (hdf5 handling)
         return
 
 
+    def handle_columns(self, batch):
+        """
+        Same as handle for a ColumnBatch: each dataset is appended to
+        its cache as one column with missing events filled in.
+        """
+
+        if self.callbacks:
+            for event_data_dict in batch.to_events():
+                for cb in self.callbacks:
+                    cb(event_data_dict)
+
+        if self.filename is not None:
+
+            to_backfill = list(self._dsets.keys())
+
+            for dataset_name, (values, mask) in batch.columns.items():
+
+                if dataset_name not in self._dsets.keys():
+                    self.new_dset(dataset_name, values if is_ragged(dataset_name) else values[0])
+                else:
+                    to_backfill.remove(dataset_name)
+
+                if not is_aligned(dataset_name) or values.shape[0] == batch.n_events:
+                    self.append_column_to_cache(dataset_name, values)
+                else:
+                    dtype, shape = self._dsets[dataset_name]
+                    column = np.empty((batch.n_events,) + shape, dtype=dtype)
+                    column.fill(_get_dset_missing_value(dataset_name, dtype))
+                    column[mask] = values
+                    self.append_column_to_cache(dataset_name, column)
+
+            for dataset_name in to_backfill:
+                if is_aligned(dataset_name):
+                    self.backfill(dataset_name, batch.n_events)
+
+        self.num_events_seen += batch.n_events
+
+        return
+
+
     def new_dset(self, dataset_name, data):
 
-        if type(data) == int:
+        if is_ragged(dataset_name):
+            # data is an array of entries, shape is that of one entry
+            shape = data.shape[1:]
+            maxshape = (None,) + shape
+            dtype = data.dtype
+        elif type(data) == int:
             shape = ()
             maxshape = (None,)
             dtype = 'i8'
@@ -259,21 +832,32 @@ class Server: # (hdf5 handling)
                                                dtype=dtype,
                                                chunks=(self.cache_size,) + shape)
 
-        if not is_unaligned(dataset_name):
+        if is_aligned(dataset_name):
             self.backfill(dataset_name, self.num_events_seen)
 
         return
 
 
-    def append_to_cache(self, dataset_name, data):
+    def _get_cache(self, dataset_name):
 
         if dataset_name not in self._cache.keys():
-            dtype, shape = self._dsets[dataset_name]
-            cache = CacheArray(shape, dtype, self.cache_size)
+            free_caches = self._free_caches.get(dataset_name)
+            if free_caches:
+                cache = free_caches.pop()
+            else:
+                dtype, shape = self._dsets[dataset_name]
+                cache = CacheArray(shape, dtype, self.cache_size)
             self._cache[dataset_name] = cache
         else:
             cache = self._cache[dataset_name]
 
+        return cache
+
+
+    def append_to_cache(self, dataset_name, data):
+
+        cache = self._get_cache(dataset_name)
+
         cache.append(data)
 
         if cache.n_events == self.cache_size:
@@ -282,26 +866,77 @@ class Server: # (hdf5 handling)
         return
 
 
+    def append_column_to_cache(self, dataset_name, column):
+
+        n_done = 0
+        while n_done < column.shape[0]:
+            cache = self._get_cache(dataset_name)
+            n_done += cache.append_many(column[n_done:])
+            if cache.n_events == self.cache_size:
+                self.write_to_file(dataset_name, cache)
+
+        return
+
+
     def write_to_file(self, dataset_name, cache):
+        """
+        Writes the cache to its dataset. With the writer thread, the cache
+        is queued (this blocks if the queue is full) and a fresh cache
+        takes its place.
+        """
+        if self._writer is None:
+            self._write(dataset_name, cache)
+            return
+
+        if self._writer_error is not None:
+            raise self._writer_error
+        del self._cache[dataset_name]
+        self._write_queue.put((dataset_name, cache))
+        self.max_queue_depth = max(self.max_queue_depth, self._write_queue.qsize())
+        return
+
+
+    def _write(self, dataset_name, cache):
+        st = time.monotonic()
         dset = self.file_handle.get(dataset_name)
-        new_size = (dset.shape[0] + cache.n_events,) + dset.shape[1:]
-        dset.resize(new_size)
+        n_written = self._n_written.get(dataset_name, 0)
+        n_needed = n_written + cache.n_events
+        if n_needed > dset.shape[0]:
+            # grow geometrically so that most writes need no resize
+            dset.resize((max(n_needed, 2 * dset.shape[0]),) + dset.shape[1:])
         # remember: data beyond n_events in the cache may be OLD
-        dset[-cache.n_events:,...] = cache.data[:cache.n_events,...] 
+        dset[n_written:n_needed,...] = cache.data[:cache.n_events,...] 
+        self._n_written[dataset_name] = n_needed
+        self.bytes_written += cache.data[:cache.n_events].nbytes
+        self.write_time += time.monotonic() - st
         cache.reset()
         return
 
 
+    def _write_loop(self):
+        while True:
+            item = self._write_queue.get()
+            if item is None:
+                break
+            dataset_name, cache = item
+            try:
+                self._write(dataset_name, cache)
+            except Exception as e:
+                # reported to the receiving thread on its next write
+                self._writer_error = e
+            self._free_caches.setdefault(dataset_name, []).append(cache)
+        return
+
+
     def backfill(self, dataset_name, num_to_backfill):
         
         dtype, shape = self._dsets[dataset_name]
 
-        missing_value = _get_missing_value(dtype) 
-        fill_data = np.empty(shape, dtype=dtype)
+        missing_value = _get_dset_missing_value(dataset_name, dtype) 
+        fill_data = np.empty((num_to_backfill,) + shape, dtype=dtype)
         fill_data.fill(missing_value)
     
-        for i in range(num_to_backfill):
-            self.append_to_cache(dataset_name, fill_data)
+        self.append_column_to_cache(dataset_name, fill_data)
         
         return
 
@@ -309,9 +944,25 @@ class Server: # (hdf5 handling)
     def done(self):
         if (self.filename is not None):
             # flush the data caches (in case did not hit cache_size yet)
-            for dset, cache in self._cache.items():
+            for dset, cache in list(self._cache.items()):
                 if cache.n_events > 0:
                     self.write_to_file(dset, cache)
+
+            if self._writer is not None:
+                self._write_queue.put(None)
+                self._writer.join()
+                if self._writer_error is not None:
+                    raise self._writer_error
+
+            # trim datasets that were grown beyond their no. of events
+            for dset_name, n_written in self._n_written.items():
+                dset = self.file_handle.get(dset_name)
+                if dset.shape[0] > n_written:
+                    dset.resize((n_written,) + dset.shape[1:])
+
+            logger.info(f'smalldata srv {self.filename}: wrote {self.bytes_written/1e6:.1f} MB '
+                        f'at {self.write_bandwidth:.1f} MB/s, max. write queue depth '
+                        f'{self.max_queue_depth}')
             self.file_handle.close()
         return
 
@@ -337,7 +988,7 @@ class SmallData: # (client)
             self._comm_partition()
 
     def setup_parms(self, filename=None, batch_size=10000, cache_size=None,
-                 callbacks=[]):
+                 callbacks=[], sort_timestamps=False):
         """
         Parameters
         ----------
@@ -359,11 +1010,22 @@ class SmallData: # (client)
             names and the values are the data themselves. Each event
             processed will have it's own dictionary of this form
             containing the data saved for that event.
+
+        sort_timestamps : bool
+            Save the permutation that sorts events by timestamp as
+            `timestamp_order` in the (joined) file. Only timestamps
+            are read to compute it, no event data is copied.
         """
 
         self.batch_size = batch_size
+        self._sort_timestamps = sort_timestamps
+        self._accumulators = {}
         self._batch = []
         self._previous_timestamp = -1
+        self._columnar = int(os.environ.get('PS_SMD_COLUMNAR', '1'))
+        self._packer = None
+        if self._columnar and int(os.environ.get('PS_SMD_BUFFERS', '1')):
+            self._packer = BufferPacker()
 
         if cache_size is None:
             cache_size = batch_size
@@ -488,9 +1150,9 @@ class SmallData: # (client)
             #  calls to self.event)
             if len(self._batch) >= self.batch_size:
                 if MODE == 'SERIAL':
-                    self._server.handle(self._batch)
+                    self._server.handle(self._pack_batch())
                 elif MODE == 'PARALLEL':
-                    self._srvcomm.send(self._batch, dest=0)
+                    self._send_batch()
                 self._batch = []           
 
             event_data_dict['timestamp'] = timestamp
@@ -514,6 +1176,24 @@ class SmallData: # (client)
         return
 
 
+    def _pack_batch(self):
+        if self._columnar:
+            return ColumnBatch.from_events(self._batch)
+        return self._batch
+
+
+    def _send_batch(self):
+        batch = self._pack_batch()
+        if self._packer is not None:
+            new_schema, buf = self._packer.pack(batch)
+            if buf is not None:
+                if new_schema:
+                    self._srvcomm.send(new_schema, dest=0, tag=SCHEMA_TAG)
+                self._srvcomm.Send([buf, MPI.BYTE], dest=0, tag=BATCH_TAG)
+                return
+        self._srvcomm.send(batch, dest=0)
+
+
     @property
     def summary(self):
         """
@@ -569,6 +1249,62 @@ class SmallData: # (client)
         return red_val
 
 
+    def accumulator(self, name, acc):
+        """
+        Registers an Accumulator (e.g. MeanVar(), Histogram(100, (0, 1))
+        or ImageSum(shape)) that is saved as summary data `name`.
+        Update it on each event -- it is reduced across clients by 
+        reduce_accumulators and in done(). Returns acc.
+
+        >> img_sum = smd.accumulator('img', ImageSum(img.shape))
+        >> for evt in run.events():
+        >>     img_sum.update(det.raw.image(evt))
+        """
+        self._accumulators[name] = acc
+        return acc
+
+
+    def reduce_accumulators(self, prefix='', reset=False):
+        """
+        Merges the accumulators of all clients and saves their results
+        (under prefix/name if prefix is given, e.g. per step). This is
+        a collective call -- all clients have to call it.
+
+        With reset, accumulators restart from zero afterwards (e.g. to
+        get per-step results).
+
+        Clients without accumulators (or with other names) still take
+        part, the results have the union of the names of all clients.
+        """
+        if self._type not in ('client', 'serial'):
+            return
+
+        reduced = self._reduction(self._accumulators, _merge_accumulators)
+        if reduced and self._full_filename is not None:
+            results = {}
+            for name, acc in reduced.items():
+                results[os.path.join(prefix, name) if prefix else name] = acc.results()
+            self.save_summary(results)
+
+        if reset:
+            for acc in self._accumulators.values():
+                acc.reset()
+        return
+
+
+    def _accumulators_updated(self):
+        """
+        True if any accumulator of any client was updated since its
+        last reset (collective over clients like reduce_accumulators).
+        """
+        if self._type not in ('client', 'serial'):
+            return False
+        updated = any(acc.updated for acc in self._accumulators.values())
+        if MODE == 'PARALLEL':
+            updated = self._client_comm.allreduce(updated, op=MPI.LOR)
+        return updated
+
+
     def save_summary(self, *args, **kwargs):
         """
         Save 'summary data', ie any data that is not per-event (typically 
@@ -600,6 +1336,8 @@ class SmallData: # (client)
                 print('Warning: dataset "%s" was passed value: None'
                       '... ignoring that dataset' % dataset_name)
             else:
+                if dataset_name in fh: # e.g. repeated reduce_accumulators
+                    del fh[dataset_name]
                 fh[dataset_name] = data
 
         # we don't want to close the file in serial mode
@@ -616,19 +1354,28 @@ class SmallData: # (client)
         (in parallel mode).
         """
 
+        # >> final results of the accumulators (before the serial
+        #    server closes the file), unless none of them was updated
+        #    since the last reset (e.g. after per-step reductions)
+        if self._accumulators_updated():
+            self.reduce_accumulators()
+
         # >> finish communication
         if self._type == 'client':
             # we want to send the finish signal to the server
             if len(self._batch) > 0:
-                self._srvcomm.send(self._batch, dest=0)
+                self._send_batch()
             self._srvcomm.send('done', dest=0)
 
         elif self._type == 'server':
             self._server.done()
 
         elif self._type == 'serial':
-            self._server.handle(self._batch)
+            self._server.handle(self._pack_batch())
             self._server.done()
+            if self._sort_timestamps and self._full_filename is not None:
+                with h5py.File(self._full_filename, 'r+') as fh:
+                    _write_timestamp_order(fh)
 
         # stuff only one process should do in parallel mode
         if MODE == 'PARALLEL':
@@ -707,9 +1454,10 @@ class SmallData: # (client)
                 # this happens if a dataset is completely missing in a file.
                 # to maintain alignment, we need to extend the length by the
                 # appropriate number and it will be filled in with the
-                # "fillvalue" argument below.  if it's unaligned, then
-                # we don't need to extend it at all.
-                elif not is_unaligned(dset_name):
+                # "fillvalue" argument below.  if it's unaligned (or the
+                # values of a ragged dataset), then we don't need to extend
+                # it at all.
+                elif is_aligned(dset_name):
                     if '/timestamp' in dsets:
                         total_events += dsets['/timestamp'][1][0]
 
@@ -734,7 +1482,7 @@ class SmallData: # (client)
 
                 else:
                     # only need to pad aligned data with "fillvalue" argument below
-                    if is_unaligned(dset_name):
+                    if not is_aligned(dset_name):
                         pass
                     else:
                         if '/timestamp' in dsets:
@@ -743,7 +1491,10 @@ class SmallData: # (client)
 
             joined_file.create_virtual_dataset(dset_name,
                                                layout,
-                                               fillvalue=_get_missing_value(dtype)) 
+                                               fillvalue=_get_dset_missing_value(dset_name, dtype)) 
+
+        if self._sort_timestamps:
+            _write_timestamp_order(joined_file)
 
         joined_file.close()
 
@@ -0,0 +1,203 @@
+## cython: linetrace=True
+## distutils: define_macros=CYTHON_TRACE_NOGIL=1
+
+from cpython.buffer cimport PyObject_GetBuffer, PyBuffer_Release, PyBUF_ANY_CONTIGUOUS, PyBUF_SIMPLE
+
+from dgramlite cimport Xtc, Sequence, Dgram
+
+from libc.stdint cimport uint8_t, uint32_t, uint64_t, int64_t
+cimport cython
+
+import numpy as np
+
+cdef enum:
+    # TransitionId values (see psexp/TransitionId.py)
+    L1ACCEPT    = 12
+    SLOWUPDATE  = 10
+
+    # TypeId values (see xtcdata/xtc/TypeId.hh)
+    TYPEID_SHAPESDATA   = 1
+    TYPEID_SHAPES       = 2
+    TYPEID_DATA         = 3
+
+    # An L1Accept smd dgram written by Smd::generate has only the smdinfo ShapesData:
+    # [Dgram][ShapesData xtc [Shapes xtc (empty)] [Data xtc [intOffset][intDgramSize]]]
+    XTC_SIZE                = 12
+    SMDINFO_DATA_SIZE       = 16
+    SMDINFO_PAYLOAD_SIZE    = 3 * XTC_SIZE + SMDINFO_DATA_SIZE
+
+cdef inline uint32_t typeid(Xtc* xtc) nogil:
+    """ Returns TypeId of the xtc (contains is the upper half of junks[1]). """
+    return (<uint32_t>xtc.junks[1] >> 16) & 0x0fff
+
+cdef inline bint parse_smdinfo(Dgram* d, int64_t* bd_offset, int64_t* bd_size) nogil:
+    """ Reads intOffset and intDgramSize off an L1Accept smd dgram.
+    Returns False when the dgram does not have the expected layout."""
+    cdef Xtc* shapesdata
+    cdef Xtc* shapes
+    cdef Xtc* data
+    cdef uint64_t* values
+    if d.xtc.extent != sizeof(Xtc) + SMDINFO_PAYLOAD_SIZE:
+        return False
+    shapesdata = <Xtc*>(<char*>&d.xtc + sizeof(Xtc))
+    shapes = <Xtc*>(<char*>shapesdata + sizeof(Xtc))
+    data = <Xtc*>(<char*>shapes + shapes.extent)
+    if typeid(shapesdata) != TYPEID_SHAPESDATA or shapesdata.extent != SMDINFO_PAYLOAD_SIZE \
+            or typeid(shapes) != TYPEID_SHAPES or shapes.extent != sizeof(Xtc) \
+            or typeid(data) != TYPEID_DATA or data.extent != sizeof(Xtc) + SMDINFO_DATA_SIZE:
+        return False
+    values = <uint64_t*>(<char*>data + sizeof(Xtc))
+    bd_offset[0] = values[0]
+    bd_size[0] = values[1]
+    return True
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def parse_smd_batch(view, int n_smd_files, bint get_bd):
+    """ Returns offsets, sizes and services of all dgrams in an smd batch.
+
+    The batch (list of events, each a list of dgrams with a footer, followed
+    by the batch footer) is walked in C using only dgram headers and footers.
+    With get_bd set, bigdata offset and size of L1Accept dgrams are read
+    directly from the smdinfo data.
+
+    Dgrams that need a full Dgram object are flagged in needs_dgram:
+    SlowUpdates (with get_bd, for chunkinfo) and L1Accepts with
+    an unexpected smdinfo layout.
+
+    Returns a dictionary of numpy arrays (rows: events, columns: smd files):
+    smd_offset, smd_size, bd_offset, bd_size, cutoff_flag, needs_dgram, and
+    services (one per event).
+    """
+    cdef Py_buffer buf
+    PyObject_GetBuffer(view, &buf, PyBUF_SIMPLE | PyBUF_ANY_CONTIGUOUS)
+    cdef char* view_ptr = <char*>buf.buf
+    cdef uint64_t view_size = buf.len
+
+    cdef uint32_t* batch_footer
+    cdef uint32_t n_events = 0
+    if view_size >= sizeof(uint32_t):
+        n_events = (<uint32_t*>(view_ptr + view_size - sizeof(uint32_t)))[0]
+
+    out = {}
+    for key, init in (('smd_offset', 0), ('smd_size', 0), ('bd_offset', 0), ('bd_size', 0),
+            ('cutoff_flag', 1), ('needs_dgram', 0)):
+        out[key] = np.full((n_events, n_smd_files), init, dtype=np.int64)
+    out['services'] = np.zeros(n_events, dtype=np.int64)
+
+    cdef int64_t[:, ::1] smd_offset_arr  = out['smd_offset']
+    cdef int64_t[:, ::1] smd_size_arr    = out['smd_size']
+    cdef int64_t[:, ::1] bd_offset_arr   = out['bd_offset']
+    cdef int64_t[:, ::1] bd_size_arr     = out['bd_size']
+    cdef int64_t[:, ::1] cutoff_flag_arr = out['cutoff_flag']
+    cdef int64_t[:, ::1] needs_dgram_arr = out['needs_dgram']
+    cdef int64_t[::1]    services_arr    = out['services']
+
+    cdef uint64_t footer_size = sizeof(uint32_t) * (n_smd_files + 1)
+    cdef uint64_t offset = 0
+    cdef uint64_t evt_size
+    cdef uint32_t* evt_footer
+    cdef uint32_t dgram_size
+    cdef uint32_t service
+    cdef Dgram* d
+    cdef uint32_t i_evt
+    cdef int i_smd
+
+    try:
+        with nogil:
+            batch_footer = <uint32_t*>(view_ptr + view_size - sizeof(uint32_t) * (n_events + 1))
+            for i_evt in range(n_events):
+                evt_size = batch_footer[i_evt]
+                evt_footer = <uint32_t*>(view_ptr + offset + evt_size - footer_size)
+                for i_smd in range(n_smd_files):
+                    dgram_size = evt_footer[i_smd]
+                    if dgram_size == 0:
+                        # Missing dgram
+                        cutoff_flag_arr[i_evt, i_smd] = 0
+                        continue
+
+                    d = <Dgram*>(view_ptr + offset)
+                    service = (d.env >> 24) & 0xf
+                    smd_offset_arr[i_evt, i_smd] = offset
+                    smd_size_arr[i_evt, i_smd] = sizeof(Dgram) + d.xtc.extent - sizeof(Xtc)
+                    services_arr[i_evt] = service
+                    if get_bd:
+                        if service == L1ACCEPT:
+                            if not parse_smdinfo(d, &bd_offset_arr[i_evt, i_smd], &bd_size_arr[i_evt, i_smd]):
+                                needs_dgram_arr[i_evt, i_smd] = 1
+                        elif service == SLOWUPDATE:
+                            needs_dgram_arr[i_evt, i_smd] = 1
+                    offset += dgram_size
+                offset += footer_size
+    finally:
+        PyBuffer_Release(&buf)
+
+    return out
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def index_smd(view):
+    """ Returns index of all complete dgrams in an smd file buffer.
+
+    Dgrams are stepped through using their headers only. The returned 
+    dictionary has one entry per dgram in each of these numpy arrays:
+    timestamp, service, smd_offset, smd_size, bd_offset, bd_size and
+    needs_dgram (SlowUpdates). bd_offset is -1 for L1Accepts without 
+    smdinfo (e.g. a bigdata file used as smd file). n_bytes is the size 
+    of the indexed part (a trailing incomplete dgram is not included).
+    """
+    cdef Py_buffer buf
+    PyObject_GetBuffer(view, &buf, PyBUF_SIMPLE | PyBUF_ANY_CONTIGUOUS)
+    cdef char* view_ptr = <char*>buf.buf
+    cdef uint64_t view_size = buf.len
+    cdef uint64_t offset = 0
+    cdef uint64_t dgram_size
+    cdef uint64_t n_dgrams = 0
+    cdef Dgram* d
+    
+    # Count dgrams first so that the output arrays can be allocated once
+    with nogil:
+        while offset + sizeof(Dgram) <= view_size:
+            d = <Dgram*>(view_ptr + offset)
+            dgram_size = sizeof(Dgram) + d.xtc.extent - sizeof(Xtc)
+            if offset + dgram_size > view_size: break
+            offset += dgram_size
+            n_dgrams += 1
+
+    out = {}
+    for key, dtype in (('timestamp', np.uint64), ('service', np.uint8), ('smd_offset', np.int64), 
+            ('smd_size', np.int64), ('bd_offset', np.int64), ('bd_size', np.int64), ('needs_dgram', np.uint8)):
+        out[key] = np.zeros(n_dgrams, dtype=dtype)
+    out['n_bytes'] = offset
+
+    cdef uint64_t[::1]  ts_arr          = out['timestamp']
+    cdef uint8_t[::1]   service_arr     = out['service']
+    cdef int64_t[::1]   smd_offset_arr  = out['smd_offset']
+    cdef int64_t[::1]   smd_size_arr    = out['smd_size']
+    cdef int64_t[::1]   bd_offset_arr   = out['bd_offset']
+    cdef int64_t[::1]   bd_size_arr     = out['bd_size']
+    cdef uint8_t[::1]   needs_dgram_arr = out['needs_dgram']
+    cdef uint64_t i
+    cdef uint32_t service
+
+    try:
+        with nogil:
+            offset = 0
+            for i in range(n_dgrams):
+                d = <Dgram*>(view_ptr + offset)
+                dgram_size = sizeof(Dgram) + d.xtc.extent - sizeof(Xtc)
+                service = (d.env >> 24) & 0xf
+                ts_arr[i] = (<uint64_t>d.seq.high << 32) | d.seq.low
+                service_arr[i] = service
+                smd_offset_arr[i] = offset
+                smd_size_arr[i] = dgram_size
+                if service == L1ACCEPT:
+                    if not parse_smdinfo(d, &bd_offset_arr[i], &bd_size_arr[i]):
+                        bd_offset_arr[i] = -1
+                elif service == SLOWUPDATE:
+                    needs_dgram_arr[i] = 1
+                offset += dgram_size
+    finally:
+        PyBuffer_Release(&buf)
+
+    return out
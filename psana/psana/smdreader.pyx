@@ -1,10 +1,10 @@
 ## cython: linetrace=True
 ## distutils: define_macros=CYTHON_TRACE_NOGIL=1
-from libc.stdlib cimport malloc, free
+from libc.stdlib cimport malloc, calloc, realloc, free
 from libc.string cimport memcpy
 from dgramlite cimport Xtc, Sequence, Dgram
 from parallelreader cimport Buffer, ParallelReader
-from libc.stdint cimport uint32_t, uint64_t
+from libc.stdint cimport uint32_t, uint64_t, UINT32_MAX
 from cpython cimport array
 import time, os
 cimport cython
@@ -14,22 +14,77 @@ from cython.parallel import prange
 from cpython.buffer cimport PyObject_GetBuffer, PyBuffer_Release, PyBUF_ANY_CONTIGUOUS, PyBUF_SIMPLE
 
 
+@cython.boundscheck(False)
+cdef inline uint64_t find_boundary(uint64_t* ts_arr, uint64_t i_start, uint64_t n_ready_events, 
+        uint64_t limit_ts) nogil:
+    """ Returns the index of the last event at or after i_start with
+    timestamp <= limit_ts (i_start itself is always included).
+
+    Timestamps in a buffer are sorted so we gallop forward from i_start
+    (1, 2, 4, ... events) until we overshoot limit_ts then binary search 
+    the last interval. This replaces stepping one event at a time."""
+    cdef uint64_t i_last = n_ready_events - 1
+    cdef uint64_t lo = i_start     # ts_arr[lo] is always accepted
+    cdef uint64_t hi
+    cdef uint64_t mid
+    cdef uint64_t step = 1
+    
+    # Galloping: find hi such that ts_arr[hi] > limit_ts (or hi is past the end)
+    while True:
+        if lo + step > i_last:
+            hi = i_last + 1
+            break
+        hi = lo + step
+        if ts_arr[hi] > limit_ts:
+            break
+        lo = hi
+        step <<= 1
+    
+    # Binary search for the last accepted index in (lo, hi)
+    while hi - lo > 1:
+        mid = lo + (hi - lo) // 2
+        if ts_arr[mid] <= limit_ts:
+            lo = mid
+        else:
+            hi = mid
+    return lo
+
+
+cdef int _check_footer_size(uint64_t size, int i_file) except -1:
+    """ Repacked sizes of files are sent in a footer of 32-bit unsigned."""
+    if size > UINT32_MAX:
+        raise OverflowError(f'SmdReader cannot repack {size} bytes of file #{i_file} '
+                f'(more than {UINT32_MAX} bytes per file in a chunk)')
+    return 0
+
+
 cdef class SmdReader:
     cdef ParallelReader prl_reader
     cdef int        winner, n_view_events
     cdef int        max_retries, sleep_secs
-    cdef uint64_t   i_starts[100]           # these 5 are aux. local variables 
-    cdef uint64_t   i_ends[100]             #    
-    cdef uint64_t   i_stepbuf_starts[100]   #
-    cdef uint64_t   i_stepbuf_ends[100]     #
-    cdef uint64_t   block_sizes[100]        # 
-    cdef uint64_t   i_st_bufs[100]          # these 4 are global - can be used for
-    cdef uint64_t   block_size_bufs[100]    # sharing viewing windows.
-    cdef uint64_t   i_st_stepbufs[100]      #
-    cdef uint64_t   block_size_stepbufs[100]#
+    cdef uint64_t*  i_starts                # these 5 are aux. local variables 
+    cdef uint64_t*  i_ends                  # (all arrays are sized nfiles)
+    cdef uint64_t*  i_stepbuf_starts        #
+    cdef uint64_t*  i_stepbuf_ends          #
+    cdef uint64_t*  block_sizes             # 
+    cdef uint64_t*  i_st_bufs               # these 4 are global - can be used for
+    cdef uint64_t*  block_size_bufs         # sharing viewing windows.
+    cdef uint64_t*  i_st_stepbufs           #
+    cdef uint64_t*  block_size_stepbufs     #
+    cdef uint64_t*  repack_offsets          # these 4 are used by repack (sized nfiles + 1)
+    cdef uint64_t*  repack_step_sizes       #
+    cdef char**     repack_step_ptrs        #
+    cdef unsigned*  repack_footer           #
     cdef float      total_time
+    cdef float      search_time             # boundary search part of total_time
+    cdef float      repack_time
+    cdef float      last_view_time          # timings of the most recent view/repack call
+    cdef float      last_search_time        #
+    cdef float      last_repack_time        #
     cdef int        num_threads
-    cdef char*      send_buf                # contains repacked data for each EventBuilder node
+    cdef char**     send_bufs               # pool of buffers with repacked data for EventBuilder nodes
+    cdef uint64_t*  send_buf_sizes          # each grows (never shrinks) to fit the largest repack
+    cdef int        n_send_bufs             #
 
     def __init__(self, int[:] fds, int chunksize, int max_retries):
         assert fds.size > 0, "Empty file descriptor list (fds.size=0)."
@@ -39,11 +94,94 @@ cdef class SmdReader:
         self.max_retries        = max_retries
         self.sleep_secs         = 1
         self.total_time         = 0
+        self.search_time        = 0
+        self.repack_time        = 0
+        self.last_view_time     = 0
+        self.last_search_time   = 0
+        self.last_repack_time   = 0
         self.num_threads        = int(os.environ.get('PS_SMD0_NUM_THREADS', '16'))
-        self.send_buf           = <char *>malloc(0x8000000) 
+        self._init_arrays(self.prl_reader.nfiles)
+        self.n_send_bufs        = 0
+        self.send_bufs          = NULL
+        self.send_buf_sizes     = NULL
+
+    cdef int _init_arrays(self, Py_ssize_t nfiles) except -1:
+        self.i_starts           = <uint64_t *>calloc(nfiles, sizeof(uint64_t))
+        self.i_ends             = <uint64_t *>calloc(nfiles, sizeof(uint64_t))
+        self.i_stepbuf_starts   = <uint64_t *>calloc(nfiles, sizeof(uint64_t))
+        self.i_stepbuf_ends     = <uint64_t *>calloc(nfiles, sizeof(uint64_t))
+        self.block_sizes        = <uint64_t *>calloc(nfiles, sizeof(uint64_t))
+        self.i_st_bufs          = <uint64_t *>calloc(nfiles, sizeof(uint64_t))
+        self.block_size_bufs    = <uint64_t *>calloc(nfiles, sizeof(uint64_t))
+        self.i_st_stepbufs      = <uint64_t *>calloc(nfiles, sizeof(uint64_t))
+        self.block_size_stepbufs= <uint64_t *>calloc(nfiles, sizeof(uint64_t))
+        self.repack_offsets     = <uint64_t *>calloc(nfiles + 1, sizeof(uint64_t))
+        self.repack_step_sizes  = <uint64_t *>calloc(nfiles + 1, sizeof(uint64_t))
+        self.repack_step_ptrs   = <char **>calloc(nfiles + 1, sizeof(char *))
+        self.repack_footer      = <unsigned *>calloc(nfiles + 1, sizeof(unsigned))
+        if self.i_starts == NULL or self.i_ends == NULL or self.i_stepbuf_starts == NULL \
+                or self.i_stepbuf_ends == NULL or self.block_sizes == NULL or self.i_st_bufs == NULL \
+                or self.block_size_bufs == NULL or self.i_st_stepbufs == NULL \
+                or self.block_size_stepbufs == NULL or self.repack_offsets == NULL \
+                or self.repack_step_sizes == NULL or self.repack_step_ptrs == NULL \
+                or self.repack_footer == NULL:
+            raise MemoryError(f'SmdReader cannot allocate arrays for {nfiles} files')
+        return 0
 
     def __dealloc__(self):
-        free(self.send_buf)
+        free(self.i_starts)
+        free(self.i_ends)
+        free(self.i_stepbuf_starts)
+        free(self.i_stepbuf_ends)
+        free(self.block_sizes)
+        free(self.i_st_bufs)
+        free(self.block_size_bufs)
+        free(self.i_st_stepbufs)
+        free(self.block_size_stepbufs)
+        free(self.repack_offsets)
+        free(self.repack_step_sizes)
+        free(self.repack_step_ptrs)
+        free(self.repack_footer)
+        for i in range(self.n_send_bufs):
+            free(self.send_bufs[i])
+        free(self.send_bufs)
+        free(self.send_buf_sizes)
+
+    cdef char* _reserve_send_buf(self, uint64_t size, int i_buf) except NULL:
+        """ Makes sure send buffer i_buf can hold size bytes. 
+        
+        Buffers are reused between repacks and grow geometrically so that 
+        chunks of any size can be repacked without frequent reallocation.
+        More than one buffer is only needed when the repacked data are sent
+        asynchronously (i.e. the previous repack may still be in flight)."""
+        cdef int i
+        cdef uint64_t new_size
+        cdef char* new_buf
+        cdef char** new_bufs
+        cdef uint64_t* new_sizes
+        if i_buf >= self.n_send_bufs:
+            # On failure the old arrays are kept (and freed in __dealloc__)
+            new_bufs = <char **>realloc(self.send_bufs, sizeof(char *) * (i_buf + 1))
+            if new_bufs == NULL:
+                raise MemoryError(f'SmdReader cannot allocate {i_buf + 1} send buffers')
+            self.send_bufs = new_bufs
+            new_sizes = <uint64_t *>realloc(self.send_buf_sizes, sizeof(uint64_t) * (i_buf + 1))
+            if new_sizes == NULL:
+                raise MemoryError(f'SmdReader cannot allocate {i_buf + 1} send buffers')
+            self.send_buf_sizes = new_sizes
+            for i in range(self.n_send_bufs, i_buf + 1):
+                self.send_bufs[i] = NULL
+                self.send_buf_sizes[i] = 0
+            self.n_send_bufs = i_buf + 1
+        
+        if size > self.send_buf_sizes[i_buf]:
+            new_size = max(size, self.send_buf_sizes[i_buf] + (self.send_buf_sizes[i_buf] >> 1))
+            new_buf = <char *>realloc(self.send_bufs[i_buf], new_size)
+            if new_buf == NULL:
+                raise MemoryError(f'SmdReader cannot allocate send buffer of {new_size/1e6:.1f} MB')
+            self.send_bufs[i_buf] = new_buf
+            self.send_buf_sizes[i_buf] = new_size
+        return self.send_bufs[i_buf]
     
     def is_complete(self):
         """ Checks that all buffers have at least one event 
@@ -124,16 +262,15 @@ cdef class SmdReader:
 
         # Locate the viewing window and update seen_offset for each buffer
         cdef Buffer* buf
-        #cdef uint64_t[:] buf_ts_arr     
-        cdef uint64_t[:] i_starts           = self.i_starts
-        cdef uint64_t[:] i_ends             = self.i_ends 
-        cdef uint64_t[:] i_stepbuf_starts   = self.i_stepbuf_starts
-        cdef uint64_t[:] i_stepbuf_ends     = self.i_stepbuf_ends 
-        cdef uint64_t[:] block_sizes        = self.block_sizes 
-        cdef uint64_t[:] i_st_bufs          = self.i_st_bufs
-        cdef uint64_t[:] block_size_bufs    = self.block_size_bufs
-        cdef uint64_t[:] i_st_stepbufs      = self.i_st_stepbufs
-        cdef uint64_t[:] block_size_stepbufs= self.block_size_stepbufs
+        cdef uint64_t* i_starts             = self.i_starts
+        cdef uint64_t* i_ends               = self.i_ends 
+        cdef uint64_t* i_stepbuf_starts     = self.i_stepbuf_starts
+        cdef uint64_t* i_stepbuf_ends       = self.i_stepbuf_ends 
+        cdef uint64_t* block_sizes          = self.block_sizes 
+        cdef uint64_t* i_st_bufs            = self.i_st_bufs
+        cdef uint64_t* block_size_bufs      = self.block_size_bufs
+        cdef uint64_t* i_st_stepbufs        = self.i_st_stepbufs
+        cdef uint64_t* block_size_stepbufs  = self.block_size_stepbufs
         cdef unsigned endrun_id = TransitionId.EndRun
         
         st_search = time.monotonic()
@@ -147,20 +284,7 @@ cdef class SmdReader:
             i_ends[i] = i_starts[i] 
             if i_ends[i] < buf.n_ready_events:
                 if buf.ts_arr[i_ends[i]] != limit_ts:
-                    ## Reduce the size of the search by searching from the next unseen event
-                    #i_ends[i] = np.searchsorted(buf_ts_arr[buf.n_seen_events:buf.n_ready_events], limit_ts) + buf.n_seen_events
-
-                    ## Note that limit_ts should be at this found index or its left index
-                    ## If the found index is 0, then this buffer has nothing to share.
-                    #if buf.ts_arr[i_ends[i]] != limit_ts:
-                    #    if i_ends[i] == 0:
-                    #        i_ends[i] = i_starts[i] - 1
-                    #    else:
-                    #        i_ends[i] -= 1
-                    
-                    while buf.ts_arr[i_ends[i] + 1] <= limit_ts \
-                            and i_ends[i] < buf.n_ready_events - 1:
-                        i_ends[i] += 1
+                    i_ends[i] = find_boundary(buf.ts_arr, i_starts[i], buf.n_ready_events, limit_ts)
                 
                 block_sizes[i] = buf.en_offset_arr[i_ends[i]] - buf.st_offset_arr[i_starts[i]]
                
@@ -184,9 +308,7 @@ cdef class SmdReader:
             i_stepbuf_ends[i] = i_stepbuf_starts[i] 
             if i_stepbuf_ends[i] <  buf.n_ready_events \
                     and buf.ts_arr[i_stepbuf_ends[i]] <= limit_ts: 
-                while buf.ts_arr[i_stepbuf_ends[i] + 1] <= limit_ts \
-                        and i_stepbuf_ends[i] < buf.n_ready_events - 1:
-                    i_stepbuf_ends[i] += 1
+                i_stepbuf_ends[i] = find_boundary(buf.ts_arr, i_stepbuf_starts[i], buf.n_ready_events, limit_ts)
                 
                 block_sizes[i] = buf.en_offset_arr[i_stepbuf_ends[i]] - buf.st_offset_arr[i_stepbuf_starts[i]]
                 
@@ -200,14 +322,17 @@ cdef class SmdReader:
         # end for i in ...
         en_all = time.monotonic()
 
-        self.total_time += en_all - st_all
+        self.last_search_time = en_all - st_search
+        self.last_view_time = en_all - st_all
+        self.search_time += self.last_search_time
+        self.total_time += self.last_view_time
 
     def show(self, int i_buf, step_buf=False):
         """ Returns memoryview of buffer i_buf at the current viewing
         i_st and block_size"""
         cdef Buffer* buf
-        cdef uint64_t[:] block_size_bufs
-        cdef uint64_t[:] i_st_bufs      
+        cdef uint64_t* block_size_bufs
+        cdef uint64_t* i_st_bufs      
         if step_buf:
             buf = &(self.prl_reader.step_bufs[i_buf])
             block_size_bufs = self.block_size_stepbufs
@@ -240,11 +365,45 @@ cdef class SmdReader:
     def total_time(self):
         return self.total_time
 
+    @property
+    def search_time(self):
+        return self.search_time
+
+    @property
+    def repack_time(self):
+        return self.repack_time
+
+    @property
+    def last_view_time(self):
+        return self.last_view_time
+
+    @property
+    def last_search_time(self):
+        return self.last_search_time
+
+    @property
+    def last_repack_time(self):
+        return self.last_repack_time
+
 
     @property
     def got(self):
         return self.prl_reader.got
 
+    @property
+    def prefetch_depth(self):
+        return self.prl_reader.prefetch_depth
+
+    @property
+    def prefetch_read_time(self):
+        """ Total time the prefetch thread spent reading smd files."""
+        return self.prl_reader.prefetch_read_time
+
+    @property
+    def prefetch_wait_time(self):
+        """ Total time get() waited for the prefetch thread."""
+        return self.prl_reader.prefetch_wait_time
+
     @property
     def chunk_overflown(self):
         return self.prl_reader.chunk_overflown
@@ -260,23 +419,39 @@ cdef class SmdReader:
             found = True
         return found
 
-    def repack(self, step_views, only_steps=False):
-        """ Repack step and smd data in one consecutive chunk with footer at end."""
+    def repack(self, step_views, only_steps=False, int i_buf=0):
+        """ Repack step and smd data in one consecutive chunk with footer at end.
+        The returned view points to send buffer i_buf and is valid until the 
+        next repack into the same buffer."""
+        st_repack = time.monotonic()
         cdef Buffer* smd_buf
         cdef Py_buffer step_buf
-        cdef int i=0, offset=0
-        cdef uint64_t smd_size=0, step_size=0, footer_size=0, total_size=0
-        cdef unsigned footer[1000]
+        cdef int i=0
+        cdef uint64_t offset=0
+        cdef uint64_t smd_size=0, step_size=0, footer_size=0, total_size=0, size=0
+        cdef unsigned* footer = self.repack_footer
         footer[self.prl_reader.nfiles] = self.prl_reader.nfiles 
         cdef char[:] view
         
+        # Size the send buffer from the actual step and smd views
+        footer_size = sizeof(unsigned) * (self.prl_reader.nfiles + 1)
+        total_size = footer_size
+        for i in range(self.prl_reader.nfiles):
+            size = memoryview(step_views[i]).nbytes
+            if not only_steps:
+                size += self.block_size_bufs[i]
+            _check_footer_size(size, i)
+            total_size += size
+        cdef char* send_buf = self._reserve_send_buf(total_size, i_buf)
+        total_size = 0
+        
         # Copy step and smd buffers if exist
         for i in range(self.prl_reader.nfiles):
             PyObject_GetBuffer(step_views[i], &step_buf, PyBUF_SIMPLE | PyBUF_ANY_CONTIGUOUS)
             view_ptr = <char *>step_buf.buf
             step_size = step_buf.len
             if step_size > 0:
-                memcpy(self.send_buf + offset, view_ptr, step_size)
+                memcpy(send_buf + offset, view_ptr, step_size)
                 offset += step_size
             PyBuffer_Release(&step_buf)
 
@@ -285,30 +460,33 @@ cdef class SmdReader:
                 smd_size = self.block_size_bufs[i]
                 if smd_size > 0:
                     smd_buf = &(self.prl_reader.bufs[i])
-                    memcpy(self.send_buf + offset, smd_buf.chunk + smd_buf.st_offset_arr[self.i_st_bufs[i]], smd_size)
+                    memcpy(send_buf + offset, smd_buf.chunk + smd_buf.st_offset_arr[self.i_st_bufs[i]], smd_size)
                     offset += smd_size
             
             footer[i] = step_size + smd_size
             total_size += footer[i]
 
         # Copy footer 
-        footer_size = sizeof(unsigned) * (self.prl_reader.nfiles + 1)
-        memcpy(self.send_buf + offset, &footer, footer_size) 
+        memcpy(send_buf + offset, footer, footer_size) 
         total_size += footer_size
-        view = <char [:total_size]> (self.send_buf) 
+        view = <char [:total_size]> (send_buf) 
+        self.last_repack_time = time.monotonic() - st_repack
+        self.repack_time += self.last_repack_time
         return view
 
-    def repack_parallel(self, step_views, only_steps=0):
+    def repack_parallel(self, step_views, only_steps=0, int i_buf=0):
         """ Repack step and smd data in one consecutive chunk with footer at end.
-        Memory copying is done is parallel.
+        Memory copying is done is parallel. See repack for i_buf.
         """
+        st_repack = time.monotonic()
         cdef Py_buffer step_buf
-        cdef char* ptr_step_bufs[1000]
-        cdef int i=0, offset=0
-        cdef uint64_t offsets[1000]
-        cdef uint64_t step_sizes[1000]
+        cdef char** ptr_step_bufs = self.repack_step_ptrs
+        cdef int i=0
+        cdef uint64_t offset=0
+        cdef uint64_t* offsets = self.repack_offsets
+        cdef uint64_t* step_sizes = self.repack_step_sizes
         cdef uint64_t footer_size=0, total_size=0
-        cdef unsigned footer[1000]
+        cdef unsigned* footer = self.repack_footer
         footer[self.prl_reader.nfiles] = self.prl_reader.nfiles 
         cdef char[:] view
         cdef int c_only_steps = only_steps
@@ -322,28 +500,33 @@ cdef class SmdReader:
             if only_steps==0:
                 total_size += self.block_size_bufs[i]
                 offset += self.block_size_bufs[i]
+            _check_footer_size(offset - offsets[i], i)
             PyObject_GetBuffer(step_views[i], &step_buf, PyBUF_SIMPLE | PyBUF_ANY_CONTIGUOUS)
             ptr_step_bufs[i] = <char *>step_buf.buf
             PyBuffer_Release(&step_buf)
+        
+        footer_size = sizeof(unsigned) * (self.prl_reader.nfiles + 1)
+        cdef char* send_buf = self._reserve_send_buf(total_size + footer_size, i_buf)
 
         # Copy step and smd buffers if exist
         for i in prange(self.prl_reader.nfiles, nogil=True, num_threads=self.num_threads):
             footer[i] = 0
             if step_sizes[i] > 0:
-                memcpy(self.send_buf + offsets[i], ptr_step_bufs[i], step_sizes[i])
+                memcpy(send_buf + offsets[i], ptr_step_bufs[i], step_sizes[i])
                 offsets[i] += step_sizes[i]
                 footer[i] += step_sizes[i]
             
             if c_only_steps == 0:
                 if self.block_size_bufs[i] > 0:
-                    memcpy(self.send_buf + offsets[i], 
+                    memcpy(send_buf + offsets[i], 
                             self.prl_reader.bufs[i].chunk + self.prl_reader.bufs[i].st_offset_arr[self.i_st_bufs[i]], 
                             self.block_size_bufs[i])
                     footer[i] += self.block_size_bufs[i]
             
         # Copy footer 
-        footer_size = sizeof(unsigned) * (self.prl_reader.nfiles + 1)
-        memcpy(self.send_buf + total_size, &footer, footer_size) 
+        memcpy(send_buf + total_size, footer, footer_size) 
         total_size += footer_size
-        view = <char [:total_size]> (self.send_buf) 
+        view = <char [:total_size]> (send_buf) 
+        self.last_repack_time = time.monotonic() - st_repack
+        self.repack_time += self.last_repack_time
         return view
@@ -0,0 +1,56 @@
+""" Microbenchmark for median common mode correction backends
+
+Applies epix10ka-like common mode corrections (banks, rows in banks and
+columns of half-segments, as in calib_epix10ka_any with cmpars mode 7) to
+n_segs segments of 352x384 float32 pixels with ~10% of pixels masked and
+reports ms/event for the numpy backend (np.median/np.ma.median) and the
+compiled kernels of psana.detector.commonmode_ext, called per segment and
+for all segments at once.
+
+Usage: python bench_commonmode.py [n_segs] [n_events]
+"""
+import sys, time
+import numpy as np
+
+import psana.detector.UtilsCommonMode as ucm
+
+def correct(arr, mask, backend):
+    hrows = arr.shape[-2] // 2
+    for sl in (np.s_[..., :hrows, :], np.s_[..., hrows:, :]):
+        ucm.common_mode_2d_hsplit_nbanks(arr[sl], mask[sl], nbanks=8, cormax=100, backend=backend)
+    ucm.common_mode_rows_hsplit_nbanks(arr, mask, nbanks=8, cormax=100, backend=backend)
+    for sl in (np.s_[..., :hrows, :], np.s_[..., hrows:, :]):
+        ucm.common_mode_cols(arr[sl], mask[sl], cormax=100, backend=backend)
+
+def per_segment(arr, mask, backend):
+    for s in range(arr.shape[0]):
+        correct(arr[s], mask[s], backend)
+
+def run(func, arr0, mask, backend, n_events):
+    arr = arr0.copy()
+    st = time.monotonic()
+    for i in range(n_events):
+        arr[:] = arr0
+        func(arr, mask, backend)
+    return (time.monotonic() - st) / n_events, arr
+
+def main(n_segs=16, n_events=5):
+    rng = np.random.default_rng(0)
+    arr0 = rng.normal(0, 20, size=(n_segs, 352, 384)).astype(np.float32)
+    mask = (rng.random(arr0.shape) > 0.1).astype(np.uint8)
+
+    t_numpy, res_numpy = run(per_segment, arr0, mask, 'numpy', n_events)
+    print(f'{n_segs} segments of 352x384, {n_events} events')
+    print(f'{"backend":>20} {"ms/evt":>8} {"speedup":>8}')
+    print(f'{"numpy":>20} {t_numpy*1e3:>8.1f} {1:>8.2f}')
+    if ucm.cmext is None:
+        print('psana.detector.commonmode_ext is not built')
+        return
+    for name, func in (('ext per segment', per_segment), ('ext all segments', correct)):
+        t, res = run(func, arr0, mask, 'ext', n_events)
+        assert np.array_equal(res, res_numpy)
+        print(f'{name:>20} {t*1e3:>8.1f} {t_numpy/t:>8.2f}')
+
+if __name__ == "__main__":
+    args = [int(arg) for arg in sys.argv[1:]]
+    main(*args)
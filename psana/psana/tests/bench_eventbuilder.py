@@ -0,0 +1,56 @@
+""" Microbenchmark for EventBuilder.build
+
+Builds synthetic smd views (dgram headers with a small payload) and reports
+events/s for the single-pass (PS_EB_SINGLE_PASS=1) and the per-event copy
+(PS_EB_SINGLE_PASS=0) modes as a function of no. of smd files.
+
+Usage: python bench_eventbuilder.py [n_events] [batch_size]
+"""
+import os, sys, time
+import numpy as np
+
+L1ACCEPT = 12
+PAYLOAD_SIZE = 32 # roughly the size of smdinfo in an smd dgram
+
+def make_view(n_events, payload_size=PAYLOAD_SIZE, missing_every=0):
+    """ Returns a bytearray of n_events dgrams with increasing timestamps.
+    Dgram layout: seq.low, seq.high, env, xtc.junks[2], xtc.extent."""
+    dgram_dtype = np.dtype([('seq_low', '<u4'), ('seq_high', '<u4'), ('env', '<u4'),
+        ('junks', '<u4', 2), ('extent', '<u4'), ('payload', 'u1', payload_size)])
+    ts = np.arange(1, n_events + 1, dtype=np.uint64)
+    if missing_every:
+        ts = ts[ts % missing_every != 0]
+    dgrams = np.zeros(ts.shape[0], dtype=dgram_dtype)
+    dgrams['seq_low'] = ts & 0xffffffff
+    dgrams['seq_high'] = ts >> 32
+    dgrams['env'] = L1ACCEPT << 24
+    dgrams['extent'] = 12 + payload_size # sizeof(Xtc) + payload
+    return bytearray(dgrams.tobytes())
+
+def run_build(views, batch_size, single_pass):
+    os.environ['PS_EB_SINGLE_PASS'] = str(single_pass)
+    from psana.eventbuilder import EventBuilder
+    eb = EventBuilder([memoryview(view) for view in views], [None]*len(views))
+    n_events = 0
+    st = time.monotonic()
+    while True:
+        batch_dict, _ = eb.build(batch_size=batch_size)
+        if eb.nevents == 0 and eb.nsteps == 0: break
+        n_events += eb.nevents
+    en = time.monotonic()
+    return n_events, en - st
+
+def main(n_events=100000, batch_size=1000):
+    print(f'{"n_smds":>8} {"copy (evts/s)":>15} {"single-pass (evts/s)":>22} {"speedup":>8}')
+    for n_smds in (1, 2, 4, 8, 16, 32, 64):
+        views = [make_view(n_events, missing_every=i+2 if i % 2 else 0) for i in range(n_smds)]
+        rates = []
+        for single_pass in (0, 1):
+            n_built, elapsed = run_build(views, batch_size, single_pass)
+            assert n_built == n_events
+            rates.append(n_built / elapsed)
+        print(f'{n_smds:>8} {rates[0]:>15.0f} {rates[1]:>22.0f} {rates[1]/rates[0]:>8.2f}')
+
+if __name__ == "__main__":
+    args = [int(arg) for arg in sys.argv[1:]]
+    main(*args)
@@ -0,0 +1,56 @@
+""" Microbenchmark for SmallData Server ingestion
+
+Feeds batches of synthetic events (n_fields scalar fields, each missing in
+some events) to one Server and reports events/s for per-event dict batches
+(PS_SMD_COLUMNAR=0) and columnar batches (PS_SMD_COLUMNAR=1). For columnar
+batches, the client-side conversion is timed separately since it runs on
+the clients, not on the srv rank.
+
+Usage: python bench_smalldata.py [n_events] [batch_size] [n_fields]
+"""
+import os, sys, time, tempfile
+
+from psana.smalldata import Server, ColumnBatch
+
+def make_batches(n_events, batch_size, n_fields):
+    """ Returns list of batches (lists of event dicts). Field i is missing
+    in every (i+2)-th event when i is odd."""
+    batches = []
+    for st in range(0, n_events, batch_size):
+        batch = []
+        for i_evt in range(st, min(st + batch_size, n_events)):
+            event_data_dict = {'timestamp': i_evt + 1}
+            for i in range(n_fields):
+                if i % 2 and i_evt % (i + 2) == 0: continue
+                event_data_dict[f'field{i}'] = float(i_evt) if i % 3 else i_evt
+            batch.append(event_data_dict)
+        batches.append(batch)
+    return batches
+
+def run_server(batches, filename, cache_size):
+    srv = Server(filename=filename, cache_size=cache_size)
+    st = time.monotonic()
+    for batch in batches:
+        srv.handle(batch)
+    srv.done()
+    return srv.num_events_seen, time.monotonic() - st
+
+def main(n_events=100000, batch_size=1000, n_fields=100):
+    batches = make_batches(n_events, batch_size, n_fields)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        n_seen, t_dicts = run_server(batches, os.path.join(tmp_dir, 'dicts.h5'), batch_size)
+        assert n_seen == n_events
+
+        st = time.monotonic()
+        column_batches = [ColumnBatch.from_events(batch) for batch in batches]
+        t_pack = time.monotonic() - st
+        n_seen, t_columns = run_server(column_batches, os.path.join(tmp_dir, 'columns.h5'), batch_size)
+        assert n_seen == n_events
+
+    print(f'{n_events} events, {n_fields} fields, batch_size={batch_size}')
+    print(f'{"srv dicts (evts/s)":>20} {"srv columns (evts/s)":>22} {"speedup":>8} {"client packing (evts/s)":>25}')
+    print(f'{n_events/t_dicts:>20.0f} {n_events/t_columns:>22.0f} {t_dicts/t_columns:>8.2f} {n_events/t_pack:>25.0f}')
+
+if __name__ == "__main__":
+    args = [int(arg) for arg in sys.argv[1:]]
+    main(*args)
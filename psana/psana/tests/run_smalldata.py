@@ -50,7 +50,7 @@ def gen_h5(source='xtc', pid=None):
         ds = DataSource(shmem='shmem_test_' + pid)
 
     smd = ds.smalldata(filename='smalldata_test.h5', batch_size=5,
-                       callbacks=[test_callback])
+                       callbacks=[test_callback], sort_timestamps=True)
 
     for run in ds.runs():
         # test that we can make a Detector, which is somewhat subtle
@@ -130,6 +130,12 @@ class SmallDataTest:
             assert np.sum((d == -99999)) == 5, d
         return
 
+    def test_timestamp_order(self):
+        ts = np.array(self.f['/timestamp'])
+        order = np.array(self.f['/timestamp_order'])
+        assert np.all(np.diff(ts[order]) >= 0), ts[order]
+        return
+
     def test_summary(self):
         d = np.array(self.f['/summary_array'])
         assert np.all(d == np.arange(3))
@@ -175,6 +181,7 @@ def run_test(mode, tmp_path):
         testobj.test_float()
         testobj.test_arrint()
         testobj.test_arrfloat()
+        testobj.test_timestamp_order()
 
         # currently these tests count the number of events,
         # however, that number is not deterministic for shmem (depends on speed)
@@ -0,0 +1,42 @@
+import os, sys
+import numpy as np
+import pytest
+sys.path = [os.path.abspath(os.path.dirname(__file__))] + sys.path
+from psana import DataSource
+import psana.pscalib.calib.MDBWebUtils as wu
+from setup_input_files import setup_input_files
+
+@pytest.fixture(autouse=True)
+def no_calib(monkeypatch):
+    # calibration constants are not used here
+    monkeypatch.setattr(wu, 'calib_constants_all_types', lambda *args, **kwargs: {})
+
+def get_events(xtc_dir, bd_access, edit=False):
+    """ Returns list of (timestamp, bytes of dgrams, raw arrays of xppcspad) """
+    ds = DataSource(exp='xpptut15', run=1, dir=xtc_dir, bd_access=bd_access)
+    events = []
+    for run in ds.runs():
+        for evt in run.events():
+            arrays = [seg.raw.arrayRaw for d in evt._dgrams if d is not None and hasattr(d, 'xppcspad')
+                      for seg in d.xppcspad.values()]
+            events.append((evt.timestamp, [bytes(memoryview(d)) for d in evt._dgrams if d is not None],
+                           [a.copy() for a in arrays]))
+            if edit:
+                # in-place edits of event data must not touch the files
+                for a in arrays:
+                    a.flags.writeable = True
+                    a -= 1
+    return events
+
+def test_bd_access(tmp_path):
+    setup_input_files(tmp_path)
+    xtc_dir = str(tmp_path / '.tmp')
+    events = get_events(xtc_dir, 'read')
+    assert len(events) > 0 and all(arrays for _, _, arrays in events)
+    for mmap_events in (get_events(xtc_dir, 'mmap', edit=True), get_events(xtc_dir, 'mmap')):
+        assert len(mmap_events) == len(events)
+        for (ts, dgrams, arrays), (mts, mdgrams, marrays) in zip(events, mmap_events):
+            assert mts == ts
+            assert mdgrams == dgrams
+            for a, ma in zip(arrays, marrays):
+                np.testing.assert_array_equal(ma, a)
@@ -0,0 +1,101 @@
+import threading
+import time
+import json
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import numpy as np
+import pytest
+
+import psana.pscalib.calib.MDBWebUtils as wu
+
+PEDESTALS = np.arange(12, dtype=np.float32).reshape(3, 4)
+
+CTYPES = ('pedestals', 'pixel_gain', 'pixel_rms', 'pixel_status')
+
+def make_doc(doc_id, time_stamp='2021-01-01T00:00:00-0800', ctype='pedestals', run=1):
+    return {'_id': doc_id, 'id_data': 'data_' + doc_id, 'ctype': ctype, 'time_stamp': time_stamp, 'run': run,
+            'data_type': 'ndarray', 'data_dtype': 'float32', 'data_shape': str(PEDESTALS.shape)}
+
+@pytest.fixture
+def calib_server():
+    """Stand-in for the calibration web service. Collections return docs of
+    all CTYPES (two runs each), GridFS returns PEDESTALS for any id after
+    a delay. Requests and the max. no. of concurrent GridFS requests are
+    recorded."""
+    requests = []
+    stats = {'in_flight': 0, 'max_in_flight': 0}
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            requests.append(self.path)
+            if '/gridfs/' in self.path:
+                with lock:
+                    stats['in_flight'] += 1
+                    stats['max_in_flight'] = max(stats['max_in_flight'], stats['in_flight'])
+                time.sleep(0.05)
+                with lock:
+                    stats['in_flight'] -= 1
+                payload = PEDESTALS.tobytes()
+            else:
+                docs = [make_doc('%s_r%d' % (ct, run), ctype=ct, run=run) for ct in CTYPES for run in (1, 2)]
+                payload = json.dumps(docs).encode()
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield 'http://127.0.0.1:%d' % server.server_address[1], requests, stats
+    server.shutdown()
+
+def test_calib_cache(calib_server, tmp_path, monkeypatch):
+    url, requests, _ = calib_server
+    monkeypatch.setenv('LCLS_CALIB_CACHE', str(tmp_path))
+    monkeypatch.setenv('LCLS_CALIB_CACHE_MB', '1')
+
+    doc = make_doc('doc0')
+    for i in range(3):
+        data = wu.get_data_for_doc('cdb_test', doc, url=url)
+        assert np.array_equal(data, PEDESTALS)
+    assert len(requests) == 1
+
+    # a new time stamp of the document invalidates the entry
+    data = wu.get_data_for_doc('cdb_test', make_doc('doc0', time_stamp='2021-02-01T00:00:00-0800'), url=url)
+    assert np.array_equal(data, PEDESTALS) and len(requests) == 2
+
+    # caching is disabled with an empty directory name and by default
+    monkeypatch.setenv('LCLS_CALIB_CACHE', '')
+    wu.get_data_for_doc('cdb_test', doc, url=url)
+    assert len(requests) == 3
+    monkeypatch.delenv('LCLS_CALIB_CACHE')
+    wu.get_data_for_doc('cdb_test', doc, url=url)
+    assert len(requests) == 4
+
+def test_calib_cache_eviction(tmp_path):
+    from psana.pscalib.calib.MDBWebCache import MDBWebCache
+    cache = MDBWebCache(str(tmp_path), max_bytes=250)
+    for i in range(3):
+        assert cache.put('cdb_test', make_doc('doc%d' % i), bytes(100))
+    assert cache.get('cdb_test', make_doc('doc0')) is None # least recently used
+    assert cache.get('cdb_test', make_doc('doc2')) == bytes(100)
+
+def test_concurrent_fetch(calib_server, monkeypatch):
+    url, requests, stats = calib_server
+    monkeypatch.setenv('LCLS_CALIB_CACHE', '')
+
+    dets = ['epix_000%d' % i for i in range(3)]
+    resp = wu.calib_constants_for_dets(
+            lambda det: wu.calib_constants_all_types(det, exp='tstx00117', run=10, url=url), dets)
+    assert list(resp) == dets
+    for det in dets:
+        assert sorted(resp[det]) == sorted(CTYPES)
+        for ct, (data, doc) in resp[det].items():
+            assert doc['ctype'] == ct and doc['run'] == 2
+            assert np.array_equal(data, PEDESTALS)
+    assert sum('/gridfs/' in path for path in requests) == len(dets) * len(CTYPES)
+    assert stats['max_in_flight'] > 1
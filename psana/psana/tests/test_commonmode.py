@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+import psana.detector.UtilsCommonMode as ucm
+
+FUNCS = {
+    'rows':       lambda a, m, backend, **kw: ucm.common_mode_rows(a, m, backend=backend, **kw),
+    'cols':       lambda a, m, backend, **kw: ucm.common_mode_cols(a, m, backend=backend, **kw),
+    '2d':         lambda a, m, backend, **kw: ucm.common_mode_2d(a, m, backend=backend, **kw),
+    'rows_banks': lambda a, m, backend, **kw: ucm.common_mode_rows_hsplit_nbanks(a, m, nbanks=8, backend=backend, **kw),
+    '2d_banks':   lambda a, m, backend, **kw: ucm.common_mode_2d_hsplit_nbanks(a, m, nbanks=8, backend=backend, **kw),
+}
+
+def make_data(dtype, shape, pmask, seed):
+    """ Returns data with repeated values and NaNs and a mask with an empty row and column. """
+    rng = np.random.default_rng(seed)
+    arr = rng.normal(0, 20, size=shape).astype(dtype)
+    arr[rng.random(shape) < 0.01] = 3
+    arr[rng.random(shape) < 0.0005] = np.nan
+    if pmask is None: return arr, None
+    mask = (rng.random(shape) > pmask).astype(np.uint8)
+    mask[..., 3, :] = 0
+    mask[..., :, 5] = 0
+    return arr, mask
+
+@pytest.mark.skipif(ucm.cmext is None, reason='psana.detector.commonmode_ext is not built')
+@pytest.mark.parametrize('name', sorted(FUNCS))
+@pytest.mark.parametrize('dtype', (np.float32, np.float64))
+@pytest.mark.parametrize('shape', ((176, 384), (3, 176, 384), (8, 16)))
+@pytest.mark.parametrize('pmask', (None, 0.3, 0.95))
+def test_commonmode_ext(name, dtype, shape, pmask):
+    """ Compiled kernels must give bit-identical results to the numpy backend. """
+    func = FUNCS[name]
+    for seed, kw in enumerate(({}, {'cormax': 10}, {'npix_min': 100})):
+        arr, mask = make_data(dtype, shape, pmask, seed)
+        a, b = arr.copy(), arr.copy()
+        with np.errstate(all='ignore'):
+            func(a, mask, 'numpy', **kw)
+            func(b, mask, 'ext', **kw)
+        assert np.array_equal(a.view(np.uint8), b.view(np.uint8)), (name, kw)
+        if mask is not None: # masks of other int types are treated as 0/1
+            c = arr.copy()
+            func(c, mask.astype(np.int16), 'ext', **kw)
+            assert np.array_equal(a.view(np.uint8), c.view(np.uint8)), (name, kw)
+
+if __name__ == "__main__":
+    for name in sorted(FUNCS):
+        test_commonmode_ext(name, np.float32, (3, 176, 384), 0.3)
@@ -0,0 +1,58 @@
+import numpy as np
+from psana.detector.UtilsEpix10kaCalib import DarkStats, proc_dark_stats
+
+def dark_frames(nrecs=400, shape=(2, 30, 40), seed=0):
+    rng = np.random.default_rng(seed)
+    peds = rng.uniform(1000, 3000, size=shape)
+    rms = rng.uniform(2, 5, size=shape)
+    return np.rint(rng.normal(peds, rms, size=(nrecs,) + shape)).astype(np.uint16)
+
+def test_dark_stats_vs_block():
+    block = dark_frames()
+    stats = DarkStats(block.shape[1:], nbins=64)
+    for raw in block: stats.add(raw)
+    assert stats.n == len(block)
+    assert np.allclose(stats.mean, block.mean(axis=0))
+    assert np.allclose(np.sqrt(stats.m2/stats.n), block.std(axis=0))
+
+    # gated average and rms as in proc_dark_block, gate limits truncated
+    # from dithered quantiles differ by 1 ADU in a fraction of pixels
+    rng = np.random.default_rng(1)
+    blkf = block + rng.random(block.shape) - 0.5
+    gate_lo = np.quantile(blkf, 0.05, axis=0).astype(np.uint16)
+    gate_hi = np.quantile(blkf, 0.95, axis=0).astype(np.uint16)
+    inside = (block >= gate_lo) & (block <= gate_hi)
+    n = inside.sum(axis=0)
+    av1_ref = (block * inside).sum(axis=0) / n
+    rms_ref = np.sqrt((np.square(block.astype(np.float64)) * inside).sum(axis=0) / n - np.square(av1_ref))
+
+    for seg in range(block.shape[1]):
+        av1, rms, sta = proc_dark_stats(stats, seg=seg)
+        assert av1.shape == block.shape[2:]
+        sd = block[:,seg].std(axis=0)
+        assert np.all(np.abs(av1 - av1_ref[seg]) < 0.2*sd)
+        assert np.all(np.abs(rms - rms_ref[seg]) < 0.2*sd)
+        assert np.median(np.abs(av1 - av1_ref[seg])) < 0.01
+        assert (sta == 0).mean() > 0.99
+
+def test_dark_stats_merge():
+    block = dark_frames(nrecs=200)
+    stats = DarkStats(block.shape[1:], nref=1)
+    for raw in block: stats.add(raw)
+
+    # halves with windows around different frames
+    a, b = DarkStats(block.shape[1:], nref=1), DarkStats(block.shape[1:], nref=1)
+    for raw in block[:120]: a.add(raw)
+    for raw in block[:119:-1]: b.add(raw)
+    assert np.any(a.off != b.off)
+    a.merge(b)
+    assert a.n == stats.n
+    assert np.array_equal(a.hist, stats.hist)
+    assert np.allclose(a.mean, stats.mean)
+    assert np.allclose(a.m2, stats.m2)
+    for x, y in zip(proc_dark_stats(a), proc_dark_stats(stats)):
+        assert np.array_equal(x, y)
+
+if __name__ == "__main__":
+    test_dark_stats_vs_block()
+    test_dark_stats_merge()
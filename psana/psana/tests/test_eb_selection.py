@@ -0,0 +1,110 @@
+from psana.eventbuilder import EventBuilder
+from psana.psexp.packet_footer import PacketFooter
+from psana import DataSource
+import psana.pscalib.calib.MDBWebUtils as wu
+from bench_eventbuilder import make_view
+from setup_input_files import setup_input_files
+import numpy as np
+import os
+import unittest
+
+L1ACCEPT = 12
+BEGINSTEP = 6
+N_EVENTS = 1000
+
+def get_timestamps(batch):
+    """ Returns list of (timestamp, service) of events in a batch."""
+    out = []
+    for evt in PacketFooter(view=batch).split_packets():
+        evt_pf = PacketFooter(view=evt)
+        dgram = [d for i, d in enumerate(evt_pf.split_packets()) if evt_pf.get_size(i)][0]
+        seq_low, seq_high, env = np.frombuffer(dgram, dtype='<u4', count=3)
+        out.append(((int(seq_high) << 32) | int(seq_low), int(env) >> 24))
+    return out
+
+class TestEventBuilderSelection(unittest.TestCase):
+
+    def setUp(self):
+        # Stream 0 has a transition every 50 dgrams, stream 1 misses every third dgram
+        dgrams = np.frombuffer(make_view(N_EVENTS), dtype=np.uint8).reshape(N_EVENTS, -1).copy()
+        dgrams[::50, 8:12].view('<u4')[:, 0] = BEGINSTEP << 24
+        self.views = [bytearray(dgrams.tobytes()), make_view(N_EVENTS, missing_every=3)]
+        self.timestamps = np.arange(1, N_EVENTS + 1)
+        self.is_l1 = np.ones(N_EVENTS, dtype=bool)
+        self.is_l1[::50] = False
+
+    def build_all(self, single_pass, **selection):
+        os.environ['PS_EB_SINGLE_PASS'] = str(single_pass)
+        eb = EventBuilder([memoryview(view) for view in self.views], [None, None])
+        eb.set_selection(**selection)
+        events = []
+        while True:
+            batch_dict, _ = eb.build(batch_size=37)
+            if eb.nevents == 0 and eb.nsteps == 0: break
+            events += get_timestamps(batch_dict[0][0])
+        return events, eb.n_l1_seen
+
+    def expected(self, timestamps=None, ts_range=None, stride=0):
+        l1 = self.timestamps[self.is_l1]
+        if timestamps is not None:
+            l1 = l1[np.isin(l1, timestamps)]
+        if ts_range is not None:
+            l1 = l1[(l1 >= ts_range[0]) & (l1 <= ts_range[1])]
+        if stride:
+            l1 = l1[::stride]
+        transitions = [(int(ts), BEGINSTEP) for ts in self.timestamps[~self.is_l1]]
+        return sorted([(int(ts), L1ACCEPT) for ts in l1] + transitions)
+
+    def test_selections(self):
+        for selection in (dict(), dict(ts_range=(100, 300)), dict(timestamps=[5, 7, 50, 999, 2000]),
+                dict(stride=7), dict(ts_range=(10, 800), stride=3)):
+            for single_pass in (0, 1):
+                events, _ = self.build_all(single_pass, **selection)
+                self.assertEqual(events, self.expected(**selection), f'{selection} single_pass={single_pass}')
+
+    def test_stride_continues(self):
+        # Count of the first EventBuilder is carried over to the second one
+        _, n_l1_seen = self.build_all(1, stride=7)
+        events, _ = self.build_all(1, stride=7, n_l1_seen=n_l1_seen)
+        l1 = self.timestamps[self.is_l1]
+        first = (-n_l1_seen) % 7
+        self.assertEqual([ts for ts, service in events if service == L1ACCEPT], list(l1[first::7]))
+
+    def test_stride_per_eb_node(self):
+        # Chunks of smd0 go to EB nodes in turn together with the no. of
+        # L1Accepts before them (see node.Smd0), so every Nth L1Accept of
+        # the run is kept for any no. of nodes
+        view = make_view(N_EVENTS)
+        chunk_size = 100 * (len(view) // N_EVENTS)
+        chunks = [view[i:i + chunk_size] for i in range(0, len(view), chunk_size)]
+        n_l1_before = [100 * i for i in range(len(chunks))]
+
+        def build_node(node_chunks):
+            events = []
+            for chunk, n_l1_seen in node_chunks:
+                eb = EventBuilder([memoryview(chunk)], [None])
+                eb.set_selection(stride=7, n_l1_seen=n_l1_seen)
+                while True:
+                    batch_dict, _ = eb.build(batch_size=37)
+                    if eb.nevents == 0 and eb.nsteps == 0: break
+                    events += [ts for ts, _ in get_timestamps(batch_dict[0][0])]
+            return events
+
+        for n_nodes in (1, 2, 3):
+            node_chunks = list(zip(chunks, n_l1_before))
+            events = sum([build_node(node_chunks[node::n_nodes]) for node in range(n_nodes)], [])
+            self.assertEqual(sorted(events), list(self.timestamps[::7]), f'n_nodes={n_nodes}')
+
+def test_stride_per_run(tmp_path, monkeypatch):
+    # Run 2 is a copy of run 1, the stride count restarts at each run
+    setup_input_files(tmp_path)
+    monkeypatch.setattr(wu, 'calib_constants_all_types', lambda *args, **kwargs: {})
+    ds = DataSource(exp='xpptut15', run=[1, 2], dir=str(tmp_path / '.tmp'), stride=3)
+    timestamps = [[evt.timestamp for evt in run.events()] for run in ds.runs()]
+    assert len(timestamps) == 2
+    assert len(timestamps[0]) == 4
+    assert timestamps[1] == timestamps[0]
+
+
+if __name__ == "__main__":
+    unittest.main()
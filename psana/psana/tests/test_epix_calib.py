@@ -13,5 +13,41 @@ def test_epix_calib():
         calibsample=image[10][0:5]
         assert np.allclose(correctanswer[nevt][0:5], calibsample, rtol=.001)
 
+def test_epix_calib_batch():
+    dir_path = os.path.dirname(os.path.realpath(__file__))
+    ds = DataSource(files=os.path.join(dir_path,'test_epix_calib.xtc2'))
+    myrun = next(ds.runs())
+    epix = myrun.Detector('epixquad')
+    events = list(myrun.events())
+    raws = epix.raw.raw_batch(events)
+    assert raws.shape == (len(events),) + epix.raw.raw(events[0]).shape
+    calibs = epix.raw.calib_batch(events)
+    for i,evt in enumerate(events):
+        assert np.array_equal(raws[i], epix.raw.raw(evt))
+        assert np.array_equal(calibs[i], epix.raw.calib(evt))
+    assert epix.raw.calib_batch(events, out=calibs) is calibs
+
+def test_gain_range_tables():
+    from psana.detector.UtilsEpix10ka import GainRangeTables, gain_maps_epix10ka_any, cbits_config_epix10ka_any
+    rng = np.random.default_rng(0)
+    class Config: pass
+    dcfg = {}
+    for i, trbit in enumerate(([1,1,1,1], [0,0,0,0], [1,0,1,0])):
+        dcfg[i] = Config()
+        dcfg[i].config = Config()
+        dcfg[i].config.trbit = np.array(trbit)
+        dcfg[i].config.asicPixelConfig = rng.choice(np.array([0,1,2,4,8,12,13], dtype=np.uint8), size=(4,178,192))
+    raw = rng.integers(0, 1<<16, size=(3,352,384), dtype=np.uint16)
+    peds = rng.uniform(1000, 3000, size=(7,3,352,384)).astype(np.float32)
+    gain = rng.uniform(0.5, 20, size=(7,3,352,384)).astype(np.float32)
+
+    tables = GainRangeTables(peds, gain, cbits_config_epix10ka_any(dcfg))
+    pedest, factor = tables.gather(tables.gain_range_index(raw))
+    gmaps = gain_maps_epix10ka_any(dcfg, raw)
+    assert np.array_equal(pedest, np.select(gmaps, tuple(peds), default=0))
+    assert np.array_equal(factor, np.select(gmaps, tuple(1/gain), default=1))
+
 if __name__ == "__main__":
     test_epix_calib()
+    test_epix_calib_batch()
+    test_gain_range_tables()
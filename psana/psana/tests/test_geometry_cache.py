@@ -0,0 +1,33 @@
+import os
+import numpy as np
+
+from psana.pscalib.geometry.GeometryAccess import GeometryAccess
+from psana.pscalib.geometry.GeometryCache import geometry_cache
+
+FNAME = os.path.join(os.path.dirname(__file__), '../pscalib/geometry/data/geometry-def-cspad2x2.data')
+
+def test_geometry_cache(tmp_path, monkeypatch):
+    monkeypatch.delenv('LCLS_GEO_CACHE', raising=False)
+    assert geometry_cache() is None # caching is opt-in
+    geo = GeometryAccess(FNAME)
+    xyz = [a.copy() for a in geo.get_pixel_coords(cframe=1)]
+    rc = [a.copy() for a in geo.get_pixel_coord_indexes(pix_scale_size_um=50, xy0_off_pix=(10,10))]
+
+    monkeypatch.setenv('LCLS_GEO_CACHE', str(tmp_path))
+    cache = geometry_cache()
+    for i in range(2): # new geometry objects use entries saved by the first one
+        geo = GeometryAccess(FNAME)
+        for a, b in zip(geo.get_pixel_coords(cframe=1), xyz):
+            assert a.dtype == b.dtype and np.array_equal(a, b)
+            a += 1 # arrays stay writeable, changes are not saved in the cache
+        for a, b in zip(geo.get_pixel_coord_indexes(pix_scale_size_um=50, xy0_off_pix=(10,10)), rc):
+            assert a.dtype == b.dtype and np.array_equal(a, b)
+    assert len(cache.entries()) == 3 # X,Y,Z for cframe=1 and 0, rows,cols
+    assert cache.hits == 2
+
+    # other call parameters and modified geometry get their own entries
+    geo.get_pixel_coord_indexes()
+    assert len(cache.entries()) == 4
+    geo.move_geo(dx=100)
+    y = geo.get_pixel_coords(cframe=1)[1] # lab frame y = -x
+    assert np.allclose(y, xyz[1] - 100) and len(cache.entries()) == 5
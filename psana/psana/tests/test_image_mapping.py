@@ -0,0 +1,31 @@
+import numpy as np
+from psana.detector.UtilsAreaDetector import ImageMapping
+
+def test_image_mapping():
+    # 2 panels 20x30 scaled on image so that some bins get 2 pixels, one pixel moved to make a hole
+    r, c = np.meshgrid(np.arange(20), np.arange(30), indexing='ij')
+    rows = np.stack((r, r + 22))
+    cols = np.stack(((c*0.9).astype(np.int64), (c*0.9).astype(np.int64)))
+    cols[0, 10, 5] = cols[0, 10, 6]
+    data = np.random.default_rng(0).normal(size=rows.shape).astype(np.float32)
+
+    imap = ImageMapping(rows, cols)
+    bins = {}
+    for (rr, cc), v in zip(zip(rows.ravel(), cols.ravel()), data.ravel()):
+        bins.setdefault((rr, cc), []).append(v)
+    assert imap.img_entries.sum() == rows.size
+    assert imap.hole_inds.tolist() == [10*imap.img_shape[1] + 4]
+
+    img_max = imap.image(data, mapmode=2, fillholes=False, vbase=-10)
+    img_mean = imap.image(data, mapmode=3, fillholes=False)
+    for (rr, cc), vals in bins.items():
+        assert img_max[rr, cc] == max(vals)
+        assert np.isclose(img_mean[rr, cc], np.mean(vals))
+    assert img_max[10, 4] == -10
+
+    img = imap.image(data, mapmode=2, fillholes=True, out=img_max)
+    assert img is img_max
+    assert img[10, 4] == min(img[9, 4], img[11, 4], img[10, 3], img[10, 5])
+
+if __name__ == "__main__":
+    test_image_mapping()
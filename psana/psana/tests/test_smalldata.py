@@ -1,8 +1,10 @@
-
-
 import os
+import h5py
+import numpy as np
 from setup_input_files import setup_input_files
 import run_smalldata
+import pytest
+from psana.smalldata import Server, ColumnBatch, BufferPacker, BufferUnpacker, Accumulator, MeanVar, Histogram, ImageSum, _merge_accumulators
 
 def test_smalldata(tmp_path):
     setup_input_files(tmp_path) # tmp_path is from pytest
@@ -10,4 +12,147 @@ def test_smalldata(tmp_path):
     run_smalldata.main(tmp_path)
     return
 
+def test_columnar_server(tmp_path):
+    # Columnar batches must give the same file as per-event dict batches
+    events = []
+    for i in range(250):
+        event_data_dict = {'timestamp': i + 1, 'late/img': np.full((2, 3), i, dtype=np.float32)}
+        if i % 3: event_data_dict['oneint'] = i
+        if i % 4: event_data_dict['onefloat'] = i / 2
+        if i % 5 == 0: event_data_dict['unaligned_int'] = i
+        if i < 100: del event_data_dict['late/img']
+        events.append(event_data_dict)
+
+    datasets = []
+    for name, columnar in (('dicts.h5', False), ('columns.h5', True)):
+        srv = Server(filename=str(tmp_path / name), cache_size=40)
+        for st in range(0, len(events), 30):
+            batch = events[st:st+30]
+            srv.handle(ColumnBatch.from_events(batch) if columnar else batch)
+        srv.done()
+        with h5py.File(tmp_path / name, 'r') as f:
+            datasets.append({key: f[key][:] for key in ('timestamp', 'oneint', 'onefloat', 'unaligned_int', 'late/img')})
+
+    for key, data in datasets[0].items():
+        np.testing.assert_array_equal(data, datasets[1][key])
+    assert datasets[1]['unaligned_int'].shape == (50,)
+    return
+
+def test_writer_thread(tmp_path, monkeypatch):
+    # Caches written by the writer thread must give the same (trimmed)
+    # datasets as caches written in the receiving thread
+    events = []
+    for i in range(333):
+        event_data_dict = {'timestamp': i + 1, 'oneint': i, 'wf': np.arange(4, dtype=np.float32) + i}
+        if i % 7: event_data_dict['ragged_peaks'] = np.arange(i % 5, dtype=np.float32)
+        if i >= 120: event_data_dict['late/img'] = np.full((2, 3), i, dtype=np.float32)
+        events.append(event_data_dict)
+
+    datasets = []
+    for queue_size in ('0', '1', '2'):
+        monkeypatch.setenv('PS_SMD_WRITE_QUEUE', queue_size)
+        name = tmp_path / f'queue{queue_size}.h5'
+        srv = Server(filename=str(name), cache_size=16)
+        assert (srv._writer is None) == (queue_size == '0')
+        for st in range(0, len(events), 25):
+            srv.handle(ColumnBatch.from_events(events[st:st+25]))
+        srv.done()
+        with h5py.File(name, 'r') as f:
+            datasets.append({key: f[key][:] for key in f.keys() if isinstance(f[key], h5py.Dataset)}
+                            | {'late/img': f['late/img'][:]})
 
+    assert datasets[0]['timestamp'].shape == (333,)
+    assert datasets[0]['late/img'].shape == (333, 2, 3)
+    np.testing.assert_array_equal(datasets[0]['late/img'][120:, 0, 0], np.arange(120, 333))
+    assert datasets[0]['ragged_peaks'].shape == (sum(i % 5 for i in range(333) if i % 7),)
+    for data in datasets[1:]:
+        assert data.keys() == datasets[0].keys()
+        for key, values in data.items():
+            assert values.shape == datasets[0][key].shape, key
+            np.testing.assert_array_equal(values, datasets[0][key])
+    return
+
+def test_buffer_transport():
+    events = [{'timestamp': i + 1, 'oneint': i, 'wf': np.arange(5, dtype=np.uint16) + i} for i in range(20)]
+    for i in range(0, 20, 3):
+        events[i]['onefloat'] = i / 2
+    packer, unpacker = BufferPacker(), BufferUnpacker()
+    for st in (0, 10):
+        batch = ColumnBatch.from_events(events[st:st+10])
+        new_schema, buf = packer.pack(batch)
+        assert bool(new_schema) == (st == 0) # schema is only sent once
+        unpacker.update(new_schema)
+        unpacked = unpacker.unpack(buf)
+        assert unpacked.n_events == batch.n_events
+        for dataset_name, (values, mask) in batch.columns.items():
+            np.testing.assert_array_equal(unpacked.columns[dataset_name][0], values)
+            np.testing.assert_array_equal(unpacked.columns[dataset_name][1], mask)
+    return
+
+def test_ragged(tmp_path):
+    # ragged datasets are stored flat with per-event lengths
+    events = []
+    for i in range(100):
+        event_data_dict = {'timestamp': i + 1}
+        if i % 3: event_data_dict['ragged_peaks'] = np.arange(i % 5, dtype=np.float32)
+        events.append(event_data_dict)
+
+    for name, columnar in (('dicts.h5', False), ('columns.h5', True)):
+        srv = Server(filename=str(tmp_path / name), cache_size=16)
+        for st in range(0, len(events), 30):
+            batch = events[st:st+30]
+            srv.handle(ColumnBatch.from_events(batch) if columnar else batch)
+        srv.done()
+        with h5py.File(tmp_path / name, 'r') as f:
+            lengths = f['ragged_peaks_lengths'][:]
+            values = f['ragged_peaks'][:]
+        assert lengths.shape == (100,)
+        offsets = np.concatenate(([0], np.cumsum(lengths)))
+        for i, event_data_dict in enumerate(events):
+            expected = event_data_dict.get('ragged_peaks', np.zeros(0))
+            np.testing.assert_array_equal(values[offsets[i]:offsets[i+1]], expected)
+    return
+
+def test_accumulators():
+    # merging accumulators of parts gives the results of the whole
+    rng = np.random.default_rng(0)
+    values = rng.normal(5, 2, (300, 4))
+    values[rng.random(values.shape) < 0.1] = np.nan
+    parts = [values[:70], values[70:71], values[71:]]
+
+    accs = []
+    for part in parts:
+        acc = {'mv': MeanVar(), 'h': Histogram(20, (0, 10)), 'img': ImageSum((4,))}
+        for value in part:
+            acc['mv'].update(np.nan_to_num(value))
+            acc['h'].update(value[~np.isnan(value)])
+            acc['img'].update(value)
+        accs.append(acc)
+    merged = {name: acc.merged(accs[1][name]).merged(accs[2][name]) for name, acc in accs[0].items()}
+
+    filled = np.nan_to_num(values)
+    np.testing.assert_allclose(merged['mv'].results()['mean'], filled.mean(axis=0))
+    np.testing.assert_allclose(merged['mv'].results()['var'], filled.var(axis=0))
+    finite = values[~np.isnan(values)]
+    h = merged['h'].results()
+    np.testing.assert_array_equal(h['counts'], np.histogram(finite, 20, (0, 10))[0])
+    assert h['underflow'] + h['overflow'] + h['counts'].sum() == finite.shape[0]
+    np.testing.assert_allclose(merged['img'].results()['mean'], np.nanmean(values, axis=0))
+    assert accs[0]['mv'].count == 70 # inputs of merged are unchanged
+
+    # updated since the last reset (done() skips the final reduction if not)
+    for acc in accs[0].values():
+        assert acc.updated
+        acc.reset()
+        assert not acc.updated
+    with pytest.raises(TypeError):
+        Accumulator()
+
+    # clients with different (or no) accumulators merge to the union of names
+    only_h = {'h': accs[1]['h']}
+    for a, b in ((accs[0], only_h), (only_h, accs[0]), ({}, accs[0]), (accs[0], {})):
+        union = _merge_accumulators(a, b)
+        assert sorted(union) == ['h', 'img', 'mv']
+    assert _merge_accumulators({}, {}) == {}
+    assert np.array_equal(_merge_accumulators(only_h, accs[0])['h'].counts, accs[1]['h'].counts + accs[0]['h'].counts)
+    return
@@ -0,0 +1,65 @@
+import os, sys, glob
+import pytest
+import numpy as np
+sys.path = [os.path.abspath(os.path.dirname(__file__))] + sys.path
+from psana import DataSource
+from psana.psexp.ds_base import InvalidDataSourceArgument
+from psana.psexp.smd_index import INDEX_DTYPE, build_index, save_index, load_index
+import psana.pscalib.calib.MDBWebUtils as wu
+from setup_input_files import setup_input_files
+
+N_EVENTS = 1500
+
+@pytest.fixture(scope='module')
+def xtc_dir(tmp_path_factory):
+    tmp_path = tmp_path_factory.mktemp('smd_index')
+    # no SlowUpdates between L1Accepts
+    setup_input_files(tmp_path, slow_update_freq=2*N_EVENTS, n_events_per_step=N_EVENTS, gen_run2=False)
+    return str(tmp_path / '.tmp')
+
+@pytest.fixture(autouse=True)
+def no_calib(monkeypatch):
+    # calibration constants are not used here
+    monkeypatch.setattr(wu, 'calib_constants_all_types', lambda *args, **kwargs: {})
+
+def get_timestamps(xtc_dir, **kwargs):
+    ds = DataSource(exp='xpptut15', run=1, dir=xtc_dir, **kwargs)
+    return [evt.timestamp for run in ds.runs() for evt in run.events()]
+
+def test_indexed_events(xtc_dir):
+    timestamps = get_timestamps(xtc_dir)
+    assert len(timestamps) == N_EVENTS
+    assert get_timestamps(xtc_dir, smd_index=True) == timestamps
+
+    # more rejected events in a row than the recursion limit
+    sparse = lambda evt: evt.timestamp % 1200 == 0
+    selected = get_timestamps(xtc_dir, filter=sparse)
+    assert 0 < len(selected) < 3
+    assert get_timestamps(xtc_dir, smd_index=True, filter=sparse) == selected
+    assert get_timestamps(xtc_dir, smd_index=True, filter=lambda evt: False) == []
+
+    assert get_timestamps(xtc_dir, smd_index=True, start_ts=timestamps[100], evt_range=(5, 50)) == timestamps[105:150]
+    assert get_timestamps(xtc_dir, smd_index=True, max_events=10) == timestamps[:10]
+
+    parts = [get_timestamps(xtc_dir, smd_index=True, index_rank=rank, index_size=3) for rank in range(3)]
+    assert sum(parts, []) == timestamps
+
+def test_smd_index_live(xtc_dir):
+    with pytest.raises(InvalidDataSourceArgument):
+        DataSource(exp='xpptut15', run=1, dir=xtc_dir, smd_index=True, live=True)
+
+def test_index_chunk_id(xtc_dir, tmp_path, monkeypatch):
+    monkeypatch.setenv('PS_SMD_INDEX_DIR', str(tmp_path))
+    smd_file = sorted(glob.glob(os.path.join(xtc_dir, 'smalldata', '*.smd.xtc2')))[0]
+    index = build_index(smd_file)
+
+    # more than 255 bigdata chunks
+    index['chunk_id'] = np.arange(index.shape[0]) + 250
+    save_index(smd_file, index)
+    assert np.array_equal(load_index(smd_file)['chunk_id'], index['chunk_id'])
+
+    # index files of an older layout are rebuilt
+    old_dtype = np.dtype([(name, 'u1' if name == 'chunk_id' else INDEX_DTYPE[name]) for name in INDEX_DTYPE.names])
+    save_index(smd_file, build_index(smd_file).astype(old_dtype))
+    assert load_index(smd_file, build=False) is None
+    assert load_index(smd_file).dtype == INDEX_DTYPE
@@ -0,0 +1,98 @@
+from psana.psexp.packet_footer import PacketFooter
+from psana.smdparser import parse_smd_batch, index_smd
+import numpy as np
+import os
+import unittest
+
+L1ACCEPT = 12
+SLOWUPDATE = 10
+
+def read_dgrams(xtc_file):
+    """ Returns list of (service, dgram bytes) from an smd file."""
+    with open(xtc_file, 'rb') as f:
+        data = f.read()
+    dgrams = []
+    offset = 0
+    while offset < len(data):
+        env, extent = np.frombuffer(data, dtype='<u4', count=6, offset=offset)[[2, 5]]
+        size = 24 + int(extent) - 12
+        dgrams.append((int(env >> 24) & 0xf, data[offset: offset+size]))
+        offset += size
+    return dgrams
+
+class TestSmdParser(unittest.TestCase):
+
+    def setUp(self):
+        # Streams in one event must have the same services - use the same file twice
+        smd_file = os.path.join(os.path.dirname(__file__), 'test_data', 'mixed_rate', 'smalldata', 'data-r0001-s00.smd.xtc2')
+        self.streams = [read_dgrams(smd_file)] * 2
+
+    def make_batch(self, n_events):
+        """ Pairs dgrams of the two streams by index. Every third
+        dgram of stream 1 is left out to create missing dgrams."""
+        batch_pf = PacketFooter(n_events)
+        batch = bytearray()
+        for i_evt in range(n_events):
+            evt_pf = PacketFooter(2)
+            evt = bytearray()
+            for i_smd, dgrams in enumerate(self.streams):
+                if i_smd == 1 and i_evt % 3 == 2 and dgrams[i_evt][0] == L1ACCEPT:
+                    continue
+                evt.extend(dgrams[i_evt][1])
+                evt_pf.set_size(i_smd, len(dgrams[i_evt][1]))
+            evt.extend(evt_pf.footer)
+            batch.extend(evt)
+            batch_pf.set_size(i_evt, len(evt))
+        batch.extend(batch_pf.footer)
+        return batch
+
+    def test_offsets_and_sizes(self):
+        n_events = min(len(self.streams[0]), 50)
+        batch = self.make_batch(n_events)
+        out = parse_smd_batch(batch, 2, True)
+        assert out['services'].shape == (n_events,)
+        for i_evt in range(n_events):
+            for i_smd, dgrams in enumerate(self.streams):
+                service, dg = dgrams[i_evt]
+                size = out['smd_size'][i_evt, i_smd]
+                if out['cutoff_flag'][i_evt, i_smd] == 0:
+                    assert size == 0 and i_smd == 1 and i_evt % 3 == 2
+                    continue
+                offset = out['smd_offset'][i_evt, i_smd]
+                assert batch[offset: offset+size] == dg
+                assert out['services'][i_evt] == service
+                if service == L1ACCEPT:
+                    bd_offset, bd_size = np.frombuffer(dg, dtype='<u8', count=2, offset=len(dg)-16)
+                    assert out['bd_offset'][i_evt, i_smd] == bd_offset
+                    assert out['bd_size'][i_evt, i_smd] == bd_size
+                    assert out['needs_dgram'][i_evt, i_smd] == 0
+                else:
+                    assert out['needs_dgram'][i_evt, i_smd] == (service == SLOWUPDATE)
+
+    def test_no_bigdata(self):
+        batch = self.make_batch(10)
+        out = parse_smd_batch(batch, 2, False)
+        assert not out['bd_offset'].any() and not out['needs_dgram'].any()
+
+    def test_empty(self):
+        out = parse_smd_batch(bytearray(), 2, True)
+        assert out['smd_offset'].shape == (0, 2)
+
+    def test_index_smd(self):
+        dgrams = self.streams[0]
+        view = b''.join(dg for _, dg in dgrams)
+        out = index_smd(view)
+        assert out['n_bytes'] == len(view)
+        assert list(out['service']) == [service for service, _ in dgrams]
+        assert (np.diff(out['smd_offset']) == out['smd_size'][:-1]).all()
+        for i, (service, dg) in enumerate(dgrams):
+            if service == L1ACCEPT:
+                assert out['bd_offset'][i] == np.frombuffer(dg, dtype='<u8', count=1, offset=len(dg)-16)[0]
+        
+        # Trailing incomplete dgram is left out
+        out = index_smd(view[:-1])
+        assert out['n_bytes'] == len(view) - len(dgrams[-1][1])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -269,6 +269,14 @@ if 'DGRAM' in BUILD_LIST :
     )
     CYTHON_EXTS.append(ext)
 
+    ext = Extension("psana.smdparser",
+                    sources=["psana/smdparser.pyx"],
+                    include_dirs=["psana"],
+                    extra_compile_args=extra_c_compile_args,
+                    extra_link_args=extra_link_args,
+    )
+    CYTHON_EXTS.append(ext)
+
     ext = Extension("psana.parallelreader",
                     sources=["psana/parallelreader.pyx"],
                     include_dirs=["psana"],
@@ -277,6 +285,13 @@ if 'DGRAM' in BUILD_LIST :
     )
     CYTHON_EXTS.append(ext)
 
+    ext = Extension("psana.detector.commonmode_ext",
+                    sources=["psana/detector/commonmode_ext.pyx"],
+                    extra_compile_args=extra_c_compile_args + openmp_compile_args,
+                    extra_link_args=extra_link_args + openmp_link_args,
+    )
+    CYTHON_EXTS.append(ext)
+
 
 if 'HSD' in BUILD_LIST :
     ext = Extension("hsd",